@@ -0,0 +1,369 @@
+import json
+import lzma
+import zlib
+import pickle
+import struct
+
+MESSAGE_HANDSHAKE = 0
+MESSAGE_DATA = 1
+MESSAGE_READY = 2
+MESSAGE_ROUTE_ERR = 3
+MESSAGE_DEL = 4
+MESSAGE_SERVER_UP = 5
+MESSAGE_SERVER_DOWN = 6
+MESSAGE_CLIENT_UP = 7
+MESSAGE_CLIENT_DOWN = 8
+MESSAGE_PANIC_OVER = 9
+MESSAGE_ENTRY = 10
+MESSAGE_OVER = 11
+MESSAGE_LAT_DIS = 12
+MESSAGE_CLEAR = 13
+MESSAGE_EXIT = 14
+MESSAGE_HANDSHAKE_RDMA = 15
+MESSAGE_TRANSPORT = 16
+
+class Message:
+    def __init__(self, type_id=None, req_id=None, req=None, index=0):
+        """
+        type_id: int
+        - MESSAGE_HANDSHAKE: transfer dtc info between func and cc
+          - req_id: None
+          - req: dict, func sends name, node and rnic, then cc returns zookeeper info
+          - index: int, index of parallel funcs
+        - MESSAGE_DATA: result data from upstream
+          - req_id: int, 64-bit request id assigned by the entry
+          - req: str
+          - index: int, index of parallel funcs
+        - MESSAGE_READY: all depends ready from downstream
+          - req_id: int
+          - req: None
+          - index: int, index of func that sent this message
+        - MESSAGE_ROUTE_ERR: route error from downstream
+          - req_id: int
+          - req: None
+          - index: int, index of func that has route err
+        - MESSAGE_DEL: upstream ask to delete data due to route err
+          - req_id: int
+          - req: None
+          - index: None
+        - MESSAGE_SERVER_UP or MESSAGE_CLIENT_UP: scale up from controller, enter panic mode,
+          - req_id: int, update_id
+          - req: None
+          - index: int, index of func needs scale up
+        - MESSAGE_SERVER_DOWN or MESSAGE_CLIENT_DOWN: scale down from controller, enter panic mode,
+          - req_id: int, update_id
+          - req: str, func_id
+          - index: int, index of func needs scale down
+        - MESSAGE_PANIC_OVER: all funcs have updated the routing table, exit panic mode
+          - req_id: int, update id
+          - req: None
+          - index: None
+        - MESSAGE_ENTRY: get the server ips of entry funcs
+          - req_id: None
+          - req: str, func_name
+          - index: None
+        - MESSAGE_OVER: funcs of final stage send to cc for calculating latency
+          - req_id: int
+          - req: str
+          - index: int
+        - MESSAGE_LAT_DIS: latency distribution from cc
+          - req_id: None
+          - req: None
+          - index: None
+        - MESSAGE_CLEAR: clear the stored latencies in cc
+          - req_id: None
+          - req: None
+          - index: None
+        - MESSAGE_EXIT: exit the sidecar
+          - req_id: None
+          - req: None
+          - index: None
+        - MESSAGE_HANDSHAKE_RDMA: handshake RDMA information
+          - req_id: None
+          - req: str, '{gid},{qp_num},{recv_mr.buf},{recv_mr.rkey}'
+          - index: int (nqp)
+        - MESSAGE_TRANSPORT: transport a func chose for a downstream instance, recorded in the grt by cc
+          - req_id: None
+          - req: dict, {"server": func_id, "client": func_id, "transport": "uds", "rdma" or "tcp"}
+          - index: None
+        """
+        self.type_id = type_id
+        self.req_id = req_id
+        self.req = req
+        self.index = index
+
+    def dumps(self):
+        message = {"type": self.type_id}
+        if not self.req_id is None:
+            message["req_id"] = self.req_id
+        if not self.req is None:
+            message["req"] = self.req
+        if not self.index is None:
+            message["index"] = self.index
+
+        return json.dumps(message)
+
+    def loads(self, message_str):
+        message = json.loads(message_str)
+
+        self.type_id = message["type"]
+        if "req_id" in message:
+            self.req_id = message["req_id"]
+        if "req" in message:
+            self.req = message["req"]
+        if "index" in message:
+            self.index = message["index"]
+
+
+# binary frame of a message: type_id, flags, index, req_id and length of the payload, then the payload,
+# so a frame is parsed and routed without unpickling the whole Message
+FRAME_HEADER = struct.Struct("!BBHQI")
+FRAME_NO_REQ_ID = 1
+FRAME_NO_INDEX = 2
+FRAME_NO_REQ = 4
+# payload is req as raw bytes or utf-8, else it is a pickle of req
+FRAME_BYTES = 8
+FRAME_STR = 16
+# payload is a pickle of the whole object, for objects that are not a Message or do not fit the header
+FRAME_OBJECT = 32
+# payload is the number and lengths of the out-of-band buffers, a protocol 5 pickle of req, then the buffers
+FRAME_OOB = 64
+OOB_COUNT = struct.Struct("!I")
+# payload is the codec, then the payload of the other flags compressed with it
+FRAME_COMPRESSED = 128
+COMPRESSED = struct.Struct("!B")
+CODEC_NONE = 0
+CODEC_ZLIB = 1
+CODEC_LZMA = 2
+
+MAX_REQ_ID = (1 << 64) - 1
+MAX_INDEX = (1 << 16) - 1
+
+# bytes values of at least OOB_THRESHOLD in a req, e.g. the .ivf and .state files of ExCamera,
+# are not copied into the pickle but sent as buffers of their own
+OOB_THRESHOLD = 64 * 1024
+
+def fits_header(message):
+    if type(message) is not Message or type(message.type_id) is not int or not 0 <= message.type_id <= 255:
+        return False
+    if message.req_id is not None and (type(message.req_id) is not int or not 0 <= message.req_id <= MAX_REQ_ID):
+        return False
+    if message.index is not None and (type(message.index) is not int or not 0 <= message.index <= MAX_INDEX):
+        return False
+    return True
+
+# a bytes value pickled as a PickleBuffer, which protocol 5 hands to the buffer_callback,
+# pickle does not call reducer_override for bytes so the value has to be wrapped
+class OutOfBand:
+    def __init__(self, data):
+        self.data = data
+        self.buffer = pickle.PickleBuffer(data)
+
+    def __reduce_ex__(self, protocol):
+        return bytes, (self.buffer,)
+
+# (copy of req with its big bytes values wrapped, id of a value -> its wrapper), None if it has none;
+# the values of a dict, list or tuple are checked, handlers put their files there, and a value held twice is wrapped once
+def wrap_blobs(req):
+    if type(req) is dict:
+        items = req.items()
+    elif type(req) is list or type(req) is tuple:
+        items = enumerate(req)
+    else:
+        return None
+    copy = None
+    for key, value in items:
+        if type(value) is not bytes or len(value) < OOB_THRESHOLD:
+            continue
+        if copy is None:
+            copy = dict(req) if type(req) is dict else list(req)
+            wrappers = {}
+        wrapper = wrappers.get(id(value), None)
+        if wrapper is None:
+            wrapper = OutOfBand(value)
+            wrappers[id(value)] = wrapper
+        copy[key] = wrapper
+    if copy is None:
+        return None
+    return tuple(copy) if type(req) is tuple else copy, wrappers
+
+# payload buffers of a req with big bytes values, the values themselves are the last buffers
+def dumps_oob(req, wrappers):
+    # only our own buffers go out-of-band, others, e.g. of numpy arrays, may be reused by their owner
+    own = {id(wrapper.buffer): wrapper.data for wrapper in wrappers.values()}
+    blobs = []
+
+    def buffer_callback(buffer):
+        data = own.get(id(buffer), None)
+        if data is None:
+            return True
+        blobs.append(data)
+        return False
+
+    pickled = pickle.dumps(req, protocol=5, buffer_callback=buffer_callback)
+    lengths = struct.pack(f"!{len(blobs)}Q", *map(len, blobs))
+    return [OOB_COUNT.pack(len(blobs)) + lengths, pickled, *blobs]
+
+# views of the parts of a FRAME_OOB payload, like dumps_oob returns them
+def split_oob(payload):
+    count, = OOB_COUNT.unpack_from(payload, 0)
+    lengths = struct.unpack_from(f"!{count}Q", payload, OOB_COUNT.size)
+    start = OOB_COUNT.size + 8 * count
+    end = len(payload) - sum(lengths)
+    views = [payload[:start], payload[start: end]]
+    for length in lengths:
+        views.append(payload[end: end + length])
+        end += length
+    return views
+
+# req of a FRAME_OOB payload, each out-of-band buffer is copied once, from the frame into a bytes value
+def loads_oob(payload):
+    views = split_oob(payload)
+    try:
+        return pickle.loads(views[1], buffers=views[2:])
+    finally:
+        # the frame may be a reused recv buffer or a mapping that is closed next
+        for view in views:
+            view.release()
+
+# req encoded ahead by the sender, e.g. to compress it for one edge, its flags and payload buffers
+# are sent as they are and with a codec the receiver decompresses the payload and gets back the req
+class Encoded:
+    def __init__(self, flags, buffers, codec=CODEC_NONE):
+        self.flags = flags
+        self.buffers = buffers
+        self.codec = codec
+
+# req encoded like encode sends it, e.g. once for all downstream funcs and replays of a result
+def dumps_req(req):
+    if req is None:
+        return Encoded(FRAME_NO_REQ, [])
+    if type(req) is Encoded:
+        return req
+    if type(req) is bytes:
+        return Encoded(FRAME_BYTES, [req] if req else [])
+    if type(req) is str:
+        payload = req.encode()
+        return Encoded(FRAME_STR, [payload] if payload else [])
+    wrapped = wrap_blobs(req)
+    if wrapped is not None:
+        return Encoded(FRAME_OOB, dumps_oob(*wrapped))
+    return Encoded(0, [pickle.dumps(req, protocol=pickle.HIGHEST_PROTOCOL)])
+
+# req of a message for the handler, decode keeps the req of a MESSAGE_DATA encoded until it is loaded here, once
+def load_req(req):
+    if type(req) is not Encoded:
+        return req
+    if req.flags & FRAME_NO_REQ:
+        return None
+    if req.codec == CODEC_NONE and req.flags & FRAME_OOB:
+        # bytes buffers are the values themselves, not copied again
+        return pickle.loads(req.buffers[1], buffers=req.buffers[2:])
+    payload = req.buffers[0] if len(req.buffers) == 1 else b"".join(req.buffers)
+    if req.codec != CODEC_NONE:
+        payload = memoryview(decompress(req.codec, payload))
+    return loads_req(req.flags, payload)
+
+# req of a MESSAGE_DATA payload, kept encoded as the parts encode sent, the sidecar routes the message by
+# its header only; the parts are views of an owned frame, which stays alive until the req is loaded,
+# the frames the transports reuse or close next are copied, which is what loading the req would have copied anyway
+def keep_req(flags, payload, owned):
+    codec = CODEC_NONE
+    if flags & FRAME_COMPRESSED:
+        codec = payload[0]
+        views = [payload[COMPRESSED.size:]]
+    elif flags & FRAME_OOB:
+        views = split_oob(payload)
+    elif not owned:
+        return Encoded(flags & ~(FRAME_NO_REQ_ID | FRAME_NO_INDEX), [bytes(payload)])
+    else:
+        views = [payload[:]]
+    if not owned:
+        buffers = []
+        for view in views:
+            with view:
+                buffers.append(bytes(view))
+        views = buffers
+    return Encoded(flags & ~(FRAME_NO_REQ_ID | FRAME_NO_INDEX | FRAME_COMPRESSED), views, codec)
+
+# req of a payload with the given flags
+def loads_req(flags, payload):
+    if flags & FRAME_BYTES:
+        return bytes(payload)
+    if flags & FRAME_STR:
+        return str(payload, "utf-8")
+    if flags & FRAME_OOB:
+        return loads_oob(payload)
+    return pickle.loads(payload)
+
+def decompress(codec, data):
+    if codec == CODEC_ZLIB:
+        return zlib.decompress(data)
+    if codec == CODEC_LZMA:
+        return lzma.decompress(data)
+    raise ValueError(f"unknown codec {codec}")
+
+# buffers of a message, the frame header then the payload, which is left out if empty and is
+# more than one buffer with FRAME_OOB, the transports send them without joining them
+def encode(message):
+    if not fits_header(message):
+        payload = pickle.dumps(message, protocol=pickle.HIGHEST_PROTOCOL)
+        return [FRAME_HEADER.pack(0, FRAME_OBJECT, 0, 0, len(payload)), payload]
+
+    flags = 0
+    req_id = message.req_id
+    if req_id is None:
+        flags |= FRAME_NO_REQ_ID
+        req_id = 0
+    index = message.index
+    if index is None:
+        flags |= FRAME_NO_INDEX
+        index = 0
+    req = message.req
+    if req is None:
+        flags |= FRAME_NO_REQ
+        payload = b""
+    elif type(req) is bytes:
+        flags |= FRAME_BYTES
+        payload = req
+    elif type(req) is str:
+        flags |= FRAME_STR
+        payload = req.encode()
+    elif type(req) is Encoded:
+        flags |= req.flags
+        buffers = req.buffers
+        if req.codec != CODEC_NONE:
+            flags |= FRAME_COMPRESSED
+            buffers = [COMPRESSED.pack(req.codec), *buffers]
+        return [FRAME_HEADER.pack(message.type_id, flags, index, req_id, sum(map(len, buffers))), *buffers]
+    else:
+        wrapped = wrap_blobs(req)
+        if wrapped is not None:
+            flags |= FRAME_OOB
+            buffers = dumps_oob(*wrapped)
+            return [FRAME_HEADER.pack(message.type_id, flags, index, req_id, sum(map(len, buffers))), *buffers]
+        payload = pickle.dumps(req, protocol=pickle.HIGHEST_PROTOCOL)
+    header = FRAME_HEADER.pack(message.type_id, flags, index, req_id, len(payload))
+    return [header, payload] if payload else [header]
+
+# message of a frame, any bytes-like object that starts with the frame header,
+# the req of a MESSAGE_DATA is an Encoded, see load_req; owned if the frame is not reused or closed
+# after decode, e.g. the buffer of one message, bytes are always owned
+def decode(frame, owned=False):
+    type_id, flags, index, req_id, length = FRAME_HEADER.unpack_from(frame, 0)
+    if flags & FRAME_NO_REQ:
+        req = None
+    else:
+        with memoryview(frame)[FRAME_HEADER.size: FRAME_HEADER.size + length] as payload:
+            if flags & FRAME_OBJECT:
+                return pickle.loads(payload)
+            if type_id == MESSAGE_DATA:
+                req = keep_req(flags, payload, owned or type(frame) is bytes)
+            elif flags & FRAME_COMPRESSED:
+                with payload[COMPRESSED.size:] as compressed:
+                    data = decompress(payload[0], compressed)
+                req = loads_req(flags, memoryview(data))
+            else:
+                req = loads_req(flags, payload)
+    return Message(type_id=type_id, req_id=None if flags & FRAME_NO_REQ_ID else req_id, req=req,
+        index=None if flags & FRAME_NO_INDEX else index)
@@ -0,0 +1,635 @@
+import os
+import errno
+import socket
+import select
+import time
+import struct
+import mmap
+import fcntl
+from array import array
+from collections import deque
+from itertools import islice, takewhile
+
+from message_types import encode, decode
+
+# length prefix of every frame
+HEADER = struct.Struct("!I")
+# set in the length prefix if the body is in fds passed with SCM_RIGHTS, the body is then the number of fds
+FD_FLAG = 1 << 31
+# max number of fds in one SCM_RIGHTS message
+SCM_MAX_FD = 253
+# zero-copy send, Linux 4.14+
+SO_ZEROCOPY = getattr(socket, "SO_ZEROCOPY", 60)
+MSG_ZEROCOPY = getattr(socket, "MSG_ZEROCOPY", 0x4000000)
+# completion notification in the error queue, struct sock_extended_err
+SOCK_EE = struct.Struct("=IBBBBII")
+SO_EE_ORIGIN_ZEROCOPY = 5
+SO_EE_CODE_ZEROCOPY_COPIED = 1
+
+# max number of buffers in one sendmsg
+try:
+    IOV_MAX = os.sysconf("SC_IOV_MAX")
+except (ValueError, OSError) as err:
+    IOV_MAX = 1024
+
+class Framer:
+    """
+    Receive buffer of one connection.
+    Bytes are read with recv_into at the tail of a bytearray and complete frames are
+    handed out as memoryview slices, so a frame body is never copied before decoding.
+    A frame bigger than size leaves with the bytearray it was read into, so the req of
+    a MESSAGE_DATA keeps views of it instead of copies.
+    """
+    def __init__(self, size=65536):
+        self.size = size
+        self.buf = bytearray(size)
+        # unread bytes are self.buf[self.start:self.end]
+        self.start = 0
+        self.end = 0
+        # fds received with SCM_RIGHTS and not yet claimed by a frame
+        self.fds = deque()
+
+    def reserve(self, n):
+        # make sure at least n bytes are free after self.end
+        if len(self.buf) - self.end >= n:
+            return
+
+        pending = self.end - self.start
+        if pending <= self.start and len(self.buf) - pending >= n:
+            # move the unread tail to the front (the two regions do not overlap)
+            self.buf[:pending] = memoryview(self.buf)[self.start:self.end]
+        else:
+            buf = bytearray(max(len(self.buf) * 2, pending + n))
+            buf[:pending] = memoryview(self.buf)[self.start:self.end]
+            self.buf = buf
+        self.start = 0
+        self.end = pending
+
+    def fill(self, select_socket, flags=0):
+        pending = self.end - self.start
+        stop = None
+        if pending >= HEADER.size:
+            # read the whole body of a big frame at once
+            frame_len = HEADER.size + (HEADER.unpack_from(self.buf, self.start)[0] & ~FD_FLAG)
+            need = frame_len - pending
+            self.reserve(max(need, 4096))
+            # but not past it, the buffer leaves with the frame
+            if frame_len > self.size and need > 0:
+                stop = self.end + need
+        else:
+            self.reserve(4096)
+
+        with memoryview(self.buf)[:stop] as view:
+            if select_socket.family == socket.AF_UNIX:
+                recv_len, ancdata, msg_flags, address = select_socket.recvmsg_into(
+                    [view[self.end:]], socket.CMSG_SPACE(SCM_MAX_FD * 4), flags)
+                for level, ctype, cdata in ancdata:
+                    if level == socket.SOL_SOCKET and ctype == socket.SCM_RIGHTS:
+                        fds = array("i")
+                        fds.frombytes(cdata[:len(cdata) - len(cdata) % fds.itemsize])
+                        self.fds.extend(fds)
+            else:
+                recv_len = select_socket.recv_into(view[self.end:], 0, flags)
+        self.end += recv_len
+        return recv_len
+
+    # (body, fds, owned) of the next complete frame, (None, None, False) if there is none,
+    # owned if the body is not reused by the framer
+    def next_frame(self):
+        pending = self.end - self.start
+        if pending < HEADER.size:
+            return None, None, False
+        len_data = HEADER.unpack_from(self.buf, self.start)[0]
+        fds = None
+        if len_data & FD_FLAG:
+            len_data &= ~FD_FLAG
+            # the fds may come with a later recvmsg than the frame
+            if pending < HEADER.size + len_data or len(self.fds) < self.buf[self.start + HEADER.size]:
+                return None, None, False
+            fds = [self.fds.popleft() for i in range(self.buf[self.start + HEADER.size])]
+        if pending < HEADER.size + len_data:
+            return None, None, False
+
+        frame_start = self.start + HEADER.size
+        self.start = frame_start + len_data
+        frame = memoryview(self.buf)[frame_start: frame_start + len_data]
+        owned = HEADER.size + len_data > self.size
+        if owned:
+            # the unread tail goes to a new buffer
+            tail = self.end - self.start
+            buf = bytearray(max(self.size, tail))
+            buf[:tail] = memoryview(self.buf)[self.start: self.end]
+            self.buf = buf
+            self.start = 0
+            self.end = tail
+        elif self.start == self.end:
+            self.start = 0
+            self.end = 0
+        return frame, fds, owned
+
+    def shrink(self):
+        # give back the memory of a big frame once it has been consumed
+        if self.start == self.end and len(self.buf) > self.size:
+            self.buf = bytearray(self.size)
+            self.start = 0
+            self.end = 0
+
+    def close(self):
+        while self.fds:
+            os.close(self.fds.popleft())
+
+# write the buffers of a frame into a sealed memfd, the receiver maps it read-only
+def to_memfd(*buffers):
+    fd = os.memfd_create("dtc", os.MFD_CLOEXEC | os.MFD_ALLOW_SEALING)
+    for data_b in buffers:
+        with memoryview(data_b) as view:
+            offset = 0
+            while offset < len(view):
+                offset += os.write(fd, view[offset:])
+    fcntl.fcntl(fd, fcntl.F_ADD_SEALS, fcntl.F_SEAL_SHRINK | fcntl.F_SEAL_GROW | fcntl.F_SEAL_WRITE | fcntl.F_SEAL_SEAL)
+    return fd
+
+class DTC:
+    def __init__(self, ip, port, nc=100):
+        # Unix domain socket if port is None, ip is then the socket path
+        if port is None:
+            self.IDENTITY = ip
+            self.addr = ip
+            self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        else:
+            self.IDENTITY = f"{ip}:{port}"
+            self.addr = (ip, port)
+            self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+
+        # fd -> Framer
+        self.recv_bk = {}
+
+    def send(self, data_obj, select_socket=None):
+        buffers = encode(data_obj)
+
+        send_b = b"".join([HEADER.pack(sum(map(len, buffers))), *buffers])
+
+        if select_socket:
+            select_socket.sendall(send_b)
+        else:
+            self.socket.sendall(send_b)
+
+    def get_framer(self, fd):
+        framer = self.recv_bk.get(fd, None)
+        if framer is None:
+            framer = Framer()
+            self.recv_bk[fd] = framer
+        return framer
+
+    def loads(self, frame, fds, owned=False):
+        with frame:
+            if not fds:
+                return decode(frame, owned)
+        # the body was passed in a memfd, it is unmapped once the message and its req are released
+        try:
+            return decode(mmap.mmap(fds[0], 0, prot=mmap.PROT_READ), owned=True)
+        finally:
+            for fd in fds:
+                os.close(fd)
+
+    # decode all complete frames in the buffer
+    def decode_frames(self, framer):
+        recv_data_list = []
+        while True:
+            frame, fds, owned = framer.next_frame()
+            if frame is None:
+                break
+            recv_data_list.append(self.loads(frame, fds, owned))
+        return recv_data_list
+
+    # blocking recv of one message, '' if a non-blocking socket has no complete message
+    def recv(self, select_socket=None):
+        if not select_socket:
+            select_socket = self.socket
+
+        framer = self.get_framer(select_socket.fileno())
+
+        while True:
+            frame, fds, owned = framer.next_frame()
+            if frame is not None:
+                return self.loads(frame, fds, owned)
+            try:
+                if not framer.fill(select_socket):
+                    return None
+            except BlockingIOError as err:
+                return ''
+
+    # drain the socket and decode every complete message, None at the end if closed
+    def recv_all(self, select_socket=None):
+        if not select_socket:
+            select_socket = self.socket
+
+        framer = self.get_framer(select_socket.fileno())
+
+        recv_data_list = []
+        while True:
+            try:
+                recv_len = framer.fill(select_socket, socket.MSG_DONTWAIT)
+            except BlockingIOError as err:
+                break
+            except ConnectionError as err:
+                recv_len = 0
+
+            if not recv_len:
+                recv_data_list.extend(self.decode_frames(framer))
+                recv_data_list.append(None)
+                return recv_data_list
+
+            recv_data_list.extend(self.decode_frames(framer))
+
+        framer.shrink()
+
+        return recv_data_list
+
+
+class Client(DTC):
+    def __init__(self, ip, port, nc=100):
+        super(Client, self).__init__(ip, port)
+        while True:
+            return_code = self.socket.connect_ex(self.addr)
+            if return_code == 0:
+                break
+            time.sleep(0.01)
+
+    def clean(self):
+        self.socket.close()
+
+class Server(DTC):
+    def __init__(self, ip, port, nc=100, hwm=4 * 1024 * 1024, fd_threshold=None, zerocopy_threshold=None):
+        super(Server, self).__init__(ip, port)
+        if port is None:
+            # socket file left by an earlier instance
+            if os.path.exists(ip):
+                os.unlink(ip)
+        else:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind(self.addr)
+        self.socket.listen(nc)
+
+        self.client_socket = []
+
+        self.poller = select.epoll()
+        self.map = {}
+        self.server_fd = self.socket.fileno()
+        self.poller.register(self.server_fd, select.EPOLLIN)
+        self.map[self.server_fd] = self.socket
+        self.pam = {self.IDENTITY: self.server_fd}
+        self.address = {}
+
+        self.to_del = []
+
+        # fd -> deque of bytes not yet accepted by the kernel
+        self.send_bk = {}
+        # fd -> number of bytes in self.send_bk[fd]
+        self.send_len = {}
+        # fd -> deque of fds to pass with the next sendmsg, Unix domain sockets only
+        self.send_fds = {}
+        # fd -> number of frames with fds queued since its queue was last empty, a sendmsg carries the fds
+        # of SCM_MAX_FD frames, so None in the queue ends a sendmsg before the frames of the next ones
+        self.n_fd_frames = {}
+        # bodies of at least fd_threshold bytes are passed in a memfd on Unix domain sockets, off if None
+        # opt-in, transport_bench shows plain UDS sends faster than the memfd handoff up to 64 MB
+        self.fd_threshold = fd_threshold
+        # fds with more than hwm bytes queued, cleared below hwm / 2
+        self.hwm = hwm
+        self.congested = set()
+        # fds with frames queued since the last flush
+        self.dirty = set()
+        # fds registered for EPOLLOUT
+        self.blocked = set()
+        # fd -> [time it blocked, bytes written since], until its queue is empty
+        self.drain = {}
+        # fd -> (bytes/s it drained at the last times it was blocked, time of the last one), see get_link_rate
+        self.link_rate = {}
+
+        # opt-in MSG_ZEROCOPY for sendmsgs of at least zerocopy_threshold bytes on TCP
+        self.zerocopy_threshold = zerocopy_threshold
+        # fds with SO_ZEROCOPY set
+        self.zerocopy = set()
+        # fd -> deque of (seq, buffers) the kernel may still read from
+        self.zc_pending = {}
+        # fd -> seq of the next zero-copy sendmsg
+        self.zc_seq = {}
+
+        # write-combining counters, see get_send_stats
+        self.n_frames = 0
+        self.n_flushes = 0
+        self.n_syscalls = 0
+        self.n_zerocopy = 0
+        self.n_zerocopy_copied = 0
+
+    def enable_zerocopy(self, select_socket):
+        if self.zerocopy_threshold is None or select_socket.family == socket.AF_UNIX:
+            return
+        try:
+            select_socket.setsockopt(socket.SOL_SOCKET, SO_ZEROCOPY, 1)
+        except OSError as err:
+            # kernel without SO_ZEROCOPY, keep copying
+            return
+        fd = select_socket.fileno()
+        self.zerocopy.add(fd)
+        self.zc_pending[fd] = deque()
+        self.zc_seq[fd] = 0
+
+    def add_dtc(self, dtc):
+        dtc_fd = dtc.socket.fileno()
+        self.enable_zerocopy(dtc.socket)
+        self.poller.register(dtc_fd, select.EPOLLIN)
+        self.map[dtc_fd] = dtc.socket
+        self.pam[dtc.IDENTITY] = dtc_fd
+        self.address[dtc_fd] = dtc.IDENTITY
+        # keep bytes already buffered by blocking recvs of the dtc
+        if dtc_fd in dtc.recv_bk:
+            self.recv_bk[dtc_fd] = dtc.recv_bk.pop(dtc_fd)
+
+    def del_dtc(self, dtc_socket):
+        dtc_fd = dtc_socket.fileno()
+        IDENTITY = [k for k in self.pam if self.pam[k] == dtc_fd][0]
+        self.pam.pop(IDENTITY, None)
+        self.map.pop(dtc_fd, None)
+        self.address.pop(dtc_fd, None)
+        framer = self.recv_bk.pop(dtc_fd, None)
+        if framer:
+            framer.close()
+        for fd in self.send_fds.pop(dtc_fd, []):
+            os.close(fd)
+        self.n_fd_frames.pop(dtc_fd, None)
+        self.send_bk.pop(dtc_fd, None)
+        self.send_len.pop(dtc_fd, None)
+        self.congested.discard(dtc_fd)
+        self.dirty.discard(dtc_fd)
+        self.blocked.discard(dtc_fd)
+        self.drain.pop(dtc_fd, None)
+        self.link_rate.pop(dtc_fd, None)
+        self.zerocopy.discard(dtc_fd)
+        self.zc_pending.pop(dtc_fd, None)
+        self.zc_seq.pop(dtc_fd, None)
+        # del self.pam[IDENTITY]
+        # del self.map[dtc_fd]
+        # del self.address[dtc_fd]
+        if dtc_socket in self.client_socket:
+            self.client_socket.remove(dtc_socket)
+        self.poller.unregister(dtc_fd)
+        dtc_socket.close()
+
+    # queue the message for select_socket, it is written by the next flush
+    def send(self, data_obj, select_socket=None):
+        if not select_socket:
+            return super(Server, self).send(data_obj)
+
+        buffers = encode(data_obj)
+        len_data = sum(map(len, buffers))
+
+        fd = select_socket.fileno()
+        if fd not in self.send_bk:
+            self.send_bk[fd] = deque()
+            self.send_len[fd] = 0
+        if select_socket.family == socket.AF_UNIX and self.fd_threshold is not None and len_data >= self.fd_threshold:
+            # pass the body in a memfd and send only the number of fds
+            n_fd_frames = self.n_fd_frames.get(fd, 0)
+            if n_fd_frames and n_fd_frames % SCM_MAX_FD == 0:
+                self.send_bk[fd].append(None)
+            self.n_fd_frames[fd] = n_fd_frames + 1
+            self.send_fds.setdefault(fd, deque()).append(to_memfd(*buffers))
+            buffers = [bytes([1])]
+            len_data = 1
+            header = HEADER.pack(len_data | FD_FLAG)
+        else:
+            header = HEADER.pack(len_data)
+
+        # header, frame header and the payload buffers, e.g. out-of-band bytes values, stay
+        # separate buffers of the sendmsg, encode leaves out empty ones as flush_fd expects
+        send_queue = self.send_bk[fd]
+        send_queue.append(header)
+        send_queue.extend(buffers)
+        self.send_len[fd] += HEADER.size + len_data
+        self.dirty.add(fd)
+        self.n_frames += 1
+
+        if self.send_len[fd] > self.hwm:
+            self.congested.add(fd)
+
+    # write the frames queued since the last flush, one sendmsg per peer if possible
+    def flush(self):
+        for fd in self.dirty:
+            # the rest is written when poll sees EPOLLOUT
+            if fd in self.blocked:
+                continue
+            if not self.flush_fd(fd):
+                # resume in poll when the socket is writable
+                self.poller.modify(fd, select.EPOLLIN | select.EPOLLOUT)
+                self.blocked.add(fd)
+                # the link is the bottleneck until the queue is empty
+                self.drain[fd] = [time.time(), 0]
+        self.dirty = set()
+
+    def flush_fd(self, fd):
+        if fd not in self.send_bk:
+            return True
+
+        select_socket = self.map[fd]
+        send_queue = self.send_bk[fd]
+        self.n_flushes += 1
+        send_fds = self.send_fds.get(fd, None)
+        try:
+            while send_queue:
+                if send_queue[0] is None:
+                    send_queue.popleft()
+                    continue
+                ancdata = []
+                if send_fds:
+                    # fds go no later than their frame, the receiver waits for them
+                    fds = array("i", islice(send_fds, SCM_MAX_FD))
+                    ancdata = [(socket.SOL_SOCKET, socket.SCM_RIGHTS, fds)]
+                buffers = list(takewhile(lambda buf: buf is not None, islice(send_queue, IOV_MAX)))
+                flags = socket.MSG_DONTWAIT
+                if fd in self.zerocopy and sum(map(len, buffers)) >= self.zerocopy_threshold:
+                    flags |= MSG_ZEROCOPY
+                try:
+                    sent_len = select_socket.sendmsg(buffers, ancdata, flags)
+                except OSError as err:
+                    # ENOBUFS if the pinned pages exceed optmem_max, copy instead
+                    if not flags & MSG_ZEROCOPY or err.errno != errno.ENOBUFS:
+                        raise
+                    flags = socket.MSG_DONTWAIT
+                    sent_len = select_socket.sendmsg(buffers, ancdata, flags)
+                self.n_syscalls += 1
+                if flags & MSG_ZEROCOPY:
+                    # the kernel reads the buffers until the completion of this seq
+                    self.zc_pending[fd].append((self.zc_seq[fd], buffers))
+                    self.zc_seq[fd] = (self.zc_seq[fd] + 1) & 0xffffffff
+                    self.n_zerocopy += 1
+                if ancdata:
+                    # the kernel holds its own references now
+                    for i in range(len(fds)):
+                        os.close(send_fds.popleft())
+                self.send_len[fd] -= sent_len
+                if fd in self.drain:
+                    self.drain[fd][1] += sent_len
+                # drop the buffers that are fully written
+                while sent_len:
+                    buf_len = len(send_queue[0])
+                    if sent_len < buf_len:
+                        send_queue[0] = memoryview(send_queue[0])[sent_len:]
+                        break
+                    send_queue.popleft()
+                    sent_len -= buf_len
+                if send_queue and sent_len:
+                    break
+        except BlockingIOError as err:
+            pass
+        except ConnectionError as err:
+            # peer is gone, the closed socket is reported by recv
+            send_queue.clear()
+            self.send_len[fd] = 0
+            self.drain.pop(fd, None)
+            while send_fds:
+                os.close(send_fds.popleft())
+
+        if self.send_len[fd] < self.hwm // 2:
+            self.congested.discard(fd)
+
+        if not send_queue:
+            self.send_bk.pop(fd, None)
+            self.send_len.pop(fd, None)
+            self.send_fds.pop(fd, None)
+            self.n_fd_frames.pop(fd, None)
+            drain = self.drain.pop(fd, None)
+            if drain:
+                self.update_link_rate(fd, *drain)
+            return True
+        return False
+
+    # while a queue is blocked the kernel takes its bytes as fast as the link sends them
+    def update_link_rate(self, fd, start, n_bytes):
+        now = time.time()
+        if now <= start or not n_bytes:
+            return
+        rate = n_bytes / (now - start)
+        if fd in self.link_rate:
+            rate = (self.link_rate[fd][0] + rate) / 2
+        self.link_rate[fd] = (rate, now)
+
+    # (bytes/s, time measured) of the link to fd, None if its queue never blocked, then the link kept up
+    def get_link_rate(self, fd):
+        return self.link_rate.get(fd, None)
+
+    # release the buffers of completed zero-copy sends
+    def reap_zerocopy(self, fd):
+        select_socket = self.map[fd]
+        pending = self.zc_pending[fd]
+        while True:
+            try:
+                msg, ancdata, msg_flags, address = select_socket.recvmsg(0, socket.CMSG_SPACE(SOCK_EE.size), socket.MSG_ERRQUEUE | socket.MSG_DONTWAIT)
+            except BlockingIOError as err:
+                break
+            for level, ctype, cdata in ancdata:
+                if len(cdata) < SOCK_EE.size:
+                    continue
+                ee_errno, ee_origin, ee_type, ee_code, ee_pad, ee_info, ee_data = SOCK_EE.unpack_from(cdata)
+                if ee_origin != SO_EE_ORIGIN_ZEROCOPY:
+                    continue
+                # sends ee_info to ee_data are done
+                if ee_code & SO_EE_CODE_ZEROCOPY_COPIED:
+                    self.n_zerocopy_copied += 1
+                while pending and (ee_data - pending[0][0]) & 0xffffffff < 0x80000000:
+                    pending.popleft()
+
+    # frames per flush and per syscall since the last call
+    def get_send_stats(self):
+        stats = {
+            "frames": self.n_frames,
+            "frames_per_flush": self.n_frames / self.n_flushes if self.n_flushes else 0,
+            "frames_per_syscall": self.n_frames / self.n_syscalls if self.n_syscalls else 0
+        }
+        if self.zerocopy:
+            # the kernel copied anyway, e.g. on loopback
+            stats["zerocopy"] = self.n_zerocopy
+            stats["zerocopy_copied"] = self.n_zerocopy_copied
+        self.n_frames = 0
+        self.n_flushes = 0
+        self.n_syscalls = 0
+        self.n_zerocopy = 0
+        self.n_zerocopy_copied = 0
+        return stats
+
+    # the outbound queue of fd is above the high-water mark
+    def is_congested(self, fd):
+        return fd in self.congested
+        
+
+    def poll(self):
+        if self.to_del:
+            for dtc_socket in self.to_del:
+                self.del_dtc(dtc_socket)
+            self.to_del = []
+        poll_results = []
+        events = dict(self.poller.poll(timeout=5))
+        for fd, event in events.items():
+            if fd == self.server_fd:
+                client_socket, client_address = self.socket.accept()
+                client_socket.setblocking(0)
+                self.client_socket.append(client_socket)
+
+                # peers of a Unix domain socket are unnamed
+                if self.socket.family == socket.AF_UNIX:
+                    client_address = (self.IDENTITY, client_socket.fileno())
+
+                self.enable_zerocopy(client_socket)
+                self.poller.register(client_socket.fileno(), select.EPOLLIN)
+                self.map[client_socket.fileno()] = client_socket
+                self.pam[f"{client_address[0]}:{client_address[1]}"] = client_socket.fileno()
+                self.address[client_socket.fileno()] = f"{client_address[0]}:{client_address[1]}"
+                continue
+
+            if event & select.EPOLLERR and fd in self.zerocopy:
+                self.reap_zerocopy(fd)
+            if event & select.EPOLLOUT:
+                if self.flush_fd(fd):
+                    self.poller.modify(fd, select.EPOLLIN)
+                    self.blocked.discard(fd)
+            if event & (select.EPOLLIN | select.EPOLLHUP | select.EPOLLERR):
+                poll_results.extend(self.poll_fd(fd))
+
+        return poll_results
+
+    # all messages received from fd in this wakeup
+    def poll_fd(self, fd):
+        poll_dtc = self.map[fd]
+        recv_data_list = self.recv_all(poll_dtc)
+
+        if recv_data_list and recv_data_list[-1] is None:
+            self.to_del.append(poll_dtc)
+
+        return [(poll_dtc, recv_data) for recv_data in recv_data_list]
+
+    def clean(self):
+        # write what is still queued
+        for fd in list(self.send_bk):
+            try:
+                while not self.flush_fd(fd):
+                    # give up on a peer that stops reading
+                    if not select.select([], [self.map[fd]], [], 5)[1]:
+                        break
+            except Exception as e:
+                pass
+        self.send_bk = {}
+        self.send_len = {}
+
+        try:
+            for client_socket in self.client_socket:
+                if client_socket.fileno() < 0:
+                    continue
+                self.poller.unregister(client_socket.fileno())
+                client_socket.close()
+            self.poller.unregister(self.server_fd)
+            self.socket.close()
+            if self.socket.family == socket.AF_UNIX:
+                os.unlink(self.addr)
+        except Exception as e:
+            pass
\ No newline at end of file
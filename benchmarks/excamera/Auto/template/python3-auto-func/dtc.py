@@ -0,0 +1,1812 @@
+import os
+import errno
+import socket
+import select
+import time
+import struct
+import mmap
+import fcntl
+from array import array
+from collections import deque
+from itertools import islice, takewhile
+import math
+import ctypes
+import bisect
+import logging
+import weakref
+
+from message_types import Message, MESSAGE_DATA, MESSAGE_READY, MESSAGE_ROUTE_ERR, MESSAGE_DEL, encode, decode
+
+# the socket part works without pyverbs, e.g. on nodes without an RNIC
+try:
+    from pyverbs.addr import AH, AHAttr, GlobalRoute, GID
+    from pyverbs.cq import CQ, CompChannel
+    from pyverbs.device import Context
+    from pyverbs.enums import *
+    from pyverbs.mr import MR
+    from pyverbs.pd import PD
+    from pyverbs.qp import QP, QPCap, QPInitAttr, QPAttr
+    from pyverbs.srq import SRQ, SrqAttr, SrqInitAttr
+    from pyverbs.wr import SGE, RecvWR, SendWR
+    HAS_PYVERBS = True
+except ImportError as err:
+    HAS_PYVERBS = False
+
+# ib_dev of the software stand-in of pyverbs in softverbs.py, for hosts without an RNIC
+SOFT_DEV = "soft"
+
+# use the software stand-in instead of pyverbs, for all RDMA instances of the process
+def use_softverbs():
+    import softverbs
+    globals().update({name: getattr(softverbs, name) for name in softverbs.__all__})
+
+# wr_id of a send is the wr_id of its mr | offset of its pool block << WR_SLOT_SHIFT
+# wr_id of a recv is SRQ_WR_ID | number of its recv buffer << WR_SLOT_SHIFT | its slot class << CLASS_SHIFT
+WR_SLOT_SHIFT = 32
+WR_ID_MASK = (1 << WR_SLOT_SHIFT) - 1
+SRQ_WR_ID = WR_ID_MASK
+CLASS_SHIFT = 56
+BUFFER_MASK = (1 << (CLASS_SHIFT - WR_SLOT_SHIFT)) - 1
+# imm_data of a send: credits returned to the peer << IMM_CREDIT_SHIFT | flags
+IMM_CREDIT_SHIFT = 16
+IMM_CREDIT_MASK = 0x7fff
+# the chunk is (addr, rkey, len, handle) of a big message to read
+IMM_RNDV = 1
+# the oldest rendezvous read of the peer is done
+IMM_FIN = 2
+RNDV_FORMAT = "!QIII"
+# control message, sent on the ud qp:
+# type << CTRL_TYPE_SHIFT | IMM_OWN_HANDLE | index << CTRL_INDEX_SHIFT | handle
+CTRL_TYPES = [MESSAGE_READY, MESSAGE_ROUTE_ERR, MESSAGE_DEL]
+CTRL_TYPE_SHIFT = 29
+# the handle was given by the receiver of the control message, otherwise by its sender
+IMM_OWN_HANDLE = 1 << 28
+CTRL_INDEX_SHIFT = 22
+# index None
+CTRL_NO_INDEX = 0x3f
+# handles of req_ids of data messages, given per peer by the sender of the data
+HANDLES = 1 << 16
+NO_HANDLE = 0xffffffff
+# first chunk: total_len, chunk_len, handle, other chunks: chunk_len
+FIRST_HEADER = struct.Struct("!III")
+CHUNK_HEADER = struct.Struct("!I")
+RNDV_HEADER = struct.Struct(RNDV_FORMAT)
+# send wrs of a qp in addition to the data sends, for empty sends that only return credits
+CREDIT_WRS = 8
+# rdma reads in flight of a qp, each is followed by a fin
+RNDV_READS = 4
+# registered buffers of the same capacity kept for reuse
+RNDV_CACHE = 4
+# messages bigger than this many recv slots of the peer use rendezvous, unless rndv_threshold is set
+RNDV_SLOTS = 4
+# recv slots come in classes of size, size / SLOT_FACTOR, ... bytes, down to MIN_SLOT,
+# each class has its own srq and the qp of an edge uses the class negotiated in the handshake
+SLOT_FACTOR = 4
+MIN_SLOT = 256
+# the class of an edge is the smallest one that fits SLOT_COVERAGE of its messages in one slot
+SLOT_COVERAGE = 0.9
+# messages of an edge before its history is used, counts are halved at HISTORY_MAX
+HISTORY_MIN = 16
+HISTORY_MAX = 1024
+# smallest block of the pool
+MIN_BLOCK = 64
+# recv buffers of a slot class reserved per qp in addition to its credits,
+# for the empty sends that return credits or end a rendezvous and take no credit
+SRQ_HEADROOM = CREDIT_WRS + RNDV_READS
+# recv buffers of a slot class, unless srq_max_wr is set: srq_depth buffers of the biggest size in bytes,
+# at least SRQ_MIN_WR and at most SRQ_MAX_WR, they grow up to that as qps attach
+SRQ_MIN_WR = 1024
+SRQ_MAX_WR = 16384
+# retry until the srq has a recv buffer instead of failing the qp,
+# only while a consumed recv buffer waits for its repost, the srq holds the credits and headroom of all qps
+RNR_RETRY_INFINITE = 7
+# 0.01 ms between retries
+MIN_RNR_TIMER = 1
+
+# ud qp of control messages of all peers,
+# wr_id of its sends is UD_WR_ID, of its recvs UD_WR_ID | offset of the recv buffer << WR_SLOT_SHIFT
+UD_WR_ID = WR_ID_MASK - 1
+# key of the ud send chain
+UD_IDENTITY = "ud"
+UD_QKEY = 0x11111111
+# kind, rc qp_num of the receiver for the connection, seq, control message,
+# ud qp_nums are only unique per device so the receiver finds the peer by its own qp_num
+UD_HEADER = struct.Struct("!BIII")
+UD_CTRL = 0
+UD_ACK = 1
+# a ud recv starts with the global routing header
+GRH_SIZE = 40
+UD_BUF = 64
+UD_RECVS = 64
+UD_SENDS = 256
+# a control message is sent again after UD_TIMEOUT seconds, doubled for each retry up to UD_MAX_TIMEOUT,
+# and sent on the rc qp after UD_RETRIES sends
+UD_TIMEOUT = 0.002
+UD_MAX_TIMEOUT = 0.1
+UD_RETRIES = 20
+# seqs of a peer remembered to drop duplicates
+UD_WINDOW = 1024
+
+# memoryview over the first length bytes of a registered buffer, without copy
+def mr_view(mr, length):
+    return memoryview((ctypes.c_char * length).from_address(mr.buf)).cast("B")
+
+class Slots:
+    """
+    Recv buffers of one slot class in registered MRs and one srq.
+
+    The qps of all edges negotiated to this slot size share them. The buffers grow in new MRs,
+    up to max_wr, to cover the credits and SRQ_HEADROOM buffers of each qp that attaches.
+    """
+    def __init__(self, pd, index, slot, depth, sg_depth, max_wr):
+        self.pd = pd
+        self.index = index
+        self.slot = slot
+        self.max_wr = max_wr
+        self.srq = SRQ(pd, SrqInitAttr(SrqAttr(max_wr=max_wr, max_sge=sg_depth)))
+        # (number of the first recv buffer, mr, view) of each registered block, ascending
+        self.blocks = []
+        self.starts = []
+        # number of recv buffers
+        self.depth = 0
+        # recv mrs of the qps attached to the class, handshakes in progress included
+        self.recv_mrs = []
+        # credits of each of them
+        self.share = 0
+        # wrs not posted yet, linked by next_wr
+        self.chain = []
+        self.grow(depth)
+        self.srq.post_recv(self.chain[0])
+        self.chain = []
+
+    # register recv buffers up to depth and give them to the srq, posted by flush
+    def grow(self, depth):
+        n = depth - self.depth
+        if n <= 0:
+            return
+        mr = MR(self.pd, n * self.slot, IBV_ACCESS_LOCAL_WRITE)
+        self.blocks.append((self.depth, mr, mr_view(mr, n * self.slot)))
+        self.starts.append(self.depth)
+        for i in range(self.depth, depth):
+            self.post(i * self.slot)
+        self.depth = depth
+
+    # (mr, view, offset in the view) of the recv buffer at offset of the class
+    def locate(self, offset):
+        start, mr, view = self.blocks[bisect.bisect_right(self.starts, offset // self.slot) - 1]
+        return mr, view, offset - start * self.slot
+
+    # give the recv buffer at offset back to the srq, posted by flush
+    def post(self, offset):
+        mr, view, at = self.locate(offset)
+        sgl = [SGE(mr.buf + at, self.slot, mr.lkey)]
+        wr = RecvWR(SRQ_WR_ID | (offset // self.slot) << WR_SLOT_SHIFT | self.index << CLASS_SHIFT, len(sgl), sgl)
+        if self.chain:
+            self.chain[-1].next_wr = wr
+        self.chain.append(wr)
+
+    # offset of the recv buffer of a completion
+    def offset(self, wr_id):
+        return ((wr_id >> WR_SLOT_SHIFT) & BUFFER_MASK) * self.slot
+
+class Pool:
+    """
+    One registered MR for the sends of all qps of an instance,
+    cut into blocks of MIN_BLOCK << order bytes by a buddy allocator.
+    """
+    def __init__(self, pd, send_size):
+        # offset 0 means no block, the first MIN_BLOCK bytes are never allocated
+        self.base = MIN_BLOCK
+        self.mr = MR(pd, self.base + send_size, IBV_ACCESS_LOCAL_WRITE | IBV_ACCESS_REMOTE_WRITE | IBV_ACCESS_REMOTE_READ)
+        self.view = mr_view(self.mr, self.base + send_size)
+
+        self.max_order = max(0, (send_size // MIN_BLOCK).bit_length() - 1)
+        # order -> offsets of free blocks, relative to base
+        self.free = [set() for order in range(self.max_order + 1)]
+        # offset -> order of allocated blocks
+        self.orders = {}
+
+        offset = 0
+        for order in range(self.max_order, -1, -1):
+            while offset + (MIN_BLOCK << order) <= send_size:
+                self.free[order].add(offset)
+                offset += MIN_BLOCK << order
+
+    # offset of a block of at least n bytes, None if there is no free block
+    def alloc(self, n):
+        order = (math.ceil(max(n, 1) / MIN_BLOCK) - 1).bit_length()
+        for free_order in range(order, self.max_order + 1):
+            if self.free[free_order]:
+                break
+        else:
+            return None
+
+        offset = self.free[free_order].pop()
+        # split, upper halves stay free
+        while free_order > order:
+            free_order -= 1
+            self.free[free_order].add(offset + (MIN_BLOCK << free_order))
+        self.orders[offset] = order
+        return self.base + offset
+
+    def release(self, offset):
+        offset -= self.base
+        order = self.orders.pop(offset)
+        # merge with the buddy while it is free
+        while order < self.max_order:
+            buddy = offset ^ (MIN_BLOCK << order)
+            if buddy not in self.free[order]:
+                break
+            self.free[order].remove(buddy)
+            offset = min(offset, buddy)
+            order += 1
+        self.free[order].add(offset)
+
+# chunks of first_cap, then of other_cap bytes of the buffers of a message,
+# a buffer that fits a chunk is used as is and a chunk is joined only if it spans buffers
+def cut_chunks(buffers, first_cap, other_cap):
+    chunks = []
+    pieces = []
+    room = first_cap
+    for data_b in buffers:
+        start = 0
+        while start < len(data_b):
+            taken = min(room, len(data_b) - start)
+            pieces.append(data_b if taken == len(data_b) else data_b[start: start + taken])
+            start += taken
+            room -= taken
+            if room == 0:
+                chunks.append(pieces[0] if len(pieces) == 1 else b"".join(pieces))
+                pieces = []
+                room = other_cap
+    if pieces:
+        chunks.append(pieces[0] if len(pieces) == 1 else b"".join(pieces))
+    return chunks
+
+class RDMA:
+    def __init__(self, func_name, args):
+        self.func_name = func_name
+
+        # before the defaults, they use the enums of pyverbs
+        if args.get('ib_dev', None) == SOFT_DEV:
+            use_softverbs()
+
+        self.args = {
+            'ib_dev': 'mlx5_1', 'sg_depth': 1, 'inline_size': 256, 'mtu': 2, 'rx_depth': 2500, 
+            'size': 1024, 'sl': 0, 'operation_type': IBV_WR_SEND_WITH_IMM , 'tx_depth': 2500, 
+            'qp_type': IBV_QPT_RC, 'gid_index': 3, 'poll_batch': 16, 'busy_poll_us': 0,
+            'max_rd_atomic': RNDV_READS, 'qp_pool': 4
+        }
+        self.args.update(args)
+
+        # credits of each peer, i.e., chunks in flight to it, fewer if the recv buffers of its slot class are shared
+        self.N = 50
+        if self.args.get("num_sgl", None):
+            self.N = self.args["num_sgl"]
+        # initial number of recv buffers of each slot class, shared by the qps of the class,
+        # they grow by the credits and headroom of each qp that attaches
+        self.NR = self.N
+        if self.args.get("srq_depth", None):
+            self.NR = self.args["srq_depth"]
+        # number of sends in flight of each qp
+        self.NS = self.N
+        if self.args.get("num_send_sgl", None):
+            self.NS = self.args["num_send_sgl"]
+        self.NS = min(self.NS, self.args['tx_depth'] - CREDIT_WRS - 2 * RNDV_READS)
+        # send wrs of a qp: data, credits, rdma reads and fins
+        self.qp_wrs = self.NS + CREDIT_WRS + 2 * RNDV_READS
+        # bytes of the pool for sends, shared by all qps
+        self.send_pool_size = self.NS * self.args['size']
+        if self.args.get("send_pool_size", None):
+            self.send_pool_size = self.args["send_pool_size"]
+        # bigger messages are read by the receiver from a registered buffer of the sender
+        # instead of being sent in chunks, RNDV_SLOTS recv slots of the peer if not set
+        self.rndv_threshold = self.args.get("rndv_threshold", None)
+        # capacity -> registered buffers for rendezvous
+        self.rndv_free = {}
+
+        # busy poll the cq without events until busy_poll_us after the last completion
+        self.busy_poll = self.args['busy_poll_us'] / 1000000
+        self.busy = False
+        self.busy_until = 0
+
+        self.empty = " " * self.args["size"]
+
+        # recv slot sizes, ascending, the biggest one is size
+        self.slot_sizes = [self.args['size']]
+        while self.slot_sizes[0] // SLOT_FACTOR >= MIN_SLOT:
+            self.slot_sizes.insert(0, self.slot_sizes[0] // SLOT_FACTOR)
+        # class -> Slots, created on first use
+        self.slots = {}
+        # class of the qps created ahead when idle, the one of the last handshake
+        self.refill_class = None
+        # (func_name of the peer, "send" or "recv") -> number of messages per slot class
+        self.history = {}
+        # func_name of the peer -> usual message size in bytes, from workflow.json
+        self.hints = self.args.get("slots", {})
+        # IDENTITY -> func_name of the peer
+        self.edges = {}
+        # k: IDENTITY, v: qp
+        self.qps = {}
+        self.nqp = 0
+        # qp_num -> IDENTITY, recv completions of the srq are matched by qp_num
+        self.qpns = {}
+        # recv - k: IDENTITY + '-1', v: {"grant": consumed chunks not yet returned as credits,
+        #   "class": slot class, "credits": credits given to the peer, "threshold": grant returned without data,
+        #   "debt": consumed chunks not returned as credits, since the credits of the peer were cut,
+        #   "reads": received messages in order, rendezvous ones wait for their read, "nreads": reads posted,
+        #   "handles": req_id -> handle given by the peer, "req_ids": handle -> req_id}
+        # send - k: IDENTITY + '-0', v: {"slot": recv slot size of the peer, "rndv_threshold": int,
+        #   "queue": chunks waiting for credit or pool block,
+        #   "inflight": pool blocks of posted sends, 0 if none, "credits": chunks the peer can still take,
+        #   "rndv": buffers of rendezvous messages until the peer reads them,
+        #   "handles": req_id -> handle given to the peer until it is ready with the req_id, "req_ids": handle -> req_id,
+        #   "next_handle": int}
+        self.mrs = {}
+        # wr_id & WR_ID_MASK -> mr_id, the pool offset is in the high bits of wr_id
+        self.map = {}
+        # mr_id -> wr_id
+        self.pam = {}
+        # send mr_ids waiting for a free pool block
+        self.blocked = set()
+        # wrs not posted yet, the wrs of a chain are linked by next_wr
+        # IDENTITY -> send wrs
+        self.send_chains = {}
+        self.inline_bufs = []
+        self.ud_recv_chain = []
+
+        # IDENTITY -> {"ah", "qpn": ud qp_num of the peer, "dest": rc qp_num of the peer,
+        #   "seq": seq of the next control message,
+        #   "seen": recent seqs from the peer, "seen_order": the same in order of arrival}
+        self.ud_peers = {}
+        # (IDENTITY, seq) -> {"ctrl", "deadline", "timeout", "tries"}, control messages not acked yet
+        self.unacked = {}
+        # ud sends not completed yet
+        self.ud_inflight = 0
+
+        # nqp -> (qp, recv mr of the connection)
+        self.handshake_info = {}
+        # class -> qps in INIT state created ahead of handshakes
+        self.free_qps = {}
+
+        # mr_id -> {"buf": bytearray of the whole message, "filled": int, "handle": int}
+        # store chunks of big data, sends of a qp arrive in order
+        self.bk = {}
+
+        self.rdma_init()
+
+    def rdma_init(self):
+        ctx = Context(name=self.args['ib_dev'])
+        # counters of the device in ctx.stats with softverbs
+        self.ctx = ctx
+        self.pd = PD(ctx)
+        self.comp_ch = CompChannel(ctx)
+        self.cqe = max(self.args['tx_depth'] + self.args['rx_depth'], self.NR + self.qp_wrs) + UD_RECVS + UD_SENDS
+        self.cq = CQ(ctx, self.cqe, None, self.comp_ch)
+        self.cq.req_notify()
+
+        # blocks of sends of all qps, recv buffers are created with their slot class
+        self.pool = Pool(self.pd, self.send_pool_size)
+
+        # control messages of all peers
+        ud_cap = QPCap(max_send_wr=UD_SENDS, max_recv_wr=UD_RECVS, max_send_sge=1, max_recv_sge=1,
+            max_inline_data=UD_HEADER.size)
+        self.ud_qp = QP(self.pd, QPInitAttr(qp_type=IBV_QPT_UD, scq=self.cq, rcq=self.cq, cap=ud_cap, sq_sig_all=True))
+        qa = QPAttr(port_num=1)
+        qa.qkey = UD_QKEY
+        self.ud_qp.to_rts(qa)
+        self.ud_mr = MR(self.pd, UD_RECVS * UD_BUF, IBV_ACCESS_LOCAL_WRITE)
+        self.ud_view = mr_view(self.ud_mr, UD_RECVS * UD_BUF)
+        for i in range(UD_RECVS):
+            self.post_ud_recv(i * UD_BUF)
+        self.flush()
+
+        self.qp_cap = QPCap(max_send_wr=self.args['tx_depth'], max_recv_wr=self.args['rx_depth'], max_send_sge=self.args['sg_depth'],
+            max_recv_sge=self.args['sg_depth'], max_inline_data=self.args['inline_size'])
+
+        self.gid = ctx.query_gid(port_num=1, index=self.args['gid_index'])
+
+    # recv message, the chunk is in the recv buffer at offset of slots,
+    # it is decoded from a view of the buffers and the buffer is reposted after the view is released
+    def mr_read(self, mr_id, slots, offset):
+        mr, view, at = slots.locate(offset)
+
+        recv_obj = None
+
+        if mr_id in self.bk:
+            # copy into the buffer of the whole message
+            chunk_len, = CHUNK_HEADER.unpack_from(view, at)
+            bk = self.bk[mr_id]
+            start = at + CHUNK_HEADER.size
+            bk["buf"][bk["filled"]: bk["filled"] + chunk_len] = view[start: start + chunk_len]
+            bk["filled"] += chunk_len
+
+            if bk["filled"] == len(bk["buf"]):
+                self.bk.pop(mr_id, None)
+                # the buffer is this message's own, the req keeps views of it
+                recv_obj = decode(bk["buf"], owned=True)
+                self.learn_handle(mr_id, recv_obj, bk["handle"])
+        else:
+            total_len, chunk_len, handle = FIRST_HEADER.unpack_from(view, at)
+            start = at + FIRST_HEADER.size
+            self.record(mr_id, "recv", total_len)
+
+            if chunk_len < total_len:
+                buf = bytearray(total_len)
+                buf[:chunk_len] = view[start: start + chunk_len]
+                self.bk[mr_id] = {"buf": buf, "filled": chunk_len, "handle": handle}
+            else:
+                with view[start: start + chunk_len] as chunk:
+                    recv_obj = decode(chunk)
+                self.learn_handle(mr_id, recv_obj, handle)
+
+        slots.post(offset)
+        self.consume(mr_id)
+
+        return recv_obj
+
+    # a recv buffer of the peer is consumed, it can send one more chunk unless its credits were cut
+    def consume(self, mr_id):
+        recv_mr = self.mrs[mr_id]
+        if recv_mr["debt"]:
+            recv_mr["debt"] -= 1
+        else:
+            recv_mr["grant"] += 1
+
+    # send message, ud=False sends a control message on the rc qp with the data messages
+    def mr_write(self, mr_id, send_obj, ud=True):
+        # a control message on the ud qp
+        ctrl = self.ctrl_code(mr_id, send_obj) if ud else None
+        if ctrl is not None:
+            self.send_ctrl(mr_id[:-2], ctrl, send_obj)
+            return
+
+        handle = self.new_handle(mr_id, send_obj)
+
+        # the frame header and payload buffers are not joined, big bytes values are buffers of their own
+        buffers = encode(send_obj)
+
+        data_len = sum(map(len, buffers))
+        self.record(mr_id, "send", data_len)
+
+        send_mr = self.mrs[mr_id]
+        if data_len > send_mr["rndv_threshold"]:
+            # rendezvous, the buffers are written one after the other and the peer reads them with one rdma read
+            mr = self.get_rndv_mr(data_len)
+            offset = 0
+            for data_b in buffers:
+                mr.write(data_b, len(data_b), offset)
+                offset += len(data_b)
+            send_mr["rndv"].append(mr)
+            send_mr["queue"].append((b"", struct.pack(RNDV_FORMAT, mr.buf, mr.rkey, data_len, handle), IMM_RNDV))
+            self.post_queue(mr_id)
+            return
+
+        # chunks fit in the recv slots of the peer
+        first_payload_cap = send_mr["slot"] - FIRST_HEADER.size
+        other_payload_cap = send_mr["slot"] - CHUNK_HEADER.size
+
+        queue = send_mr["queue"]
+        for i, chunk_data in enumerate(cut_chunks(buffers, first_payload_cap, other_payload_cap)):
+            chunk_len = len(chunk_data)
+
+            if i == 0:
+                # first chunk
+                header = FIRST_HEADER.pack(data_len, chunk_len, handle)
+            else:
+                # other chunks
+                header = CHUNK_HEADER.pack(chunk_len)
+            queue.append((header, chunk_data, 0))
+
+        self.post_queue(mr_id)
+
+    # post queued chunks while there are credits and free pool blocks,
+    # the rest is posted when the peer returns credits or sends complete
+    def post_queue(self, mr_id):
+        send_mr = self.mrs[mr_id]
+        recv_mr = self.mrs[f"{mr_id[:-2]}-1"]
+        queue = send_mr["queue"]
+        mr = self.pool.mr
+        while queue and send_mr["credits"] and len(send_mr["inflight"]) < self.NS:
+            header, chunk_data, flags = queue[0]
+            length = len(header) + len(chunk_data)
+            send_flags = IBV_SEND_SIGNALED
+            buf = None
+            if length <= self.args['inline_size']:
+                # copied into the wqe by post_send, no pool block
+                offset = 0
+                buf = ctypes.create_string_buffer(header + chunk_data, length)
+                sgl = [SGE(ctypes.addressof(buf), length, mr.lkey)]
+                send_flags |= IBV_SEND_INLINE
+            else:
+                offset = self.pool.alloc(length)
+                if offset is None:
+                    self.blocked.add(mr_id)
+                    return
+                mr.write(header, len(header), offset)
+                mr.write(chunk_data, len(chunk_data), offset + len(header))
+                sgl = [SGE(mr.buf + offset, length, mr.lkey)]
+            queue.popleft()
+
+            # piggyback credits of the recv side
+            grant = min(recv_mr["grant"], IMM_CREDIT_MASK)
+            recv_mr["grant"] -= grant
+            send_mr["credits"] -= 1
+
+            wr = SendWR(self.pam[mr_id] | (offset << WR_SLOT_SHIFT), opcode=self.args['operation_type'], num_sge=1,
+                    imm_data=grant << IMM_CREDIT_SHIFT | flags, sg=sgl, send_flags=send_flags)
+
+            self.post_send(mr_id[:-2], wr, buf)
+            send_mr["inflight"].append(offset)
+        self.blocked.discard(mr_id)
+
+    # return credits to the peer with an empty send, flags=IMM_FIN also ends a rendezvous
+    def post_credits(self, mr_id, flags=0):
+        recv_mr = self.mrs[mr_id]
+        grant = min(recv_mr["grant"], IMM_CREDIT_MASK)
+        recv_mr["grant"] -= grant
+
+        self.post_empty(mr_id, grant << IMM_CREDIT_SHIFT | flags)
+
+    # send without data, only imm_data
+    def post_empty(self, mr_id, imm):
+        sgl = [SGE(self.pool.mr.buf, 0, self.pool.mr.lkey)]
+        wr = SendWR(self.pam[mr_id], opcode=self.args['operation_type'], num_sge=1,
+                imm_data=imm, sg=sgl)
+
+        self.post_send(mr_id[:-2], wr)
+
+    # code of a READY, ROUTE_ERR or DEL message of a req_id the peer has a handle of, else None
+    def ctrl_code(self, mr_id, send_obj):
+        if not isinstance(send_obj, Message) or send_obj.type_id not in CTRL_TYPES or send_obj.req is not None:
+            return None
+        index = CTRL_NO_INDEX if send_obj.index is None else send_obj.index
+        if not 0 <= index <= CTRL_NO_INDEX:
+            return None
+
+        # data from the peer, or data to the peer
+        handle = self.mrs[f"{mr_id[:-2]}-1"]["handles"].get(send_obj.req_id, None)
+        if handle is not None:
+            own = IMM_OWN_HANDLE
+        else:
+            handle = self.mrs[mr_id]["handles"].get(send_obj.req_id, None)
+            if handle is None:
+                return None
+            own = 0
+        return CTRL_TYPES.index(send_obj.type_id) << CTRL_TYPE_SHIFT | own | index << CTRL_INDEX_SHIFT | handle
+
+    # message of a control code from the peer of recv mr_id, req_id is None if the handle is unknown
+    def ctrl_message(self, mr_id, ctrl):
+        handle = ctrl & (HANDLES - 1)
+        if ctrl & IMM_OWN_HANDLE:
+            req_id = self.mrs[f"{mr_id[:-2]}-0"]["req_ids"].get(handle, None)
+        else:
+            req_id = self.mrs[mr_id]["req_ids"].get(handle, None)
+        index = (ctrl >> CTRL_INDEX_SHIFT) & CTRL_NO_INDEX
+        if index == CTRL_NO_INDEX:
+            index = None
+        return Message(type_id=CTRL_TYPES[(ctrl >> CTRL_TYPE_SHIFT) & 3], req_id=req_id, req=None, index=index)
+
+    # send a control message to the peer on the ud qp, it is sent again until acked
+    def send_ctrl(self, IDENTITY, ctrl, send_obj):
+        peer = self.ud_peers[IDENTITY]
+        seq = peer["seq"]
+        peer["seq"] = (seq + 1) & 0xffffffff
+
+        entry = {"ctrl": ctrl, "message": send_obj, "deadline": 0, "timeout": UD_TIMEOUT, "tries": 0}
+        self.unacked[(IDENTITY, seq)] = entry
+        self.transmit(IDENTITY, seq, entry)
+
+    def transmit(self, IDENTITY, seq, entry):
+        # the send queue is full, sent again by resend
+        if not self.post_ud(IDENTITY, UD_CTRL, seq, entry["ctrl"]):
+            return
+        entry["tries"] += 1
+        entry["deadline"] = time.time() + entry["timeout"]
+        entry["timeout"] = min(entry["timeout"] * 2, UD_MAX_TIMEOUT)
+
+    # send control messages again that are not acked in time, on the rc qp after UD_RETRIES sends
+    def resend(self):
+        if not self.unacked:
+            return
+        now = time.time()
+        for key, entry in list(self.unacked.items()):
+            if entry["deadline"] > now:
+                continue
+            if entry["tries"] >= UD_RETRIES:
+                # the peer did not get it, or does not know the handle yet, the rc qp keeps it behind the data
+                del self.unacked[key]
+                logging.info(f"control message {entry['ctrl']:#x} to {key[0]} not acked after {UD_RETRIES} sends, "
+                    f"sent on the rc qp")
+                self.mr_write(f"{key[0]}-0", entry["message"], ud=False)
+                continue
+            self.transmit(key[0], key[1], entry)
+
+    # seconds until the next resend, at most timeout
+    def timeout(self, timeout):
+        if not self.unacked:
+            return timeout
+        deadline = min(entry["deadline"] for entry in self.unacked.values())
+        return max(0, min(timeout, deadline - time.time()))
+
+    # inline send on the ud qp, False if its send queue is full
+    def post_ud(self, IDENTITY, kind, seq, ctrl):
+        if self.ud_inflight >= UD_SENDS:
+            return False
+        peer = self.ud_peers[IDENTITY]
+
+        buf = ctypes.create_string_buffer(UD_HEADER.pack(kind, peer["dest"], seq, ctrl), UD_HEADER.size)
+        sgl = [SGE(ctypes.addressof(buf), UD_HEADER.size, self.ud_mr.lkey)]
+        wr = SendWR(UD_WR_ID, opcode=IBV_WR_SEND, num_sge=1, sg=sgl, send_flags=IBV_SEND_SIGNALED | IBV_SEND_INLINE)
+        wr.set_wr_ud(peer["ah"], peer["qpn"], UD_QKEY)
+
+        self.post_send(UD_IDENTITY, wr, buf)
+        self.ud_inflight += 1
+        return True
+
+    # control message or ack from a peer, acked if it can be decoded
+    def recv_ud(self, wc, poll_results):
+        offset = wc.wr_id >> WR_SLOT_SHIFT
+        if wc.status != IBV_WC_SUCCESS:
+            self.post_ud_recv(offset)
+            return
+        kind, dest, seq, ctrl = UD_HEADER.unpack_from(self.ud_view, offset + GRH_SIZE)
+        self.post_ud_recv(offset)
+        # qp already destroyed
+        IDENTITY = self.qpns.get(dest, None)
+        if IDENTITY is None:
+            return
+
+        if kind == UD_ACK:
+            self.unacked.pop((IDENTITY, seq), None)
+            return
+
+        peer = self.ud_peers[IDENTITY]
+        # not a duplicate of an acked one
+        if seq not in peer["seen"]:
+            mr_id = f"{IDENTITY}-1"
+            message = self.ctrl_message(mr_id, ctrl)
+            # the data message with the handle is not here yet, wait for the next send or the rc qp
+            if message.req_id is None:
+                return
+            if ctrl & IMM_OWN_HANDLE:
+                self.finish_handle(f"{IDENTITY}-0", message)
+            peer["seen"].add(seq)
+            peer["seen_order"].append(seq)
+            if len(peer["seen_order"]) > UD_WINDOW:
+                peer["seen"].discard(peer["seen_order"].popleft())
+            poll_results.append((mr_id, message))
+        self.post_ud(IDENTITY, UD_ACK, seq, 0)
+
+    # handle of the req_id of a data message to the peer, the oldest handle is reused once the peer is ready
+    # with its req_id, else the message gets no handle and the control messages of its req_id go on the rc qp
+    def new_handle(self, mr_id, send_obj):
+        if not isinstance(send_obj, Message) or send_obj.type_id != MESSAGE_DATA:
+            return NO_HANDLE
+        send_mr = self.mrs[mr_id]
+        handle = send_mr["next_handle"]
+        send_mr["next_handle"] = (handle + 1) % HANDLES
+        if handle in send_mr["req_ids"]:
+            return NO_HANDLE
+        self.set_handle(send_mr, send_obj.req_id, handle)
+        return handle
+
+    # handle the peer gave to the req_id of a data message
+    def learn_handle(self, mr_id, recv_obj, handle):
+        if handle != NO_HANDLE:
+            self.set_handle(self.mrs[mr_id], recv_obj.req_id, handle)
+        elif isinstance(recv_obj, Message) and recv_obj.req is None:
+            self.finish_handle(f"{mr_id[:-2]}-0", recv_obj)
+
+    # the peer is ready with a req_id it got from send mr_id, the handle of the req_id can be given again
+    def finish_handle(self, mr_id, message):
+        if message.type_id != MESSAGE_READY:
+            return
+        send_mr = self.mrs[mr_id]
+        handle = send_mr["handles"].pop(message.req_id, None)
+        if handle is not None:
+            send_mr["req_ids"].pop(handle, None)
+
+    def set_handle(self, handle_mr, req_id, handle):
+        old = handle_mr["req_ids"].pop(handle, None)
+        if old is not None and handle_mr["handles"].get(old, None) == handle:
+            handle_mr["handles"].pop(old)
+        # a req_id sent again gets a new handle, the old one is free
+        old = handle_mr["handles"].get(req_id, None)
+        if old is not None and handle_mr["req_ids"].get(old, None) == req_id:
+            handle_mr["req_ids"].pop(old)
+        handle_mr["handles"][req_id] = handle
+        handle_mr["req_ids"][handle] = req_id
+
+    # completion of a send, sends of a qp complete in the order they were posted
+    def complete_send(self, mr_id, offset):
+        send_mr = self.mrs[mr_id]
+        while send_mr["inflight"]:
+            done = send_mr["inflight"].popleft()
+            if done:
+                self.pool.release(done)
+            if done == offset:
+                break
+        self.post_queue(mr_id)
+
+    # registered buffer of at least n bytes for a rendezvous
+    def get_rndv_mr(self, n):
+        capacity = 1 << (n - 1).bit_length()
+        free = self.rndv_free.get(capacity, None)
+        if free:
+            return free.pop()
+        return MR(self.pd, capacity, IBV_ACCESS_LOCAL_WRITE | IBV_ACCESS_REMOTE_WRITE | IBV_ACCESS_REMOTE_READ)
+
+    # view of the first length bytes of a rendezvous buffer, the buffer goes back to the cache
+    # once the view and the parts of a req decoded from it are released
+    def rndv_view(self, mr, length):
+        buf = (ctypes.c_char * length).from_address(mr.buf)
+        weakref.finalize(buf, self.put_rndv_mr, mr)
+        return memoryview(buf).cast("B")
+
+    def put_rndv_mr(self, mr):
+        free = self.rndv_free.setdefault(mr.length, [])
+        if len(free) < RNDV_CACHE:
+            free.append(mr)
+        else:
+            mr.close()
+
+    # the peer sent (addr, rkey, len) of a big message, read it after the messages before it
+    def recv_rndv(self, mr_id, slots, offset):
+        mr, view, at = slots.locate(offset)
+        addr, rkey, length, handle = RNDV_HEADER.unpack_from(view, at)
+        slots.post(offset)
+        self.consume(mr_id)
+        self.record(mr_id, "recv", length)
+
+        self.mrs[mr_id]["reads"].append({"addr": addr, "rkey": rkey, "len": length, "handle": handle,
+            "mr": None, "obj": None, "done": False})
+        self.post_reads(mr_id)
+
+    # post rdma reads of the peer, at most RNDV_READS in flight
+    def post_reads(self, mr_id):
+        recv_mr = self.mrs[mr_id]
+        for read in recv_mr["reads"]:
+            if recv_mr["nreads"] >= RNDV_READS:
+                break
+            if read["done"] or read["mr"] is not None:
+                continue
+            mr = self.get_rndv_mr(read["len"])
+            read["mr"] = mr
+
+            sgl = [SGE(mr.buf, read["len"], mr.lkey)]
+            wr = SendWR(self.pam[mr_id], opcode=IBV_WR_RDMA_READ, num_sge=1, sg=sgl)
+            wr.set_wr_rdma(read["rkey"], read["addr"])
+
+            self.post_send(mr_id[:-2], wr)
+            recv_mr["nreads"] += 1
+
+    # reads of a qp complete in the order they were posted
+    def complete_read(self, mr_id, poll_results):
+        recv_mr = self.mrs[mr_id]
+        read = next(read for read in recv_mr["reads"] if not read["done"] and read["mr"] is not None)
+        mr = read.pop("mr")
+        with self.rndv_view(mr, read["len"]) as view:
+            read["obj"] = decode(view, owned=True)
+        read["done"] = True
+        self.learn_handle(mr_id, read["obj"], read["handle"])
+        recv_mr["nreads"] -= 1
+
+        # the sender can reuse its buffer
+        self.post_credits(mr_id, IMM_FIN)
+        self.post_reads(mr_id)
+        self.deliver(mr_id, None, poll_results)
+
+    # messages of a peer are delivered in order, after rendezvous reads before them
+    def deliver(self, mr_id, recv_data, poll_results):
+        reads = self.mrs[mr_id]["reads"]
+        if recv_data is not None:
+            if not reads:
+                poll_results.append((mr_id, recv_data))
+                return
+            reads.append({"obj": recv_data, "done": True})
+        while reads and reads[0]["done"]:
+            poll_results.append((mr_id, reads.popleft()["obj"]))
+
+    # give a recv buffer to the ud qp, posted by flush
+    def post_ud_recv(self, offset):
+        sgl = [SGE(self.ud_mr.buf + offset, UD_BUF, self.ud_mr.lkey)]
+        wr = RecvWR(UD_WR_ID | (offset << WR_SLOT_SHIFT), len(sgl), sgl)
+        if self.ud_recv_chain:
+            self.ud_recv_chain[-1].next_wr = wr
+        self.ud_recv_chain.append(wr)
+
+    # chain a send wr of the qp of IDENTITY, or of the ud qp, posted by flush,
+    # buf is the inline data that must live until then
+    def post_send(self, IDENTITY, wr, buf=None):
+        chain = self.send_chains.setdefault(IDENTITY, [])
+        if chain:
+            chain[-1].next_wr = wr
+        chain.append(wr)
+        if buf is not None:
+            self.inline_bufs.append(buf)
+
+    # post the chained wrs, one post_send (doorbell) per qp and one post_recv per srq
+    def flush(self):
+        for slots in self.slots.values():
+            if slots.chain:
+                slots.srq.post_recv(slots.chain[0])
+                slots.chain = []
+        if self.ud_recv_chain:
+            self.ud_qp.post_recv(self.ud_recv_chain[0])
+            self.ud_recv_chain = []
+        for IDENTITY, chain in self.send_chains.items():
+            qp = self.ud_qp if IDENTITY == UD_IDENTITY else self.qps[IDENTITY]
+            qp.post_send(chain[0])
+        self.send_chains = {}
+        self.inline_bufs = []
+
+    # send message, posted by the next flush or poll
+    def send(self, mr_id, send_obj):
+        self.mr_write(mr_id, send_obj)
+
+    # wait=False polls the cq without an event, used while busy polling
+    def poll(self, wait=True):
+        if wait:
+            self.comp_ch.get_cq_event(self.cq)
+            self.cq.ack_events(1)
+
+        poll_results = []
+        # event mode, arm before polling so that no completion is missed
+        if not self.busy_poll:
+            self.cq.req_notify()
+            self.poll_cq(poll_results)
+            return poll_results
+
+        if self.poll_cq(poll_results):
+            self.busy = True
+            self.busy_until = time.time() + self.busy_poll
+        elif not self.busy or time.time() >= self.busy_until:
+            # idle, back to event mode
+            self.busy = False
+            self.cq.req_notify()
+            if self.poll_cq(poll_results):
+                self.busy = True
+                self.busy_until = time.time() + self.busy_poll
+
+        return poll_results
+
+    # drain the cq in batches of poll_batch, return number of completions
+    def poll_cq(self, poll_results):
+        n_wc = 0
+        # recv mrs that consumed chunks
+        recv_mrs = set()
+        while True:
+            wc_num, wc_list = self.cq.poll(self.args['poll_batch'])
+            n_wc += wc_num
+
+            for wc in wc_list:
+                # control messages and acks
+                if wc.wr_id & WR_ID_MASK == UD_WR_ID:
+                    if wc.opcode & IBV_WC_RECV:
+                        self.recv_ud(wc, poll_results)
+                    else:
+                        self.ud_inflight -= 1
+                    continue
+
+                # recv of the srq
+                if wc.wr_id & WR_ID_MASK == SRQ_WR_ID:
+                    slots = self.slots[wc.wr_id >> CLASS_SHIFT]
+                    offset = slots.offset(wc.wr_id)
+                    IDENTITY = self.qpns.get(wc.qp_num, None)
+                    # qp already destroyed
+                    if IDENTITY is None or wc.status != IBV_WC_SUCCESS:
+                        slots.post(offset)
+                        continue
+
+                    mr_id = f"{IDENTITY}-1"
+                    smr_id = f"{IDENTITY}-0"
+                    credits = (wc.imm_data >> IMM_CREDIT_SHIFT) & IMM_CREDIT_MASK
+                    # an empty send only returns credits
+                    if wc.byte_len == 0:
+                        slots.post(offset)
+                        if wc.imm_data & IMM_FIN:
+                            self.put_rndv_mr(self.mrs[smr_id]["rndv"].popleft())
+                    elif wc.imm_data & IMM_RNDV:
+                        self.recv_rndv(mr_id, slots, offset)
+                        recv_mrs.add(mr_id)
+                    else:
+                        self.deliver(mr_id, self.mr_read(mr_id, slots, offset), poll_results)
+                        recv_mrs.add(mr_id)
+                    if credits:
+                        self.mrs[smr_id]["credits"] += credits
+                        self.post_queue(smr_id)
+                    continue
+
+                mr_id = self.map.get(str(wc.wr_id & WR_ID_MASK), None)
+                # qp already destroyed
+                if mr_id is None or mr_id not in self.mrs:
+                    continue
+                # a send with data, not one that only returns credits
+                if mr_id[-1] == '0':
+                    self.complete_send(mr_id, wc.wr_id >> WR_SLOT_SHIFT)
+                elif wc.opcode == IBV_WC_RDMA_READ:
+                    self.complete_read(mr_id, poll_results)
+
+            if wc_num < self.args['poll_batch']:
+                break
+
+        # pool blocks may be free again
+        for mr_id in list(self.blocked):
+            self.post_queue(mr_id)
+
+        # return credits that were not piggybacked on sends
+        for mr_id in recv_mrs:
+            if mr_id in self.mrs and self.mrs[mr_id]["grant"] >= self.mrs[mr_id]["threshold"]:
+                self.post_credits(mr_id)
+
+        # control messages not acked in time
+        self.resend()
+
+        # reposts and sends of this batch
+        self.flush()
+
+        return n_wc
+
+    # completions of the srqs and of all qps, with n more, must fit in the cq
+    def reserve_cq(self, n):
+        free_qps = sum(len(free) for free in self.free_qps.values())
+        cqe = sum(slots.depth for slots in self.slots.values()) + UD_RECVS + UD_SENDS + \
+            (len(self.qps) + len(self.handshake_info) + free_qps + n) * self.qp_wrs
+        if cqe > self.cqe:
+            self.cq.resize(cqe)
+            self.cqe = cqe
+
+    # recv buffers of a slot class, created with its first qp
+    def get_slots(self, index):
+        if index not in self.slots:
+            slot = self.slot_sizes[index]
+            max_wr = self.args.get('srq_max_wr', None) or \
+                min(SRQ_MAX_WR, max(SRQ_MIN_WR, self.NR * self.args['size'] // slot))
+            self.slots[index] = Slots(self.pd, index, slot, min(self.NR, max_wr), self.args['sg_depth'], max_wr)
+            self.reserve_cq(0)
+        return self.slots[index]
+
+    # the qps of a slot class share its max_wr recv buffers, each gets the same credits, num_sgl at most
+    def share(self, slots):
+        n = len(slots.recv_mrs)
+        return max(1, min(self.N, (slots.max_wr - n * SRQ_HEADROOM) // n))
+
+    # after a qp attached or left, peers with more credits return fewer and peers with less get more
+    def rebalance(self, slots):
+        n = len(slots.recv_mrs)
+        if n == 0:
+            return
+        share = self.share(slots)
+        if share < self.N and share != slots.share:
+            logging.info(f"{n} qps share {slots.max_wr} recvs of {slots.slot}B slots, {share} credits each")
+        slots.share = share
+        slots.grow(min(n * (share + SRQ_HEADROOM), slots.max_wr))
+        self.reserve_cq(0)
+
+        for recv_mr in slots.recv_mrs:
+            if recv_mr["credits"] > share:
+                recv_mr["debt"] += recv_mr["credits"] - share
+            else:
+                more = share - recv_mr["credits"]
+                paid = min(more, recv_mr["debt"])
+                recv_mr["debt"] -= paid
+                recv_mr["grant"] += more - paid
+            recv_mr["credits"] = share
+            # return credits without data once a quarter of them are consumed
+            recv_mr["threshold"] = math.ceil(share / 4)
+
+    # class of the smallest slot that fits n bytes, the biggest one if none
+    def class_of(self, n):
+        return min(bisect.bisect_left(self.slot_sizes, n), len(self.slot_sizes) - 1)
+
+    # count a message of n bytes to or from the peer of mr_id
+    def record(self, mr_id, direction, n):
+        peer = self.edges.get(mr_id[:-2], None)
+        if peer is None:
+            return
+        counts = self.history.setdefault((peer, direction), [0] * len(self.slot_sizes))
+        counts[self.class_of(n + FIRST_HEADER.size)] += 1
+        # recent messages weigh more
+        if sum(counts) >= HISTORY_MAX:
+            for i in range(len(counts)):
+                counts[i] //= 2
+
+    # slot class for the messages of an edge, from their history, else from the hint in workflow.json,
+    # None if neither is known
+    def choose_class(self, peer, direction):
+        counts = self.history.get((peer, direction), None)
+        if counts and sum(counts) >= HISTORY_MIN:
+            covered = 0
+            for index, count in enumerate(counts):
+                covered += count
+                if covered >= SLOT_COVERAGE * sum(counts):
+                    return index
+        if self.hints.get(peer, None):
+            return self.class_of(self.hints[peer] + FIRST_HEADER.size)
+        return None
+
+    # slot class of the recv buffers of an edge, the one the peer wants to send with (wish bytes),
+    # else from the history of the edge, else the biggest one
+    def recv_class(self, peer, wish=0):
+        if wish:
+            return self.class_of(wish)
+        index = self.choose_class(peer, "recv")
+        if index is None:
+            return len(self.slot_sizes) - 1
+        return index
+
+    # create qps of slot class index in INIT state until there are n, or qp_pool, for the next handshakes
+    def refill(self, n=None, index=None):
+        if n is None:
+            n = self.args['qp_pool']
+        if index is None:
+            index = self.refill_class
+        # no handshake yet
+        if index is None:
+            return
+        free = self.free_qps.setdefault(index, deque())
+        if len(free) >= n:
+            return
+        slots = self.get_slots(index)
+        self.reserve_cq(n - len(free))
+
+        qa = QPAttr(port_num=1)
+        qa.qp_access_flags = IBV_ACCESS_REMOTE_WRITE | IBV_ACCESS_REMOTE_READ | IBV_ACCESS_LOCAL_WRITE
+        qp_init_attr = QPInitAttr(qp_type=self.args['qp_type'], scq=self.cq, rcq=self.cq, srq=slots.srq, cap=self.qp_cap,
+            sq_sig_all=True)
+        while len(free) < n:
+            free.append(QP(self.pd, qp_init_attr, qa))
+
+    # peer is the func_name of the downstream instance, or remote_info_str the handshake of the upstream one
+    def prepare_dtc(self, index, peer=None, remote_info_str=None):
+        wish = 0
+        if remote_info_str is not None:
+            fields = remote_info_str.split(",")
+            peer, wish = fields[5], int(fields[7])
+        recv_class = self.recv_class(peer, wish)
+        send_class = self.choose_class(peer, "send")
+        send_slot = 0 if send_class is None else self.slot_sizes[send_class]
+
+        # a qp of the pool, it is refilled when the sidecar is idle
+        self.refill_class = recv_class
+        if not self.free_qps.get(recv_class, None):
+            self.refill(1, recv_class)
+        qp = self.free_qps[recv_class].popleft()
+
+        # the recv buffers of the class cover the credits of the peer and its empty sends
+        slots = self.slots[recv_class]
+        recv_mr = {"grant": 0, "debt": 0, "class": recv_class, "reads": deque(), "nreads": 0, "handles": {}, "req_ids": {}}
+        slots.recv_mrs.append(recv_mr)
+        # credits of the new peer are given in the handshake, not granted
+        recv_mr["credits"] = self.share(slots)
+        self.rebalance(slots)
+
+        self.handshake_info[str(index)] = (qp, recv_mr)
+
+        local_info = f"{str(self.gid)},{str(qp.qp_num)},{str(self.pool.mr.buf)},{str(self.pool.mr.rkey)},{str(self.ud_qp.qp_num)}," \
+            f"{self.func_name},{str(self.slot_sizes[recv_class])},{str(send_slot)},{str(recv_mr['credits'])}"
+
+        return local_info
+
+    def add_dtc(self, remote_info_str, IDENTITY, index):
+        gid_str, qpn_str, remote_addr, remote_key, ud_qpn_str, peer, slot_str, wish_str, credits_str = remote_info_str.split(",")
+
+        remote_info = {"gid": GID(gid_str), "qpn": int(qpn_str), "addr": int(remote_addr), "rkey": int(remote_key)}
+
+        qp, recv_mr = self.handshake_info[str(index)]
+
+        gr = GlobalRoute(dgid=remote_info['gid'], sgid_index=self.args['gid_index'])
+        ah_attr = AHAttr(gr=gr, is_global=1, port_num=1)
+
+        qa = QPAttr()
+        qa.ah_attr = ah_attr
+        qa.dest_qp_num = remote_info['qpn']
+        qa.path_mtu = self.args['mtu']
+        qa.max_rd_atomic = self.args['max_rd_atomic']
+        qa.max_dest_rd_atomic = self.args['max_rd_atomic']
+        qa.qp_access_flags = IBV_ACCESS_REMOTE_WRITE | IBV_ACCESS_REMOTE_READ | IBV_ACCESS_LOCAL_WRITE
+        # the srq is shared, a peer may find it empty
+        qa.rnr_retry = RNR_RETRY_INFINITE
+        qa.min_rnr_timer = MIN_RNR_TIMER
+        qp.to_rts(qa)
+
+        self.qps[IDENTITY] = qp
+        self.qpns[qp.qp_num] = IDENTITY
+        self.ud_peers[IDENTITY] = {"ah": AH(self.pd, attr=ah_attr), "qpn": int(ud_qpn_str), "dest": remote_info["qpn"], "seq": 0,
+            "seen": set(), "seen_order": deque()}
+        self.edges[IDENTITY] = peer
+        smr_id = f"{IDENTITY}-0"
+        rmr_id = f"{IDENTITY}-1"
+
+        self.map[str(index * 2)] = smr_id
+        self.map[str(index * 2 + 1)] = rmr_id
+        self.pam[smr_id] = index * 2
+        self.pam[rmr_id] = index * 2 + 1
+
+        slot = int(slot_str)
+        self.mrs[smr_id] = {"slot": slot, "rndv_threshold": self.rndv_threshold or RNDV_SLOTS * slot,
+            "queue": deque(), "inflight": deque(), "credits": int(credits_str), "rndv": deque(),
+            "handles": {}, "req_ids": {}, "next_handle": 0}
+        self.mrs[rmr_id] = recv_mr
+
+        del self.handshake_info[str(index)]
+
+    def destroy(self, IDENTITY):
+        if IDENTITY not in self.qps:
+            return
+
+        qp = self.qps.pop(IDENTITY)
+        self.qpns.pop(qp.qp_num, None)
+        self.send_chains.pop(IDENTITY, None)
+        self.edges.pop(IDENTITY, None)
+        peer = self.ud_peers.pop(IDENTITY, None)
+        if peer:
+            peer["ah"].close()
+        for key in [key for key in self.unacked if key[0] == IDENTITY]:
+            del self.unacked[key]
+        qp.close()
+
+        # blocks of sends in flight
+        send_mr = self.mrs.pop(f"{IDENTITY}-0", None)
+        if send_mr:
+            for offset in send_mr["inflight"]:
+                if offset:
+                    self.pool.release(offset)
+            for mr in send_mr["rndv"]:
+                mr.close()
+        recv_mr = self.mrs.pop(f"{IDENTITY}-1", None)
+        if recv_mr:
+            # the other qps of the class get its recv buffers
+            slots = self.slots[recv_mr["class"]]
+            slots.recv_mrs.remove(recv_mr)
+            self.rebalance(slots)
+            for read in recv_mr["reads"]:
+                if read.get("mr", None) is not None:
+                    read["mr"].close()
+        self.blocked.discard(f"{IDENTITY}-0")
+        self.bk.pop(f"{IDENTITY}-1", None)
+
+        wr_ids = [wr_id for wr_id in self.map if f"{IDENTITY}-" in self.map[wr_id]]
+        for wr_id in wr_ids:
+            # del self.map[wr_id]
+            self.map.pop(wr_id, None)
+
+        if len(self.qps) == 0:
+            for free in self.free_qps.values():
+                while free:
+                    free.popleft().close()
+            self.ud_qp.close()
+            for free in self.rndv_free.values():
+                for mr in free:
+                    mr.close()
+            self.rndv_free = {}
+            self.comp_ch.close()
+            self.cq.close()
+
+# length prefix of every frame
+HEADER = struct.Struct("!I")
+# set in the length prefix if the body is in fds passed with SCM_RIGHTS, the body is then the number of fds
+FD_FLAG = 1 << 31
+# max number of fds in one SCM_RIGHTS message
+SCM_MAX_FD = 253
+# zero-copy send, Linux 4.14+
+SO_ZEROCOPY = getattr(socket, "SO_ZEROCOPY", 60)
+MSG_ZEROCOPY = getattr(socket, "MSG_ZEROCOPY", 0x4000000)
+# completion notification in the error queue, struct sock_extended_err
+SOCK_EE = struct.Struct("=IBBBBII")
+SO_EE_ORIGIN_ZEROCOPY = 5
+SO_EE_CODE_ZEROCOPY_COPIED = 1
+
+# max number of buffers in one sendmsg
+try:
+    IOV_MAX = os.sysconf("SC_IOV_MAX")
+except (ValueError, OSError) as err:
+    IOV_MAX = 1024
+
+class Framer:
+    """
+    Receive buffer of one connection.
+    Bytes are read with recv_into at the tail of a bytearray and complete frames are
+    handed out as memoryview slices, so a frame body is never copied before decoding.
+    A frame bigger than size leaves with the bytearray it was read into, so the req of
+    a MESSAGE_DATA keeps views of it instead of copies.
+    """
+    def __init__(self, size=65536):
+        self.size = size
+        self.buf = bytearray(size)
+        # unread bytes are self.buf[self.start:self.end]
+        self.start = 0
+        self.end = 0
+        # fds received with SCM_RIGHTS and not yet claimed by a frame
+        self.fds = deque()
+
+    def reserve(self, n):
+        # make sure at least n bytes are free after self.end
+        if len(self.buf) - self.end >= n:
+            return
+
+        pending = self.end - self.start
+        if pending <= self.start and len(self.buf) - pending >= n:
+            # move the unread tail to the front (the two regions do not overlap)
+            self.buf[:pending] = memoryview(self.buf)[self.start:self.end]
+        else:
+            buf = bytearray(max(len(self.buf) * 2, pending + n))
+            buf[:pending] = memoryview(self.buf)[self.start:self.end]
+            self.buf = buf
+        self.start = 0
+        self.end = pending
+
+    def fill(self, select_socket, flags=0):
+        pending = self.end - self.start
+        stop = None
+        if pending >= HEADER.size:
+            # read the whole body of a big frame at once
+            frame_len = HEADER.size + (HEADER.unpack_from(self.buf, self.start)[0] & ~FD_FLAG)
+            need = frame_len - pending
+            self.reserve(max(need, 4096))
+            # but not past it, the buffer leaves with the frame
+            if frame_len > self.size and need > 0:
+                stop = self.end + need
+        else:
+            self.reserve(4096)
+
+        with memoryview(self.buf)[:stop] as view:
+            if select_socket.family == socket.AF_UNIX:
+                recv_len, ancdata, msg_flags, address = select_socket.recvmsg_into(
+                    [view[self.end:]], socket.CMSG_SPACE(SCM_MAX_FD * 4), flags)
+                for level, ctype, cdata in ancdata:
+                    if level == socket.SOL_SOCKET and ctype == socket.SCM_RIGHTS:
+                        fds = array("i")
+                        fds.frombytes(cdata[:len(cdata) - len(cdata) % fds.itemsize])
+                        self.fds.extend(fds)
+            else:
+                recv_len = select_socket.recv_into(view[self.end:], 0, flags)
+        self.end += recv_len
+        return recv_len
+
+    # (body, fds, owned) of the next complete frame, (None, None, False) if there is none,
+    # owned if the body is not reused by the framer
+    def next_frame(self):
+        pending = self.end - self.start
+        if pending < HEADER.size:
+            return None, None, False
+        len_data = HEADER.unpack_from(self.buf, self.start)[0]
+        fds = None
+        if len_data & FD_FLAG:
+            len_data &= ~FD_FLAG
+            # the fds may come with a later recvmsg than the frame
+            if pending < HEADER.size + len_data or len(self.fds) < self.buf[self.start + HEADER.size]:
+                return None, None, False
+            fds = [self.fds.popleft() for i in range(self.buf[self.start + HEADER.size])]
+        if pending < HEADER.size + len_data:
+            return None, None, False
+
+        frame_start = self.start + HEADER.size
+        self.start = frame_start + len_data
+        frame = memoryview(self.buf)[frame_start: frame_start + len_data]
+        owned = HEADER.size + len_data > self.size
+        if owned:
+            # the unread tail goes to a new buffer
+            tail = self.end - self.start
+            buf = bytearray(max(self.size, tail))
+            buf[:tail] = memoryview(self.buf)[self.start: self.end]
+            self.buf = buf
+            self.start = 0
+            self.end = tail
+        elif self.start == self.end:
+            self.start = 0
+            self.end = 0
+        return frame, fds, owned
+
+    def shrink(self):
+        # give back the memory of a big frame once it has been consumed
+        if self.start == self.end and len(self.buf) > self.size:
+            self.buf = bytearray(self.size)
+            self.start = 0
+            self.end = 0
+
+    def close(self):
+        while self.fds:
+            os.close(self.fds.popleft())
+
+# write the buffers of a frame into a sealed memfd, the receiver maps it read-only
+def to_memfd(*buffers):
+    fd = os.memfd_create("dtc", os.MFD_CLOEXEC | os.MFD_ALLOW_SEALING)
+    for data_b in buffers:
+        with memoryview(data_b) as view:
+            offset = 0
+            while offset < len(view):
+                offset += os.write(fd, view[offset:])
+    fcntl.fcntl(fd, fcntl.F_ADD_SEALS, fcntl.F_SEAL_SHRINK | fcntl.F_SEAL_GROW | fcntl.F_SEAL_WRITE | fcntl.F_SEAL_SEAL)
+    return fd
+
+class DTC:
+    def __init__(self, ip, port, nc=100):
+        # Unix domain socket if port is None, ip is then the socket path
+        if port is None:
+            self.IDENTITY = ip
+            self.addr = ip
+            self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        else:
+            self.IDENTITY = f"{ip}:{port}"
+            self.addr = (ip, port)
+            self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+
+        # fd -> Framer
+        self.recv_bk = {}
+
+    def send(self, data_obj, select_socket=None):
+        buffers = encode(data_obj)
+
+        send_b = b"".join([HEADER.pack(sum(map(len, buffers))), *buffers])
+
+        if select_socket:
+            select_socket.sendall(send_b)
+        else:
+            self.socket.sendall(send_b)
+
+    def get_framer(self, fd):
+        framer = self.recv_bk.get(fd, None)
+        if framer is None:
+            framer = Framer()
+            self.recv_bk[fd] = framer
+        return framer
+
+    def loads(self, frame, fds, owned=False):
+        with frame:
+            if not fds:
+                return decode(frame, owned)
+        # the body was passed in a memfd, it is unmapped once the message and its req are released
+        try:
+            return decode(mmap.mmap(fds[0], 0, prot=mmap.PROT_READ), owned=True)
+        finally:
+            for fd in fds:
+                os.close(fd)
+
+    # decode all complete frames in the buffer
+    def decode_frames(self, framer):
+        recv_data_list = []
+        while True:
+            frame, fds, owned = framer.next_frame()
+            if frame is None:
+                break
+            recv_data_list.append(self.loads(frame, fds, owned))
+        return recv_data_list
+
+    # blocking recv of one message, '' if a non-blocking socket has no complete message
+    def recv(self, select_socket=None):
+        if not select_socket:
+            select_socket = self.socket
+
+        framer = self.get_framer(select_socket.fileno())
+
+        while True:
+            frame, fds, owned = framer.next_frame()
+            if frame is not None:
+                return self.loads(frame, fds, owned)
+            try:
+                if not framer.fill(select_socket):
+                    return None
+            except BlockingIOError as err:
+                return ''
+
+    # drain the socket and decode every complete message, None at the end if closed
+    def recv_all(self, select_socket=None):
+        if not select_socket:
+            select_socket = self.socket
+
+        framer = self.get_framer(select_socket.fileno())
+
+        recv_data_list = []
+        while True:
+            try:
+                recv_len = framer.fill(select_socket, socket.MSG_DONTWAIT)
+            except BlockingIOError as err:
+                break
+            except ConnectionError as err:
+                recv_len = 0
+
+            if not recv_len:
+                recv_data_list.extend(self.decode_frames(framer))
+                recv_data_list.append(None)
+                return recv_data_list
+
+            recv_data_list.extend(self.decode_frames(framer))
+
+        framer.shrink()
+
+        return recv_data_list
+
+
+class Client(DTC):
+    def __init__(self, ip, port, nc=100):
+        super(Client, self).__init__(ip, port)
+        while True:
+            return_code = self.socket.connect_ex(self.addr)
+            if return_code == 0:
+                break
+            time.sleep(0.01)
+
+    def clean(self):
+        self.socket.close()
+
+class Server(DTC):
+    def __init__(self, ip, port, nc=100, hwm=4 * 1024 * 1024, fd_threshold=None, zerocopy_threshold=None):
+        super(Server, self).__init__(ip, port)
+        if port is None:
+            # socket file left by an earlier instance
+            if os.path.exists(ip):
+                os.unlink(ip)
+        else:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind(self.addr)
+        self.socket.listen(nc)
+
+        self.client_socket = []
+
+        self.poller = select.epoll()
+        self.map = {}
+        self.server_fd = self.socket.fileno()
+        self.poller.register(self.server_fd, select.EPOLLIN)
+        self.map[self.server_fd] = self.socket
+        self.pam = {self.IDENTITY: self.server_fd}
+        self.address = {}
+
+        self.to_del = []
+
+        # fd -> deque of bytes not yet accepted by the kernel
+        self.send_bk = {}
+        # fd -> number of bytes in self.send_bk[fd]
+        self.send_len = {}
+        # fd -> deque of fds to pass with the next sendmsg, Unix domain sockets only
+        self.send_fds = {}
+        # fd -> number of frames with fds queued since its queue was last empty, a sendmsg carries the fds
+        # of SCM_MAX_FD frames, so None in the queue ends a sendmsg before the frames of the next ones
+        self.n_fd_frames = {}
+        # bodies of at least fd_threshold bytes are passed in a memfd on Unix domain sockets, off if None
+        # opt-in, transport_bench shows plain UDS sends faster than the memfd handoff up to 64 MB
+        self.fd_threshold = fd_threshold
+        # fds with more than hwm bytes queued, cleared below hwm / 2
+        self.hwm = hwm
+        self.congested = set()
+        # fds with frames queued since the last flush
+        self.dirty = set()
+        # fds registered for EPOLLOUT
+        self.blocked = set()
+        # fd -> [time it blocked, bytes written since], until its queue is empty
+        self.drain = {}
+        # fd -> (bytes/s it drained at the last times it was blocked, time of the last one), see get_link_rate
+        self.link_rate = {}
+
+        # opt-in MSG_ZEROCOPY for sendmsgs of at least zerocopy_threshold bytes on TCP
+        self.zerocopy_threshold = zerocopy_threshold
+        # fds with SO_ZEROCOPY set
+        self.zerocopy = set()
+        # fd -> deque of (seq, buffers) the kernel may still read from
+        self.zc_pending = {}
+        # fd -> seq of the next zero-copy sendmsg
+        self.zc_seq = {}
+
+        # write-combining counters, see get_send_stats
+        self.n_frames = 0
+        self.n_flushes = 0
+        self.n_syscalls = 0
+        self.n_zerocopy = 0
+        self.n_zerocopy_copied = 0
+
+    def enable_zerocopy(self, select_socket):
+        if self.zerocopy_threshold is None or select_socket.family == socket.AF_UNIX:
+            return
+        try:
+            select_socket.setsockopt(socket.SOL_SOCKET, SO_ZEROCOPY, 1)
+        except OSError as err:
+            # kernel without SO_ZEROCOPY, keep copying
+            return
+        fd = select_socket.fileno()
+        self.zerocopy.add(fd)
+        self.zc_pending[fd] = deque()
+        self.zc_seq[fd] = 0
+
+    def add_dtc(self, dtc):
+        dtc_fd = dtc.socket.fileno()
+        self.enable_zerocopy(dtc.socket)
+        self.poller.register(dtc_fd, select.EPOLLIN)
+        self.map[dtc_fd] = dtc.socket
+        self.pam[dtc.IDENTITY] = dtc_fd
+        self.address[dtc_fd] = dtc.IDENTITY
+        # keep bytes already buffered by blocking recvs of the dtc
+        if dtc_fd in dtc.recv_bk:
+            self.recv_bk[dtc_fd] = dtc.recv_bk.pop(dtc_fd)
+
+    def add_comp_ch(self, comp_ch_fd):
+        self.comp_ch = comp_ch_fd
+        self.poller.register(comp_ch_fd, select.EPOLLIN)
+
+    def del_dtc(self, dtc_socket):
+        dtc_fd = dtc_socket.fileno()
+        IDENTITY = [k for k in self.pam if self.pam[k] == dtc_fd][0]
+        self.pam.pop(IDENTITY, None)
+        self.map.pop(dtc_fd, None)
+        self.address.pop(dtc_fd, None)
+        framer = self.recv_bk.pop(dtc_fd, None)
+        if framer:
+            framer.close()
+        for fd in self.send_fds.pop(dtc_fd, []):
+            os.close(fd)
+        self.n_fd_frames.pop(dtc_fd, None)
+        self.send_bk.pop(dtc_fd, None)
+        self.send_len.pop(dtc_fd, None)
+        self.congested.discard(dtc_fd)
+        self.dirty.discard(dtc_fd)
+        self.blocked.discard(dtc_fd)
+        self.drain.pop(dtc_fd, None)
+        self.link_rate.pop(dtc_fd, None)
+        self.zerocopy.discard(dtc_fd)
+        self.zc_pending.pop(dtc_fd, None)
+        self.zc_seq.pop(dtc_fd, None)
+        # del self.pam[IDENTITY]
+        # del self.map[dtc_fd]
+        # del self.address[dtc_fd]
+        if dtc_socket in self.client_socket:
+            self.client_socket.remove(dtc_socket)
+        self.poller.unregister(dtc_fd)
+        dtc_socket.close()
+
+    # queue the message for select_socket, it is written by the next flush
+    def send(self, data_obj, select_socket=None):
+        if not select_socket:
+            return super(Server, self).send(data_obj)
+
+        buffers = encode(data_obj)
+        len_data = sum(map(len, buffers))
+
+        fd = select_socket.fileno()
+        if fd not in self.send_bk:
+            self.send_bk[fd] = deque()
+            self.send_len[fd] = 0
+        if select_socket.family == socket.AF_UNIX and self.fd_threshold is not None and len_data >= self.fd_threshold:
+            # pass the body in a memfd and send only the number of fds
+            n_fd_frames = self.n_fd_frames.get(fd, 0)
+            if n_fd_frames and n_fd_frames % SCM_MAX_FD == 0:
+                self.send_bk[fd].append(None)
+            self.n_fd_frames[fd] = n_fd_frames + 1
+            self.send_fds.setdefault(fd, deque()).append(to_memfd(*buffers))
+            buffers = [bytes([1])]
+            len_data = 1
+            header = HEADER.pack(len_data | FD_FLAG)
+        else:
+            header = HEADER.pack(len_data)
+
+        # header, frame header and the payload buffers, e.g. out-of-band bytes values, stay
+        # separate buffers of the sendmsg, encode leaves out empty ones as flush_fd expects
+        send_queue = self.send_bk[fd]
+        send_queue.append(header)
+        send_queue.extend(buffers)
+        self.send_len[fd] += HEADER.size + len_data
+        self.dirty.add(fd)
+        self.n_frames += 1
+
+        if self.send_len[fd] > self.hwm:
+            self.congested.add(fd)
+
+    # write the frames queued since the last flush, one sendmsg per peer if possible
+    def flush(self):
+        for fd in self.dirty:
+            # the rest is written when poll sees EPOLLOUT
+            if fd in self.blocked:
+                continue
+            if not self.flush_fd(fd):
+                # resume in poll when the socket is writable
+                self.poller.modify(fd, select.EPOLLIN | select.EPOLLOUT)
+                self.blocked.add(fd)
+                # the link is the bottleneck until the queue is empty
+                self.drain[fd] = [time.time(), 0]
+        self.dirty = set()
+
+    def flush_fd(self, fd):
+        if fd not in self.send_bk:
+            return True
+
+        select_socket = self.map[fd]
+        send_queue = self.send_bk[fd]
+        self.n_flushes += 1
+        send_fds = self.send_fds.get(fd, None)
+        try:
+            while send_queue:
+                if send_queue[0] is None:
+                    send_queue.popleft()
+                    continue
+                ancdata = []
+                if send_fds:
+                    # fds go no later than their frame, the receiver waits for them
+                    fds = array("i", islice(send_fds, SCM_MAX_FD))
+                    ancdata = [(socket.SOL_SOCKET, socket.SCM_RIGHTS, fds)]
+                buffers = list(takewhile(lambda buf: buf is not None, islice(send_queue, IOV_MAX)))
+                flags = socket.MSG_DONTWAIT
+                if fd in self.zerocopy and sum(map(len, buffers)) >= self.zerocopy_threshold:
+                    flags |= MSG_ZEROCOPY
+                try:
+                    sent_len = select_socket.sendmsg(buffers, ancdata, flags)
+                except OSError as err:
+                    # ENOBUFS if the pinned pages exceed optmem_max, copy instead
+                    if not flags & MSG_ZEROCOPY or err.errno != errno.ENOBUFS:
+                        raise
+                    flags = socket.MSG_DONTWAIT
+                    sent_len = select_socket.sendmsg(buffers, ancdata, flags)
+                self.n_syscalls += 1
+                if flags & MSG_ZEROCOPY:
+                    # the kernel reads the buffers until the completion of this seq
+                    self.zc_pending[fd].append((self.zc_seq[fd], buffers))
+                    self.zc_seq[fd] = (self.zc_seq[fd] + 1) & 0xffffffff
+                    self.n_zerocopy += 1
+                if ancdata:
+                    # the kernel holds its own references now
+                    for i in range(len(fds)):
+                        os.close(send_fds.popleft())
+                self.send_len[fd] -= sent_len
+                if fd in self.drain:
+                    self.drain[fd][1] += sent_len
+                # drop the buffers that are fully written
+                while sent_len:
+                    buf_len = len(send_queue[0])
+                    if sent_len < buf_len:
+                        send_queue[0] = memoryview(send_queue[0])[sent_len:]
+                        break
+                    send_queue.popleft()
+                    sent_len -= buf_len
+                if send_queue and sent_len:
+                    break
+        except BlockingIOError as err:
+            pass
+        except ConnectionError as err:
+            # peer is gone, the closed socket is reported by recv
+            send_queue.clear()
+            self.send_len[fd] = 0
+            self.drain.pop(fd, None)
+            while send_fds:
+                os.close(send_fds.popleft())
+
+        if self.send_len[fd] < self.hwm // 2:
+            self.congested.discard(fd)
+
+        if not send_queue:
+            self.send_bk.pop(fd, None)
+            self.send_len.pop(fd, None)
+            self.send_fds.pop(fd, None)
+            self.n_fd_frames.pop(fd, None)
+            drain = self.drain.pop(fd, None)
+            if drain:
+                self.update_link_rate(fd, *drain)
+            return True
+        return False
+
+    # while a queue is blocked the kernel takes its bytes as fast as the link sends them
+    def update_link_rate(self, fd, start, n_bytes):
+        now = time.time()
+        if now <= start or not n_bytes:
+            return
+        rate = n_bytes / (now - start)
+        if fd in self.link_rate:
+            rate = (self.link_rate[fd][0] + rate) / 2
+        self.link_rate[fd] = (rate, now)
+
+    # (bytes/s, time measured) of the link to fd, None if its queue never blocked, then the link kept up
+    def get_link_rate(self, fd):
+        return self.link_rate.get(fd, None)
+
+    # release the buffers of completed zero-copy sends
+    def reap_zerocopy(self, fd):
+        select_socket = self.map[fd]
+        pending = self.zc_pending[fd]
+        while True:
+            try:
+                msg, ancdata, msg_flags, address = select_socket.recvmsg(0, socket.CMSG_SPACE(SOCK_EE.size), socket.MSG_ERRQUEUE | socket.MSG_DONTWAIT)
+            except BlockingIOError as err:
+                break
+            for level, ctype, cdata in ancdata:
+                if len(cdata) < SOCK_EE.size:
+                    continue
+                ee_errno, ee_origin, ee_type, ee_code, ee_pad, ee_info, ee_data = SOCK_EE.unpack_from(cdata)
+                if ee_origin != SO_EE_ORIGIN_ZEROCOPY:
+                    continue
+                # sends ee_info to ee_data are done
+                if ee_code & SO_EE_CODE_ZEROCOPY_COPIED:
+                    self.n_zerocopy_copied += 1
+                while pending and (ee_data - pending[0][0]) & 0xffffffff < 0x80000000:
+                    pending.popleft()
+
+    # frames per flush and per syscall since the last call
+    def get_send_stats(self):
+        stats = {
+            "frames": self.n_frames,
+            "frames_per_flush": self.n_frames / self.n_flushes if self.n_flushes else 0,
+            "frames_per_syscall": self.n_frames / self.n_syscalls if self.n_syscalls else 0
+        }
+        if self.zerocopy:
+            # the kernel copied anyway, e.g. on loopback
+            stats["zerocopy"] = self.n_zerocopy
+            stats["zerocopy_copied"] = self.n_zerocopy_copied
+        self.n_frames = 0
+        self.n_flushes = 0
+        self.n_syscalls = 0
+        self.n_zerocopy = 0
+        self.n_zerocopy_copied = 0
+        return stats
+
+    # the outbound queue of fd is above the high-water mark
+    def is_congested(self, fd):
+        return fd in self.congested
+
+    # all messages received from fd in this wakeup
+    def poll_fd(self, fd):
+        poll_dtc = self.map[fd]
+        recv_data_list = self.recv_all(poll_dtc)
+
+        if recv_data_list and recv_data_list[-1] is None:
+            self.to_del.append(poll_dtc)
+
+        return [(poll_dtc, recv_data) for recv_data in recv_data_list]
+        
+    def poll(self, timeout=5):
+        if self.to_del:
+            for dtc_socket in self.to_del:
+                self.del_dtc(dtc_socket)
+            self.to_del = []
+
+        poll_fds = []
+        events = dict(self.poller.poll(timeout=timeout))
+        
+        for fd, event in events.items():
+            if fd == self.server_fd:
+                client_socket, client_address = self.socket.accept()
+                client_socket.setblocking(0)
+                self.client_socket.append(client_socket)
+
+                # peers of a Unix domain socket are unnamed
+                if self.socket.family == socket.AF_UNIX:
+                    client_address = (self.IDENTITY, client_socket.fileno())
+
+                self.enable_zerocopy(client_socket)
+                self.poller.register(client_socket.fileno(), select.EPOLLIN)
+                self.map[client_socket.fileno()] = client_socket
+                self.pam[f"{client_address[0]}:{client_address[1]}"] = client_socket.fileno()
+                self.address[client_socket.fileno()] = f"{client_address[0]}:{client_address[1]}"
+                continue
+
+            if event & select.EPOLLERR and fd in self.zerocopy:
+                self.reap_zerocopy(fd)
+            if event & select.EPOLLOUT:
+                if self.flush_fd(fd):
+                    self.poller.modify(fd, select.EPOLLIN)
+                    self.blocked.discard(fd)
+            if event & (select.EPOLLIN | select.EPOLLHUP | select.EPOLLERR):
+                poll_fds.append(fd)
+
+        return poll_fds
+
+    def clean(self):
+        # write what is still queued
+        for fd in list(self.send_bk):
+            try:
+                while not self.flush_fd(fd):
+                    # give up on a peer that stops reading
+                    if not select.select([], [self.map[fd]], [], 5)[1]:
+                        break
+            except Exception as e:
+                pass
+        self.send_bk = {}
+        self.send_len = {}
+
+        try:
+            for client_socket in self.client_socket:
+                if client_socket.fileno() < 0:
+                    continue
+                self.poller.unregister(client_socket.fileno())
+                client_socket.close()
+            self.poller.unregister(self.server_fd)
+            self.socket.close()
+            if self.socket.family == socket.AF_UNIX:
+                os.unlink(self.addr)
+        except Exception as e:
+            pass
\ No newline at end of file
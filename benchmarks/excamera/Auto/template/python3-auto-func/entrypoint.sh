@@ -0,0 +1,6 @@
+#!/bin/sh
+# entrypoint.sh
+
+ulimit -l unlimited
+
+exec python index.py
\ No newline at end of file
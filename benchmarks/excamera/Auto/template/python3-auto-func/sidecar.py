@@ -0,0 +1,700 @@
+import os
+import json
+import uuid
+import socket
+import select
+import logging
+import threading
+import traceback
+from collections import deque, Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from dtc import Client, Server, RDMA, HAS_PYVERBS, SOFT_DEV
+from compress import Compressor
+from consistent import HashTable
+from message_types import *
+from zookeeper import ZookeeperClient
+
+import time
+
+logging.basicConfig(level=logging.INFO)
+
+# shared hostPath volume, same directory for all instances on a node
+IPC_DIR = "/home/app/ipc"
+
+# id of the node, the first instance on a node writes it into the shared volume
+def get_node_id():
+    if not os.path.isdir(IPC_DIR):
+        return None
+    node_path = f"{IPC_DIR}/node"
+    if not os.path.exists(node_path):
+        tmp_path = f"{node_path}.{uuid.uuid4().hex}"
+        with open(tmp_path, "w") as f:
+            f.write(uuid.uuid4().hex)
+        try:
+            # atomic, the file is complete once it has the name
+            os.link(tmp_path, node_path)
+        except FileExistsError as err:
+            pass
+        os.unlink(tmp_path)
+    with open(node_path) as f:
+        return f.read()
+
+class Sidecar:
+    def __init__(self, handle, config):
+        self.func_name = config.func_name
+        # logging.info(self.func_name)
+
+        # RDMA only if pyverbs and the RNIC are available, or over softverbs
+        self.dtc = None
+        rdma_args = config.config.get("rdma", None)
+        if rdma_args and (HAS_PYVERBS or rdma_args.get("ib_dev", None) == SOFT_DEV):
+            try:
+                self.dtc = RDMA(self.func_name, rdma_args)
+            except Exception as e:
+                logging.info(f"{self.func_name}: RDMA disabled, {e}")
+        self.node = get_node_id()
+
+        # handshake with cc
+        workflow_name, grt_address, read_up = self.handshake(config)
+
+        self.fan_in = config.fan_in
+        self.server = Server("0.0.0.0", 6000)
+        self.server.add_dtc(self.cc)
+        # opt-in compression of big messages on slow TCP links, "compress": {} in workflow.json, args in compress.py
+        compress_args = config.config.get("compress", None)
+        self.compressor = Compressor(compress_args) if compress_args is not None else None
+        if self.dtc:
+            self.server.add_comp_ch(self.dtc.comp_ch.fd)
+
+        # upstream funcs on the same node connect to the Unix domain socket
+        self.uds = None
+        if self.node:
+            self.uds = Server(f"{IPC_DIR}/{self.func_id}.sock", None)
+            self.server.poller.register(self.uds.poller.fileno(), select.EPOLLIN)
+
+        # socket or mr_id of upstream func -> index of func
+        self.servers = {}
+        # str(index) -> sockets or mr_ids
+        self.server_index_list = {}
+        for i in range(self.fan_in):
+            self.server_index_list[str(i)] = []
+
+        client_funcs = config.get_clients()
+        self.fan_out = len(client_funcs)
+
+        # get clients from grt
+        clients = self.get_clients_from_grt(grt_address, workflow_name, read_up, client_funcs)
+
+        # connect to all downstream instances at once, each one may still be starting
+        client_infos_all = [client_info for client_infos in clients for client_info in client_infos.values()]
+        if self.dtc:
+            # qps of all RDMA handshakes, in the slot classes of their edges
+            rdma_funcs = [client_func for client_func, client_infos in zip(client_funcs, clients)
+                for client_info in client_infos.values() if client_info["rnic"]]
+            for index, n in Counter(self.dtc.recv_class(client_func) for client_func in rdma_funcs).items():
+                self.dtc.refill(n, index)
+        with ThreadPoolExecutor(max_workers=max(len(client_infos_all), 1)) as executor:
+            connected = iter(list(executor.map(self.dial, client_infos_all)))
+
+        # 2-dim array. 1st are fan-out funcs, 2nd are (func_id, dtc)
+        # tuple[][]: array of (func_id, dtc) for downstream funcs, dtc is a socket or mr_id
+        self.clients = []
+        self.fan_in_clients = config.get_fan_in()
+        # [], hash table for fan_in, int for others
+        self.hash_tables = []
+        # client_id -> dtc
+        self.client_dtcs = {}
+        # fd -> client_id of downstream funcs over TCP, the edges of the compressor
+        self.client_names = {}
+        for client_index, client_infos in enumerate(clients):
+            # client_info: {client_id: {"host", "node", "rnic", "path"}}
+            self.clients.append([])
+            for client_id, client_info in client_infos.items():
+                client_dtc = self.connect(client_id, client_info, next(connected))
+                self.client_dtcs[client_id] = client_dtc
+                if not isinstance(client_dtc, str):
+                    self.client_names[client_dtc.fileno()] = client_id
+                self.clients[client_index].append((client_id, client_dtc))
+
+                if client_index in self.fan_in_clients:
+                    self.hash_tables.append(HashTable())
+                    self.hash_tables[-1].add_server(client_id)
+                else:
+                    self.hash_tables.append(0)
+
+        # worker funcntion
+        self.handle = handle
+        # index of parallel funcs
+        self.index = config.index
+
+        # inputs from upstream funcs
+        self.inputs = {}
+        # save outputs temporarily
+        self.outputs = {}
+        # req_id:index that have wrong hash route, used by servers
+        self.replays = []
+        # req_id:index -> dtc of client, indicate replay client, used by clients
+        self.dtc_map = {}
+
+        self.panic = False
+
+        # new downstream instances connected in the background, (poll_dtc, message, client_info, client)
+        self.scale_ups = deque()
+        # fd -> (poll_dtc, message, mr_id) of new downstream instances over RDMA, routed to once their qp is ready
+        self.pending_clients = {}
+        self.wakeup_r, self.wakeup_w = os.pipe()
+        os.set_blocking(self.wakeup_r, False)
+        self.server.poller.register(self.wakeup_r, select.EPOLLIN)
+
+        self.flush()
+
+    # handshake with cc
+    def handshake(self, config):
+        cc_name = config.cc_name
+        cc_ip = f"{cc_name}.openfaas-fn.svc.cluster.local"
+        cc_port = 6000
+        self.cc = Client(cc_ip, cc_port)
+
+        req = {"func_name": self.func_name, "node": self.node, "rnic": self.dtc is not None}
+        message = Message(type_id=MESSAGE_HANDSHAKE, req_id=None, req=req, index=None)
+        self.cc.send(message)
+
+        response = self.cc.recv()
+
+        handshake_info = response.req
+        self.func_id = handshake_info["func_id"]
+        return handshake_info["workflow_name"], handshake_info["grt_address"], handshake_info["acl"]
+
+    def get_clients_from_grt(self, grt_address, workflow_name, read_up, func_names):
+        zk = ZookeeperClient(grt_address, read_up[0], read_up[1])
+
+        clients = []
+
+        for func_name in func_names:
+            while True:
+                func_instances = json.loads(zk.get_node(f"/{workflow_name}/{func_name}"))
+                if func_instances:
+                    clients.append(func_instances)
+                    break
+                else:
+                    time.sleep(1)
+
+        zk.stop()
+
+        return clients
+
+    # connection to a downstream instance, Unix domain socket on the same node, else TCP,
+    # blocks until the instance accepts, may run in a thread
+    def dial(self, client_info):
+        if self.uds and client_info["node"] == self.node:
+            return Client(client_info["path"], None)
+        return Client(client_info["host"], 6000)
+
+    # add the connection of dial, RDMA over it if both have an RNIC
+    def connect(self, client_id, client_info, client):
+        if self.uds and client_info["node"] == self.node:
+            self.uds.add_dtc(client)
+            client_dtc = client.socket
+            transport = "uds"
+        else:
+            self.server.add_dtc(client)
+            if self.dtc and client_info["rnic"]:
+                # the socket carries the RDMA handshake, data goes over the QP
+                client_name = "-".join(client_id.split("-")[:-1])
+                local_info = self.dtc.prepare_dtc(self.dtc.nqp, peer=client_name)
+                handshake_message = Message(type_id=MESSAGE_HANDSHAKE_RDMA, req_id=None, req=local_info, index=self.dtc.nqp)
+                self.server.send(handshake_message, client.socket)
+                self.dtc.nqp = self.dtc.nqp + 1
+                client_dtc = f"{client.socket.fileno()}-0"
+                transport = "rdma"
+            else:
+                client_dtc = client.socket
+                transport = "tcp"
+
+        logging.info(f"{self.func_name}: {transport} to {client_id}")
+        req = {"server": self.func_id, "client": client_id, "transport": transport}
+        message = Message(type_id=MESSAGE_TRANSPORT, req_id=None, req=req, index=None)
+        self.sender(self.cc.socket, message)
+
+        return client_dtc
+
+    # massage.type_id == MESSAGE_HANDSHAKE_RDMA
+    def handle_handshake_RDMA(self, poll_dtc, message):
+        # socket dtc
+        IDENTITY = str(poll_dtc.fileno())
+        # handshake from upstream
+        if poll_dtc in self.server.client_socket:
+            local_info = self.dtc.prepare_dtc(self.dtc.nqp, remote_info_str=message.req)
+            response = Message(type_id=MESSAGE_HANDSHAKE_RDMA, req_id=None, req=local_info, index=message.index)
+
+            self.dtc.add_dtc(message.req, IDENTITY, self.dtc.nqp)
+
+            self.dtc.nqp = self.dtc.nqp + 1
+
+            self.server.send(response, poll_dtc)
+        # feedback from downstream
+        else:
+            self.dtc.add_dtc(message.req, IDENTITY, message.index)
+            if poll_dtc.fileno() in self.pending_clients:
+                self.route_client(*self.pending_clients.pop(poll_dtc.fileno()))
+
+    def choose_client(self, client_index, req_id):
+        # only 1 client
+        if len(self.clients[client_index]) == 1:
+            return self.clients[client_index][0][1]
+        # multiple clients and fan-in, hash
+        elif client_index in self.fan_in_clients:
+            return self.client_dtcs[self.hash_tables[client_index].get_server(req_id)]
+        # multiple clients but non-fan-in, round-robin
+        else:
+            choose_index = self.hash_tables[client_index]
+            self.hash_tables[client_index] = (self.hash_tables[client_index] + 1) % len(self.clients[client_index])
+            return self.clients[client_index][choose_index][1]
+
+    # select_dtc is socket object or mr_id
+    def sender(self, select_dtc, message):
+        # mr_id
+        if isinstance(select_dtc, str):
+            if select_dtc[-1] == '0':
+                self.dtc.send(select_dtc, message)
+            else:
+                self.dtc.send(f"{select_dtc[:-1]}0", message)
+        # socket object
+        elif select_dtc.family == socket.AF_UNIX:
+            self.uds.send(message, select_dtc)
+        else:
+            if self.compressor:
+                fd = select_dtc.fileno()
+                message = self.compressor.compress(message, self.client_names.get(fd, fd), self.server.get_link_rate(fd))
+            self.server.send(message, select_dtc)
+
+    # one sendmsg per peer for all frames queued so far, one post_send per qp
+    def flush(self):
+        self.server.flush()
+        if self.uds:
+            self.uds.flush()
+        if self.dtc is not None:
+            self.dtc.flush()
+
+    def worker(self, req_id, req):
+        # logging.info("start worker")
+        self.n_req_interval += 1
+        self.n_req += 1
+
+        # do not hold frames already produced while the handler runs
+        self.flush()
+
+        exec_start = time.time()
+
+        try:
+            res = self.handle(req)
+        except Exception as e:
+            traceback.print_exc()
+            self.n_req -= 1
+            return
+
+        # logging.info("finish handle")
+
+        exec_time = time.time() - exec_start
+
+        if self.avg_exec_time:
+            avg_exec_time = (self.avg_exec_time * (self.n_req - 1) + exec_time) / self.n_req
+            self.avg_exec_time = avg_exec_time
+        else:
+            self.avg_exec_time = exec_time
+
+        # logging.info(f"{self.func_name}: {res}")
+
+        if self.fan_out > 0:
+            # encoded once for all downstream funcs and replays, stored until all downstream funcs are ready
+            res = dumps_req(res)
+            self.outputs[req_id] = {"ready": 0, "req": res}
+            message = Message(type_id=MESSAGE_DATA, req_id=req_id, req=res, index=self.index)
+            for client_index in range(self.fan_out):
+                replay_id = f"{req_id}:{client_index}"
+                # sometimes index=0 is not the critical, but still adopt its route
+                if replay_id in self.dtc_map:
+                    self.sender(self.dtc_map[replay_id], message)
+                    self.dtc_map.pop(replay_id, None)
+                else:
+                    # logging.info(f"start send req to client {client_index}")
+                    chosen_client = self.choose_client(client_index, req_id)
+                    self.sender(chosen_client, message)
+                    self.outputs[req_id][str(client_index)] = chosen_client
+        else:
+            # pass
+            # only for getting latency distribution
+            message = Message(type_id=MESSAGE_OVER, req_id=req_id, req=res, index=self.index)
+            self.sender(self.cc.socket, message)
+            # logging.info(f"{self.func_name}: {res}")
+
+    # massage.type_id == MESSAGE_DATA
+    def handle_func_req(self, poll_dtc, message):
+        if poll_dtc not in self.servers:
+            self.servers[poll_dtc] = message.index
+            self.server_index_list[str(message.index)].append(poll_dtc)
+
+        req_id = message.req_id
+
+        if req_id in self.inputs:
+            self.inputs[req_id]["ready"] = self.inputs[req_id]["ready"] + 1
+        else:
+            self.inputs[req_id] = {"ready": 1, "req": [None] * self.fan_in}
+
+        self.inputs[req_id]["req"][message.index] = message.req
+
+        replay_id = f"{req_id}:{message.index}"
+        # complete req
+        if self.inputs[req_id]["ready"] == self.fan_in:
+            # reqs are kept encoded until here, and loaded once for the handler
+            reqs = [load_req(req) for req in self.inputs[req_id]["req"]]
+            if self.fan_in == 1:
+                data = reqs[0]
+            else:
+                if isinstance(reqs[message.index], str):
+                    # merge data for string data
+                    data = json.dumps(reqs)
+                else:
+                    # merge data for non-string data
+                    data = reqs
+
+            self.worker(req_id, data)
+
+            # del self.inputs[req_id]
+            self.inputs.pop(req_id, None)
+
+            # return
+
+            response = Message(type_id=MESSAGE_READY, req_id=req_id, req=None, index=self.index)
+
+            # if replay, notify all upstream clients
+            if replay_id in self.replays:
+                for server_dtc in self.server_index_list[str(message.index)]:
+                    self.sender(server_dtc, response)
+                self.replays.remove(replay_id)
+            # else, only response client
+            else:
+                self.sender(poll_dtc, response)
+        # critical path, ask replay if in panic mode
+        elif message.index == 0 and self.panic:
+            response = Message(type_id=MESSAGE_ROUTE_ERR, req_id=req_id, req=None, index=self.index)
+            # notify all upstream clients
+            for index, req in enumerate(self.inputs[req_id]["req"]):
+                if req is None:
+                    self.replays.append(f"{req_id}:{index}")
+                    for server_dtc in self.server_index_list[str(message.index)]:
+                        self.sender(server_dtc, response)
+        # reply of replay
+        elif replay_id in self.replays:
+            response = Message(type_id=MESSAGE_READY, req_id=req_id, req=None, index=self.index)
+            for server_dtc in self.server_index_list[str(message.index)]:
+                self.sender(server_dtc, response)
+            self.replays.remove(replay_id)
+
+    # massage.type_id == MESSAGE_READY
+    def handle_depends_ready(self, message):
+        req_id = message.req_id
+        # check if del outputs
+        if req_id in self.outputs:
+            self.outputs[req_id]["ready"] = self.outputs[req_id]["ready"] + 1
+
+            if self.outputs[req_id]["ready"] == self.fan_out:
+                # del self.outputs[req_id]
+                self.outputs.pop(req_id, None)
+        else:
+            logging.error("---some wrong here?---")
+
+        # check if del replay
+        replay_id = f"{req_id}:{message.index}"
+        if replay_id in self.replays:
+            self.replays.remove(replay_id)
+        if replay_id in self.dtc_map:
+            # del self.dtc_map[replay_id]
+            self.dtc_map.pop(replay_id, None)
+
+    # massage.type_id == MESSAGE_ROUTE_ERR
+    def handle_route_error(self, poll_dtc, message):
+        req_id = message.req_id
+        # route error, replay
+        if req_id in self.outputs:
+            response = Message(type_id=MESSAGE_DATA, req_id=req_id, req=self.outputs[req_id]["req"], index=self.index)
+            self.sender(poll_dtc, response)
+
+            # ask the original client to delete data
+            del_message = Message(type_id=MESSAGE_DEL, req_id=req_id, req=None, index=None)
+            self.sender(self.outputs[req_id][self.index], del_message)
+        # maybe still execute, store dtc for future
+        else:
+            self.dtc_map[f"{req_id}:{message.index}"] = poll_dtc
+
+    # check if some reqs in stable mode needs replay
+    def check_replay(self):
+        for req_id in self.inputs:
+            response = None
+            # notify all upstream clients
+            for index, req in enumerate(self.inputs[req_id]["req"]):
+                # if critical path has data
+                if index == 0 and req is not None:
+                    break
+                else:
+                    response = Message(type_id=MESSAGE_ROUTE_ERR, req_id=req_id, req=None, index=self.index)
+                if req is None:
+                    self.replays.append(f"{req_id}:{index}")
+                    for server_dtc in self.server_index_list[str(index)]:
+                        self.sender(server_dtc, response)
+
+    # message.type_id == MESSAGE_SERVER_UP or MESSAGE_CLIENT_UP
+    # only MESSAGE_CLIENT_UP, MESSAGE_SERVER_UP happends in connect
+    # zookeeper and the connection run in a thread, the event loop goes on
+    def handle_scale_up(self, poll_dtc, message):
+        threading.Thread(target=self.dial_scale_up, args=(poll_dtc, message), daemon=True).start()
+
+    # connect to the new downstream instance, then wake up the event loop
+    def dial_scale_up(self, poll_dtc, message):
+        try:
+            client_id = (message.req)["func_id"]
+            workflow_name = message.req["workflow_name"]
+            grt_address = message.req["grt_address"]
+            reader_up = message.req["acl"]
+
+            client_name = "-".join(client_id.split("-")[:-1])
+
+            zk = ZookeeperClient(grt_address, reader_up[0], reader_up[1])
+            func_instances = json.loads(zk.get_node(f"/{workflow_name}/{client_name}"))
+            zk.stop()
+
+            client_info = func_instances[client_id]
+            client = self.dial(client_info)
+        except Exception as e:
+            traceback.print_exc()
+            return
+
+        self.scale_ups.append((poll_dtc, message, client_info, client))
+        os.write(self.wakeup_w, b"\0")
+
+    # add the downstream instances connected by dial_scale_up
+    def handle_connected(self):
+        try:
+            os.read(self.wakeup_r, 4096)
+        except BlockingIOError:
+            pass
+        while self.scale_ups:
+            poll_dtc, message, client_info, client = self.scale_ups.popleft()
+            self.add_client(poll_dtc, message, client_info, client)
+
+    def add_client(self, poll_dtc, message, client_info, client):
+        client_id = (message.req)["func_id"]
+
+        client_dtc = self.connect(client_id, client_info, client)
+        if isinstance(client_dtc, str):
+            # choose_client only picks it once add_dtc has created its mrs, in handle_handshake_RDMA
+            self.pending_clients[client.socket.fileno()] = (poll_dtc, message, client_dtc)
+            return
+        self.route_client(poll_dtc, message, client_dtc)
+
+    # the transport to a new downstream instance is ready, route to it
+    def route_client(self, poll_dtc, message, client_dtc):
+        client_id = (message.req)["func_id"]
+
+        self.client_dtcs[client_id] = client_dtc
+        if not isinstance(client_dtc, str):
+            self.client_names[client_dtc.fileno()] = client_id
+        self.clients[message.index].append((client_id, client_dtc))
+
+        if message.index in self.fan_in_clients:
+            self.hash_tables[message.index].add_server(client_id)
+
+        self.panic = True
+
+        response = Message(type_id=MESSAGE_PANIC_OVER, req_id=message.req_id, req=None, index=self.index)
+        self.sender(poll_dtc, response)
+
+        self.check_replay()
+
+    # message.type_id == MESSAGE_SERVER_DOWN or MESSAGE_CLIENT_DOWN
+    def handle_scale_down(self, poll_dtc, message):
+        # del servers; message from upstream func that will exit
+        if message.type_id == MESSAGE_SERVER_DOWN:
+            self.servers.pop(poll_dtc, None)
+            if poll_dtc in self.server_index_list[str(message.index)]:
+                self.server_index_list[str(message.index)].remove(poll_dtc)
+            if isinstance(poll_dtc, str):
+                self.dtc.destroy(poll_dtc[:-2])
+        # del clients; message from cc
+        else:
+            client_id = message.req
+            for fd in [fd for fd, pending in self.pending_clients.items() if pending[1].req["func_id"] == client_id]:
+                del self.pending_clients[fd]
+            client_dtc = self.client_dtcs.pop(client_id, None)
+            if (client_id, client_dtc) in self.clients[message.index]:
+                self.clients[message.index].remove((client_id, client_dtc))
+            if client_dtc is not None and not isinstance(client_dtc, str):
+                self.client_names.pop(client_dtc.fileno(), None)
+            if self.compressor:
+                self.compressor.reset(client_id)
+
+            if message.index in self.fan_in_clients:
+                self.hash_tables[message.index].del_server(client_id)
+
+            self.panic = True
+
+            response = Message(type_id=MESSAGE_PANIC_OVER, req_id=message.req_id, req=None, index=self.index)
+            self.sender(poll_dtc, response)
+
+            self.check_replay()
+
+    # poll_dtc is a closed socket
+    def handle_closed_dtc(self, poll_dtc):
+        # the QP of the socket is gone as well
+        IDENTITY = str(poll_dtc.fileno())
+        server_dtcs = [poll_dtc]
+        if self.dtc and IDENTITY in self.dtc.qps:
+            self.dtc.destroy(IDENTITY)
+            server_dtcs.append(f"{IDENTITY}-1")
+
+        for server_dtc in server_dtcs:
+            server_index = self.servers.pop(server_dtc, None)
+            if server_index is not None:
+                self.server_index_list[str(server_index)].remove(server_dtc)
+
+        for client_id, client_dtc in list(self.client_dtcs.items()):
+            if client_dtc == poll_dtc or client_dtc == f"{IDENTITY}-0":
+                self.client_dtcs.pop(client_id, None)
+                # the next socket on this fd is another edge
+                self.client_names.pop(poll_dtc.fileno(), None)
+                if self.compressor:
+                    self.compressor.reset(client_id)
+                for clients in self.clients:
+                    if (client_id, client_dtc) in clients:
+                        clients.remove((client_id, client_dtc))
+
+    def update_arrival_rate(self):
+        self.arrival_rate = self.n_req_interval * 1.0 / (time.time() - self.start_exec_time - 5)
+
+        if self.arrival_rate > 0:
+            if self.arrival_rate > self.n_req_interval:
+                logging.info(f"{self.func_name}: recv {self.n_req_interval} in {time.time() - self.start_exec_time - 5}s")
+            else:
+                logging.info(f"{self.func_name}: RPS={self.arrival_rate}/s")
+
+            if self.avg_exec_time:
+                logging.info(f"{self.func_name}: QPS={1.0 / self.avg_exec_time}/s")
+
+        send_stats = self.server.get_send_stats()
+        if send_stats["frames"]:
+            logging.info(f"{self.func_name}: sent {send_stats['frames']} frames, "
+                f"{send_stats['frames_per_flush']:.2f} frames/flush, {send_stats['frames_per_syscall']:.2f} frames/syscall")
+
+        if self.compressor:
+            for edge, stats in self.compressor.get_stats().items():
+                link = f"{stats['link'] / 1e6:.1f} MB/s" if stats["link"] else "not limiting"
+                logging.info(f"{self.func_name}: compress to {edge}: {stats['codec']}, "
+                    f"msgs {stats['msgs']}, ratio {stats['ratio']:.3f}, estimated {stats['est']}, link {link}, "
+                    f"raw over loop budget {stats['over_budget']}")
+
+        self.n_req_interval = 0
+        self.start_exec_time = time.time()
+
+    def run(self):
+        self.arrival_rate = None
+        self.start_exec_time = time.time()
+        self.n_req = 0
+        self.n_req_interval = 0
+        self.avg_exec_time = None
+
+        logging.info(f"{self.func_name} LC started")
+
+        flag = True
+        while flag:
+            # busy polling of the cq after RDMA activity
+            busy = self.dtc is not None and self.dtc.busy
+            # wake up in time to resend control messages that are not acked
+            poll_fds = self.server.poll(0 if busy else (self.dtc.timeout(5) if self.dtc else 5))
+            poll_results = []
+            if busy and self.server.comp_ch not in poll_fds:
+                poll_results.extend(self.dtc.poll(wait=False))
+            for fd in poll_fds:
+                # RDMA event
+                if self.dtc and fd == self.server.comp_ch:
+                    dtc_poll_results = self.dtc.poll()
+                    if dtc_poll_results:
+                        poll_results.extend(dtc_poll_results)
+                # Unix domain socket event
+                elif self.uds and fd == self.uds.poller.fileno():
+                    for uds_fd in self.uds.poll():
+                        poll_results.extend(self.uds.poll_fd(uds_fd))
+                # scale up connected
+                elif fd == self.wakeup_r:
+                    self.handle_connected()
+                    self.flush()
+                else:
+                    socket_poll_results = self.server.poll_fd(fd)
+                    poll_results.extend(socket_poll_results)
+
+            if not poll_results:
+                # no message, update arrival rate and create qps for the next scale up
+                if not busy:
+                    self.update_arrival_rate()
+                    if self.dtc:
+                        self.dtc.refill()
+                if self.dtc:
+                    self.dtc.resend()
+                    self.dtc.flush()
+                continue
+            if self.compressor:
+                self.compressor.new_round()
+            for poll_dtc, message in poll_results:
+                if message is None:
+                    self.handle_closed_dtc(poll_dtc)
+                    continue
+
+                if message.type_id == MESSAGE_DATA:
+                    # logging.info("Start handling req")
+                    self.handle_func_req(poll_dtc, message)
+                elif message.type_id == MESSAGE_READY:
+                    self.handle_depends_ready(message)
+                elif message.type_id == MESSAGE_ROUTE_ERR:
+                    self.handle_route_error(poll_dtc, message)
+                elif message.type_id == MESSAGE_DEL:
+                    self.inputs.pop(message.req_id, None)
+                elif message.type_id ==  MESSAGE_HANDSHAKE_RDMA:
+                    self.handle_handshake_RDMA(poll_dtc, message)
+                elif message.type_id == MESSAGE_SERVER_UP or message.type_id == MESSAGE_CLIENT_UP:
+                    self.handle_scale_up(poll_dtc, message)
+                elif message.type_id == MESSAGE_SERVER_DOWN or message.type_id == MESSAGE_CLIENT_DOWN:
+                    self.handle_scale_down(poll_dtc, message)
+                elif message.type_id == MESSAGE_PANIC_OVER:
+                    self.panic = False
+                    logging.info(f"{self.func_name} panic over")
+                elif message.type_id == MESSAGE_EXIT:
+                    flag = False
+                    continue
+
+            # one sendmsg per peer and one post_send per qp for all frames of this iteration
+            self.flush()
+
+        self.quit()
+
+        logging.info(f"{self.func_name} LC closed")
+
+    def quit(self):
+        req = Message(type_id=MESSAGE_CLIENT_DOWN, req_id=None, req=self.func_id, index=self.index)
+        self.sender(self.cc.socket, req)
+
+        req = Message(type_id=MESSAGE_SERVER_DOWN, req_id=None, req=None, index=self.index)
+        if self.fan_out:
+            for client_info in self.clients:
+                for client_id, client_dtc in client_info:
+                    self.sender(client_dtc, req)
+        self.flush()
+
+        if self.dtc:
+            for IDENTITY in list(self.dtc.qps):
+                self.dtc.destroy(IDENTITY)
+
+        self.server.clean()
+        if self.uds:
+            self.uds.clean()
+        os.close(self.wakeup_r)
+        os.close(self.wakeup_w)
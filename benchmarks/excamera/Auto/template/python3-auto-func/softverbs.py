@@ -0,0 +1,701 @@
+"""
+Software stand-in of the pyverbs subset used by dtc.RDMA, for hosts without an RNIC.
+
+It is selected with "ib_dev": "soft" in the rdma args. Each Context binds a Unix datagram
+socket in SOFT_DIR, named by its gid, which is also the fd of its completion channel. Each MR
+is a file in SOFT_DIR that other processes map by its key. Instances on one host, or in one
+process, then talk like over an RNIC: rdma reads and writes copy between the mapped MRs
+without the peer, a send passes (key, addr, len) of its data and the peer copies it into a
+recv buffer and acks it, so the send completes like on a reliable connection.
+Context.stats counts wrs, packets and copied bytes.
+"""
+import os
+import mmap
+import atexit
+import ctypes
+import socket
+import struct
+import random
+import itertools
+from collections import deque, Counter, OrderedDict
+
+__all__ = [
+    "PyverbsRDMAError", "GID", "Context", "PD", "MR", "SGE", "RecvWR", "SendWR", "WC", "CompChannel", "CQ",
+    "QPCap", "QPInitAttr", "QPAttr", "QP", "GlobalRoute", "AHAttr", "AH", "SrqAttr", "SrqInitAttr", "SRQ",
+    "IBV_WR_RDMA_WRITE", "IBV_WR_RDMA_WRITE_WITH_IMM", "IBV_WR_SEND", "IBV_WR_SEND_WITH_IMM", "IBV_WR_RDMA_READ",
+    "IBV_WC_SEND", "IBV_WC_RDMA_WRITE", "IBV_WC_RDMA_READ", "IBV_WC_RECV", "IBV_WC_RECV_RDMA_WITH_IMM",
+    "IBV_WC_SUCCESS", "IBV_WC_LOC_LEN_ERR", "IBV_WC_REM_ACCESS_ERR", "IBV_WC_RETRY_EXC_ERR", "IBV_WC_WITH_IMM",
+    "IBV_SEND_FENCE", "IBV_SEND_SIGNALED", "IBV_SEND_SOLICITED", "IBV_SEND_INLINE",
+    "IBV_QPT_RC", "IBV_QPT_UC", "IBV_QPT_UD",
+    "IBV_ACCESS_LOCAL_WRITE", "IBV_ACCESS_REMOTE_WRITE", "IBV_ACCESS_REMOTE_READ",
+    "IBV_QPS_RESET", "IBV_QPS_INIT", "IBV_QPS_RTR", "IBV_QPS_RTS", "IBV_MTU_1024",
+]
+
+# values of pyverbs.enums
+IBV_WR_RDMA_WRITE = 0
+IBV_WR_RDMA_WRITE_WITH_IMM = 1
+IBV_WR_SEND = 2
+IBV_WR_SEND_WITH_IMM = 3
+IBV_WR_RDMA_READ = 4
+IBV_WC_SEND = 0
+IBV_WC_RDMA_WRITE = 1
+IBV_WC_RDMA_READ = 2
+IBV_WC_RECV = 128
+IBV_WC_RECV_RDMA_WITH_IMM = 129
+IBV_WC_SUCCESS = 0
+IBV_WC_LOC_LEN_ERR = 1
+IBV_WC_REM_ACCESS_ERR = 10
+IBV_WC_RETRY_EXC_ERR = 12
+IBV_WC_WITH_IMM = 2
+IBV_SEND_FENCE = 1
+IBV_SEND_SIGNALED = 2
+IBV_SEND_SOLICITED = 4
+IBV_SEND_INLINE = 8
+IBV_QPT_RC = 2
+IBV_QPT_UC = 3
+IBV_QPT_UD = 4
+IBV_ACCESS_LOCAL_WRITE = 1
+IBV_ACCESS_REMOTE_WRITE = 2
+IBV_ACCESS_REMOTE_READ = 4
+IBV_QPS_RESET = 0
+IBV_QPS_INIT = 1
+IBV_QPS_RTR = 2
+IBV_QPS_RTS = 3
+IBV_MTU_1024 = 3
+
+# sockets and MR files of all instances on the host
+SOFT_DIR = os.environ.get("SOFTVERBS_DIR", "/dev/shm/softverbs" if os.path.isdir("/dev/shm") else "/tmp/softverbs")
+
+# kind, dst qp_num, src qp_num, seq, imm_data, flags, status, key, addr, length of the data in an MR of the sender,
+# key 0 if the data follows the header
+PACKET = struct.Struct("!BIIQIBBIQI")
+PKT_SEND = 0
+PKT_ACK = 1
+PKT_WAKE = 2
+# rdma write with imm, the data is already written
+PKT_IMM = 3
+PKT_WITH_IMM = 1
+MAX_PACKET = 65536
+# the address of an MR in the process that registered it, its length, access and the pid of the process,
+# in the first page of its file
+MR_HEADER = struct.Struct("!QQQI")
+# a ud recv starts with the global routing header
+GRH_SIZE = 40
+# MRs of other processes kept mapped
+MAPPED_MRS = 256
+
+# key -> MR of this process
+_mrs = {}
+# key -> (mmap, address of the MR in its process, access) of MRs of other processes
+_mapped = OrderedDict()
+# contexts of this process, cleaned up at exit
+_contexts = []
+
+def sock_path(gid):
+    return os.path.join(SOFT_DIR, f"{gid}.sock")
+
+def mr_path(key):
+    return os.path.join(SOFT_DIR, f"mr-{key}")
+
+def alive(pid):
+    if pid <= 0:
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+# remove the sockets and MRs of processes that exited without cleanup, e.g. by os._exit
+def sweep():
+    for entry in os.listdir(SOFT_DIR):
+        path = os.path.join(SOFT_DIR, entry)
+        try:
+            if entry.endswith(".sock"):
+                pid = int(entry.rsplit("-", 2)[1])
+            elif entry.startswith("mr-"):
+                with open(path, "rb") as f:
+                    pid = MR_HEADER.unpack(f.read(MR_HEADER.size))[3]
+            else:
+                continue
+            if not alive(pid):
+                os.unlink(path)
+        except (ValueError, IndexError, struct.error, OSError):
+            continue
+
+class PyverbsRDMAError(Exception):
+    pass
+
+# address of length bytes at addr of the MR of key, which may belong to another process,
+# access 0 for the data of a send
+def remote_address(key, addr, length, access):
+    mr = _mrs.get(key, None)
+    if mr is not None:
+        if access and not mr.access & access or addr < mr.buf or addr + length > mr.buf + mr.length:
+            raise PyverbsRDMAError(f"access out of MR {key}")
+        return addr
+
+    if key in _mapped:
+        _mapped.move_to_end(key)
+    else:
+        try:
+            fd = os.open(mr_path(key), os.O_RDWR)
+        except FileNotFoundError:
+            raise PyverbsRDMAError(f"no MR {key}")
+        try:
+            mem = mmap.mmap(fd, os.fstat(fd).st_size)
+        finally:
+            os.close(fd)
+        base, mr_length, mr_access, _ = MR_HEADER.unpack_from(mem, 0)
+        _mapped[key] = (mem, base, mr_access)
+        if len(_mapped) > MAPPED_MRS:
+            _mapped.popitem(last=False)[1][0].close()
+    mem, base, mr_access = _mapped[key]
+    offset = mmap.PAGESIZE + addr - base
+    if access and not mr_access & access or addr < base or offset + length > len(mem):
+        raise PyverbsRDMAError(f"access out of MR {key}")
+    return ctypes.addressof(ctypes.c_char.from_buffer(mem, offset)) if length else 0
+
+class GID:
+    def __init__(self, val=None):
+        self.gid = val
+    def __str__(self):
+        return self.gid
+
+class Context:
+    def __init__(self, name=None, **kwargs):
+        self.name = name
+        os.makedirs(SOFT_DIR, exist_ok=True)
+        sweep()
+        self.gid = f"{name}-{os.getpid()}-{random.getrandbits(32):08x}"
+        self.path = sock_path(self.gid)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.bind(self.path)
+        self.sock.setblocking(False)
+        self.qp_nums = itertools.count(1)
+        # qp_num -> QP
+        self.qps = {}
+        # (path, packet) the kernel did not take yet
+        self.outbox = deque()
+        # a wake packet is on the way
+        self.woken = False
+        # packets are handled by a poll, which also takes the completions they make
+        self.progressing = False
+        self.stats = Counter()
+        _contexts.append(self)
+
+    def query_gid(self, port_num=1, index=0):
+        return GID(self.gid)
+
+    def send(self, path, packet):
+        self.stats["packets"] += 1
+        if not self.outbox:
+            try:
+                self.sock.sendto(packet, path)
+                return True
+            except BlockingIOError:
+                pass
+            except OSError:
+                # the peer is gone
+                return False
+        self.outbox.append((path, packet))
+        # a poll retries it, a post outside of one has to wake the channel for that
+        if not self.progressing:
+            self.wake()
+        return True
+
+    # make the completion channel fd readable, for completions made outside a poll,
+    # e.g. of rdma reads, which complete when posted, and to retry packets of the outbox
+    def wake(self):
+        if self.woken:
+            return
+        try:
+            self.sock.sendto(PACKET.pack(PKT_WAKE, 0, 0, 0, 0, 0, 0, 0, 0, 0), self.path)
+            self.woken = True
+        except OSError:
+            # the socket is full, so it is readable anyway
+            pass
+
+    # send queued packets and handle the received ones
+    def progress(self):
+        self.progressing = True
+        try:
+            while self.outbox:
+                path, packet = self.outbox[0]
+                try:
+                    self.sock.sendto(packet, path)
+                except BlockingIOError:
+                    break
+                except OSError:
+                    pass
+                self.outbox.popleft()
+            while True:
+                try:
+                    packet, path = self.sock.recvfrom(MAX_PACKET)
+                except (BlockingIOError, OSError):
+                    break
+                self.handle(packet, path)
+        finally:
+            self.progressing = False
+        # the peer did not read yet, try again soon
+        if self.outbox:
+            self.wake()
+
+    def handle(self, packet, path):
+        kind, dst, src, seq, imm, flags, status, key, addr, length = PACKET.unpack_from(packet)
+        if kind == PKT_WAKE:
+            self.woken = False
+            return
+        qp = self.qps.get(dst, None)
+        if kind == PKT_ACK:
+            if qp is not None:
+                qp.acked(seq, status)
+            return
+        if qp is None:
+            # no such qp any more, the sender gets an error
+            self.send(path, PACKET.pack(PKT_ACK, src, dst, seq, 0, 0, IBV_WC_RETRY_EXC_ERR, 0, 0, 0))
+            return
+        qp.arrive((kind, src, seq, imm, flags, key, addr, length, packet[PACKET.size:], path))
+
+    def close(self):
+        if self.sock.fileno() < 0:
+            return
+        self.sock.close()
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+@atexit.register
+def cleanup():
+    for ctx in _contexts:
+        ctx.close()
+    for mr in list(_mrs.values()):
+        mr.close()
+
+class PD:
+    def __init__(self, ctx):
+        self.ctx = ctx
+    def close(self):
+        pass
+
+class MR:
+    def __init__(self, pd, length=0, access=0, **kwargs):
+        self.length = length
+        self.access = access
+        while True:
+            self.lkey = random.randrange(1, 1 << 31)
+            try:
+                fd = os.open(mr_path(self.lkey), os.O_RDWR | os.O_CREAT | os.O_EXCL, 0o600)
+                break
+            except FileExistsError:
+                continue
+        self.rkey = self.lkey
+        try:
+            os.ftruncate(fd, mmap.PAGESIZE + max(length, 1))
+            self.mem = mmap.mmap(fd, max(length, 1), offset=mmap.PAGESIZE)
+            self.buf = ctypes.addressof(ctypes.c_char.from_buffer(self.mem))
+            os.pwrite(fd, MR_HEADER.pack(self.buf, length, access, os.getpid()), 0)
+        finally:
+            os.close(fd)
+        _mrs[self.lkey] = self
+
+    def write(self, data, length, offset=0):
+        if isinstance(data, str):
+            data = data.encode()
+        self.mem[offset: offset + length] = data[:length]
+
+    def read(self, length, offset):
+        return self.mem[offset: offset + length]
+
+    def close(self):
+        if _mrs.pop(self.lkey, None) is None:
+            return
+        try:
+            os.unlink(mr_path(self.lkey))
+        except FileNotFoundError:
+            pass
+        try:
+            self.mem.close()
+        except BufferError:
+            # still viewed, unmapped with the object
+            pass
+
+class SGE:
+    def __init__(self, addr, length, lkey):
+        self.addr = addr
+        self.length = length
+        self.lkey = lkey
+
+class RecvWR:
+    def __init__(self, wr_id=0, num_sge=0, sg=None, next_wr=None):
+        self.wr_id = wr_id
+        self.num_sge = num_sge
+        self.sg = list(sg or [])[:num_sge]
+        self.next_wr = next_wr
+
+class SendWR:
+    def __init__(self, wr_id=0, opcode=IBV_WR_SEND, num_sge=0, imm_data=0, sg=None, send_flags=IBV_SEND_SIGNALED,
+            next_wr=None):
+        self.wr_id = wr_id
+        self.opcode = opcode
+        self.num_sge = num_sge
+        self.sg = list(sg or [])[:num_sge]
+        self.imm_data = imm_data
+        self.send_flags = send_flags
+        self.next_wr = next_wr
+
+    def set_wr_rdma(self, rkey, addr):
+        self.rkey = rkey
+        self.remote_addr = addr
+
+    def set_wr_ud(self, ah, rqpn, rqkey):
+        self.ah = ah
+        self.remote_qpn = rqpn
+        self.remote_qkey = rqkey
+
+class WC:
+    def __init__(self, wr_id=0, status=IBV_WC_SUCCESS, opcode=0, byte_len=0, imm_data=0, qp_num=0, src_qp=0, wc_flags=0):
+        self.wr_id = wr_id
+        self.status = status
+        self.opcode = opcode
+        self.byte_len = byte_len
+        self.imm_data = imm_data
+        self.qp_num = qp_num
+        self.src_qp = src_qp
+        self.wc_flags = wc_flags
+
+class CompChannel:
+    def __init__(self, ctx):
+        self.ctx = ctx
+        self.fd = ctx.sock.fileno()
+
+    # does not block, the fd was readable
+    def get_cq_event(self, cq):
+        self.ctx.progress()
+
+    def close(self):
+        self.ctx.close()
+
+class CQ:
+    def __init__(self, ctx, cqe, cq_context=None, comp_channel=None, comp_vector=0):
+        self.ctx = ctx
+        self.cqe = cqe
+        self.comp_ch = comp_channel
+        self.entries = deque()
+
+    def push(self, wc):
+        if len(self.entries) >= self.cqe:
+            raise PyverbsRDMAError("CQ overrun")
+        self.entries.append(wc)
+        if self.comp_ch is not None and not self.ctx.progressing:
+            self.ctx.wake()
+
+    def poll(self, num_entries=1):
+        self.ctx.progress()
+        self.ctx.stats["polls"] += 1
+        wcs = []
+        while self.entries and len(wcs) < num_entries:
+            wcs.append(self.entries.popleft())
+        return len(wcs), wcs
+
+    # every completion outside a poll wakes the channel
+    def req_notify(self, solicited_only=False):
+        pass
+
+    def ack_events(self, num_events):
+        pass
+
+    def resize(self, cqe):
+        if cqe < len(self.entries):
+            raise PyverbsRDMAError("CQ resize below its entries")
+        self.cqe = cqe
+
+    def close(self):
+        pass
+
+class QPCap:
+    def __init__(self, max_send_wr=1, max_recv_wr=10, max_send_sge=1, max_recv_sge=1, max_inline_data=0):
+        self.max_send_wr = max_send_wr
+        self.max_recv_wr = max_recv_wr
+        self.max_send_sge = max_send_sge
+        self.max_recv_sge = max_recv_sge
+        self.max_inline_data = max_inline_data
+
+class QPInitAttr:
+    def __init__(self, qp_type=IBV_QPT_UD, qp_context=None, scq=None, rcq=None, srq=None, cap=None, sq_sig_all=1):
+        self.qp_type = qp_type
+        self.scq = scq
+        self.rcq = rcq
+        self.srq = srq
+        self.cap = cap or QPCap()
+        self.sq_sig_all = sq_sig_all
+
+class QPAttr:
+    def __init__(self, qp_state=IBV_QPS_INIT, cur_qp_state=IBV_QPS_RESET, port_num=1, path_mtu=IBV_MTU_1024):
+        self.qp_state = qp_state
+        self.port_num = port_num
+        self.path_mtu = path_mtu
+        self.qkey = 0
+        self.dest_qp_num = 0
+        self.ah_attr = None
+
+class GlobalRoute:
+    def __init__(self, dgid=None, flow_label=0, sgid_index=0, hop_limit=1, traffic_class=0):
+        self.dgid = dgid
+        self.sgid_index = sgid_index
+
+class AHAttr:
+    def __init__(self, dlid=0, sl=0, src_path_bits=0, static_rate=0, is_global=0, port_num=1, gr=None):
+        self.gr = gr
+        self.is_global = is_global
+        self.port_num = port_num
+
+class AH:
+    def __init__(self, pd, attr=None):
+        self.path = sock_path(str(attr.gr.dgid))
+    def close(self):
+        pass
+
+class SrqAttr:
+    def __init__(self, max_wr=100, max_sge=1, srq_limit=0):
+        self.max_wr = max_wr
+        self.max_sge = max_sge
+        self.srq_limit = srq_limit
+
+class SrqInitAttr:
+    def __init__(self, attr=None):
+        self.attr = attr or SrqAttr()
+
+class SRQ:
+    def __init__(self, pd, init_attr):
+        self.max_wr = init_attr.attr.max_wr
+        self.rq = deque()
+        # qps of the srq, a recv may let them take packets that wait
+        self.qps = []
+
+    def post_recv(self, wr, bad_wr=None):
+        while wr is not None:
+            if len(self.rq) >= self.max_wr:
+                raise PyverbsRDMAError("SRQ full")
+            self.rq.append(wr)
+            wr = wr.next_wr
+        for qp in self.qps:
+            qp.retry()
+
+    def close(self):
+        pass
+
+# bytes of the sges of a wr, in the address space of this process
+def gather(sg):
+    return b"".join(ctypes.string_at(sge.addr, sge.length) for sge in sg)
+
+# copy data into the sges of a recv wr, False if it does not fit
+def scatter(sg, data):
+    if len(data) > sum(sge.length for sge in sg):
+        return False
+    offset = 0
+    for sge in sg:
+        n = min(sge.length, len(data) - offset)
+        if n <= 0:
+            break
+        ctypes.memmove(sge.addr, data[offset: offset + n], n)
+        offset += n
+    return True
+
+class QP:
+    def __init__(self, pd, init_attr, qp_attr=None):
+        self.ctx = pd.ctx
+        self.qp_type = init_attr.qp_type
+        self.scq = init_attr.scq
+        self.rcq = init_attr.rcq
+        self.srq = init_attr.srq
+        self.cap = init_attr.cap
+        self.sq_sig_all = init_attr.sq_sig_all
+        self.qp_num = next(self.ctx.qp_nums)
+        self.rq = deque()
+        # socket path and qp_num of the peer of a connected qp
+        self.remote = None
+        self.qkey = 0
+        self.seq = 0
+        # posted send wrs, [seq, wr_id, wc opcode, signaled, done, status, byte_len], they complete in order
+        self.sq = deque()
+        # packets waiting for a recv wr, like a peer with rnr_retry 7
+        self.backlog = deque()
+        self.closed = False
+        if self.srq is not None:
+            self.srq.qps.append(self)
+        self.ctx.qps[self.qp_num] = self
+
+    def to_rts(self, attr):
+        if self.qp_type == IBV_QPT_UD:
+            self.qkey = attr.qkey
+        else:
+            self.remote = (sock_path(str(attr.ah_attr.gr.dgid)), attr.dest_qp_num)
+
+    def post_recv(self, wr, bad_wr=None):
+        while wr is not None:
+            if len(self.rq) >= self.cap.max_recv_wr:
+                raise PyverbsRDMAError("RQ full")
+            self.rq.append(wr)
+            wr = wr.next_wr
+        self.retry()
+
+    def recv_queue(self):
+        return self.srq.rq if self.srq is not None else self.rq
+
+    def post_send(self, wr, bad_wr=None):
+        stats = self.ctx.stats
+        stats["post_send"] += 1
+        while wr is not None:
+            stats["wrs"] += 1
+            if len(self.sq) >= self.cap.max_send_wr:
+                raise PyverbsRDMAError("SQ full")
+            if wr.send_flags & IBV_SEND_INLINE and sum(sge.length for sge in wr.sg) > self.cap.max_inline_data:
+                raise PyverbsRDMAError("inline data too large")
+            self.execute(wr)
+            wr = wr.next_wr
+        self.complete()
+
+    def execute(self, wr):
+        stats = self.ctx.stats
+        signaled = self.sq_sig_all or wr.send_flags & IBV_SEND_SIGNALED
+        entry = [self.seq, wr.wr_id, IBV_WC_SEND, signaled, False, IBV_WC_SUCCESS, 0]
+        self.sq.append(entry)
+        self.seq += 1
+        imm_flags = PKT_WITH_IMM if wr.opcode in (IBV_WR_SEND_WITH_IMM, IBV_WR_RDMA_WRITE_WITH_IMM) else 0
+
+        if wr.opcode in (IBV_WR_SEND, IBV_WR_SEND_WITH_IMM):
+            stats["sends"] += 1
+            if self.qp_type == IBV_QPT_UD:
+                path, dst = wr.ah.path, wr.remote_qpn
+            else:
+                path, dst = self.remote
+            # the data goes in the packet if inline or small, else the peer copies it from the MR
+            if wr.send_flags & IBV_SEND_INLINE or self.qp_type == IBV_QPT_UD or len(wr.sg) != 1:
+                data = gather(wr.sg)
+                stats["bytes_copied"] += len(data)
+                packet = PACKET.pack(PKT_SEND, dst, self.qp_num, entry[0], wr.imm_data, imm_flags, 0, 0, 0, len(data)) + data
+            else:
+                sge = wr.sg[0]
+                packet = PACKET.pack(PKT_SEND, dst, self.qp_num, entry[0], wr.imm_data, imm_flags, 0, sge.lkey, sge.addr,
+                    sge.length)
+            sent = self.ctx.send(path, packet)
+            # datagrams complete when sent, sends on a connection when the peer acks
+            if self.qp_type == IBV_QPT_UD or not sent:
+                entry[4] = True
+                entry[5] = IBV_WC_SUCCESS if sent else IBV_WC_RETRY_EXC_ERR
+            return
+
+        if wr.opcode in (IBV_WR_RDMA_WRITE, IBV_WR_RDMA_WRITE_WITH_IMM):
+            stats["writes"] += 1
+            entry[2] = IBV_WC_RDMA_WRITE
+            try:
+                addr = wr.remote_addr
+                for sge in wr.sg:
+                    ctypes.memmove(remote_address(wr.rkey, addr, sge.length, IBV_ACCESS_REMOTE_WRITE), sge.addr, sge.length)
+                    addr += sge.length
+                    stats["bytes_copied"] += sge.length
+            except PyverbsRDMAError:
+                entry[4] = True
+                entry[5] = IBV_WC_REM_ACCESS_ERR
+                return
+            length = addr - wr.remote_addr
+            if wr.opcode == IBV_WR_RDMA_WRITE_WITH_IMM:
+                path, dst = self.remote
+                packet = PACKET.pack(PKT_IMM, dst, self.qp_num, entry[0], wr.imm_data, imm_flags, 0, 0, 0, length)
+                if self.ctx.send(path, packet):
+                    return
+            entry[4] = True
+            return
+
+        if wr.opcode == IBV_WR_RDMA_READ:
+            stats["reads"] += 1
+            entry[2] = IBV_WC_RDMA_READ
+            entry[4] = True
+            try:
+                addr = wr.remote_addr
+                for sge in wr.sg:
+                    ctypes.memmove(sge.addr, remote_address(wr.rkey, addr, sge.length, IBV_ACCESS_REMOTE_READ), sge.length)
+                    addr += sge.length
+                    stats["bytes_copied"] += sge.length
+                entry[6] = addr - wr.remote_addr
+            except PyverbsRDMAError:
+                entry[5] = IBV_WC_REM_ACCESS_ERR
+            return
+
+        raise PyverbsRDMAError(f"opcode {wr.opcode} not supported")
+
+    # completions of the send queue, in the order of the wrs
+    def complete(self):
+        while self.sq and self.sq[0][4]:
+            seq, wr_id, opcode, signaled, done, status, byte_len = self.sq.popleft()
+            if signaled or status != IBV_WC_SUCCESS:
+                self.scq.push(WC(wr_id=wr_id, status=status, opcode=opcode, byte_len=byte_len, qp_num=self.qp_num))
+
+    def acked(self, seq, status):
+        for entry in self.sq:
+            if entry[0] == seq:
+                entry[4] = True
+                entry[5] = status
+                break
+        self.complete()
+
+    # a packet of the peer, it waits while there is no recv wr
+    def arrive(self, packet):
+        if self.closed:
+            return
+        if self.qp_type == IBV_QPT_UD:
+            # datagrams are lost without a recv wr
+            if self.recv_queue():
+                self.deliver(packet)
+            else:
+                self.ctx.stats["lost"] += 1
+            return
+        self.backlog.append(packet)
+        self.retry()
+
+    def retry(self):
+        rq = self.recv_queue()
+        while self.backlog and rq:
+            self.deliver(self.backlog.popleft())
+        if self.backlog:
+            self.ctx.stats["rnr"] += 1
+
+    def deliver(self, packet):
+        kind, src, seq, imm, flags, key, addr, length, data, path = packet
+        stats = self.ctx.stats
+        wr = self.recv_queue().popleft()
+        status = IBV_WC_SUCCESS
+        wc_flags = IBV_WC_WITH_IMM if flags & PKT_WITH_IMM else 0
+
+        if kind == PKT_IMM:
+            opcode = IBV_WC_RECV_RDMA_WITH_IMM
+        else:
+            opcode = IBV_WC_RECV
+            if key:
+                try:
+                    data = ctypes.string_at(remote_address(key, addr, length, 0), length) if length else b""
+                except PyverbsRDMAError:
+                    status = IBV_WC_REM_ACCESS_ERR
+                    data = b""
+            if self.qp_type == IBV_QPT_UD:
+                data = bytes(GRH_SIZE) + data
+            if status == IBV_WC_SUCCESS and not scatter(wr.sg, data):
+                status = IBV_WC_LOC_LEN_ERR
+            length = len(data)
+            stats["bytes_copied"] += length
+        stats["recvs"] += 1
+
+        self.rcq.push(WC(wr_id=wr.wr_id, status=status, opcode=opcode, byte_len=length, imm_data=imm, qp_num=self.qp_num,
+            src_qp=src, wc_flags=wc_flags))
+        if self.qp_type != IBV_QPT_UD:
+            self.ctx.send(path, PACKET.pack(PKT_ACK, src, self.qp_num, seq, 0, 0, status, 0, 0, 0))
+
+    def close(self):
+        self.closed = True
+        self.ctx.qps.pop(self.qp_num, None)
+        if self.srq is not None and self in self.srq.qps:
+            self.srq.qps.remove(self)
@@ -14,7 +14,8 @@ def generate_data():
 def generate_reqs(n_req):
     reqs = []
     for i in range(n_req):
-        req_id = str(uuid.uuid4())
+        # 64-bit request id of the binary frame header
+        req_id = uuid.uuid4().int >> 64
         req = {"req_id": req_id}
         message = Message(type_id=MESSAGE_DATA, req_id=req_id, req=req, index=0)
         reqs.append(message)
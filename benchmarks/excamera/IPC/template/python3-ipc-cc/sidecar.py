@@ -31,7 +31,7 @@ class Sidecar:
         self.map = {}
 
         # id for view update, +1 when handle_view_handle is invoked
-        self.update_id = "0"
+        self.update_id = 0
         # update_id: count of instances need to notify when view is updated 
         self.panic_count = {}
 
@@ -124,7 +124,7 @@ class Sidecar:
                         self.panic_ids.append(f"{stage_fn}-{i}")
                         self.panic_count[self.update_id] += 1
 
-        self.update_id = str(int(self.update_id) + 1)
+        self.update_id += 1
 
     def handle_panic_over(self, message):
         if message.req_id in self.panic_count:
@@ -221,7 +221,7 @@ class Sidecar:
 
         self.panic_del_ids[self.update_id] = func_id
 
-        self.update_id = str(int(self.update_id) + 1)
+        self.update_id += 1
 
     def handle_closed_dtc(self, dtc):
         dtc_rf = dtc.rf
@@ -330,6 +330,9 @@ class Sidecar:
         prt.join()
         
         self.socket.close()
+        # blobs the funcs sent through the pipes that were never read
+        for dtc in self.poller.map.values():
+            dtc.sweep()
         self.poller.close()
 
         logging.info("Centralized Coordinator Close")
\ No newline at end of file
@@ -1,11 +1,66 @@
 import os
 import select
 import zmq
-import pickle
 import struct
+import mmap
+import fcntl
+import time
+import uuid
+import ctypes
+
+from message_types import encode, decode
+
+# set in the length prefix if the body is the path of a blob file
+BLOB_FLAG = 1 << 31
+
+# write the buffers of a big message into a file on the shared volume, only its path is sent
+# prefix names the receiver and sender, so blobs that are never read can be swept
+def to_blob(ipc_path, *buffers, prefix=""):
+    path = f"{ipc_path}/{prefix}{uuid.uuid4().hex}.blob"
+    fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o666)
+    try:
+        for data_b in buffers:
+            with memoryview(data_b) as view:
+                offset = 0
+                while offset < len(view):
+                    offset += os.write(fd, view[offset:])
+    finally:
+        os.close(fd)
+    return path.encode()
+
+# map the blob read-only, it is removed as soon as it is opened
+# the map is the frame of the message, it is unmapped once the message and its req are released
+def from_blob(path, loads=decode):
+    fd = os.open(bytes(path), os.O_RDONLY)
+    try:
+        os.unlink(bytes(path))
+        return loads(mmap.mmap(fd, 0, prot=mmap.PROT_READ), owned=True)
+    finally:
+        os.close(fd)
+
+# remove the blobs whose name starts with prefix, left by a receiver or sender that is gone
+def sweep_blobs(ipc_path, prefix):
+    for entry in os.scandir(ipc_path):
+        if entry.name.startswith(prefix) and entry.name.endswith(".blob"):
+            try:
+                os.unlink(entry.path)
+            except FileNotFoundError as err:
+                pass
+
+# prefix of the blobs of a sender for a receiver, or of all blobs for the receiver, func_ids have no dots
+def blob_prefix(receiver, sender=None):
+    if sender is None:
+        return f"{receiver}."
+    return f"{receiver}.{sender}."
 
 class DTC:
-    def __init__(self, read_pipe, write_pipe, ipc_path="/home/app/ipc"):
+    def __init__(self, read_pipe, write_pipe, ipc_path="/home/app/ipc", blob_threshold=256 * 1024):
+        self.ipc_path = ipc_path
+        # messages of at least blob_threshold bytes go through a blob file
+        self.blob_threshold = blob_threshold
+        # the names of the pipes name the receiver and the sender of the blobs
+        self.read_name = read_pipe
+        self.write_name = write_pipe
         self.read_pipe = f"{ipc_path}/{read_pipe}"
         self.write_pipe = f"{ipc_path}/{write_pipe}"
         self.mkfifo(self.read_pipe)
@@ -24,9 +79,16 @@ class DTC:
             pass
 
     def send(self, data_obj):
-        data_b = pickle.dumps(data_obj)
-        header = struct.pack("!I", len(data_b))
-        os.write(self.wf, header + data_b)
+        buffers = encode(data_obj)
+        len_data = sum(map(len, buffers))
+        if len_data >= self.blob_threshold:
+            # the write stays below PIPE_BUF, so it is atomic
+            buffers = [to_blob(self.ipc_path, *buffers, prefix=blob_prefix(self.write_name, self.read_name))]
+            header = struct.pack("!I", len(buffers[0]) | BLOB_FLAG)
+        else:
+            header = struct.pack("!I", len_data)
+        # one write of the header and the buffers, without joining them
+        os.writev(self.wf, [header, *buffers])
 
     def recv(self):
         recv_data_list = []
@@ -40,6 +102,8 @@ class DTC:
                     header_bytes += chunk
 
                 expected_len = struct.unpack("!I", header_bytes)[0]
+                is_blob = expected_len & BLOB_FLAG
+                expected_len &= ~BLOB_FLAG
 
                 recv_data_b = b''
                 while len(recv_data_b) < expected_len:
@@ -48,7 +112,10 @@ class DTC:
                         raise EOFError("Early EOF while reading data body")
                     recv_data_b += chunk
 
-                obj = pickle.loads(recv_data_b)
+                if is_blob:
+                    obj = from_blob(recv_data_b)
+                else:
+                    obj = decode(recv_data_b)
                 recv_data_list.append(obj)
             except BlockingIOError as err:
                 break
@@ -58,6 +125,10 @@ class DTC:
 
         return recv_data_list
 
+    # blobs sent through the read pipe that were never read
+    def sweep(self):
+        sweep_blobs(self.ipc_path, blob_prefix(self.read_name))
+
 class Client(DTC):
     def __init__(self, pipe_name):
         super(Client, self).__init__(pipe_name)
@@ -75,10 +146,10 @@ class Socket:
         self.socket.connect(f"tcp://{ip}")
 
     def send(self, data_obj):
-        self.socket.send(pickle.dumps(data_obj))
+        self.socket.send(b"".join(encode(data_obj)))
 
     def recv(self):
-        return pickle.loads(self.socket.recv())
+        return decode(self.socket.recv())
     
 class SSocket:
     def __init__(self, ip):
@@ -87,10 +158,247 @@ class SSocket:
         self.socket.bind(f"tcp://{ip}")
 
     def send(self, data_obj):
-        self.socket.send(pickle.dumps(data_obj))
+        self.socket.send(b"".join(encode(data_obj)))
 
     def recv(self):
-        return pickle.loads(self.socket.recv())
+        return decode(self.socket.recv())
+
+# mailbox file: header, then a ring of records
+# header: capacity, head (next byte the owner reads), tail (next byte a sender reserves)
+MAILBOX_HEADER = struct.Struct("QQQ")
+MAILBOX_DATA = 64
+# record: state, length of body
+RECORD_HEADER = struct.Struct("II")
+RECORD_STATE = struct.Struct("I")
+RECORD_FREE = 0
+RECORD_READY = 1
+RECORD_PAD = 2
+# body is the path of a blob file
+RECORD_BLOB = 3
+# a body is the length of the sender name, the name and the frame of the message
+SENDER = struct.Struct("!H")
+
+# head and tail are loaded and stored as one aligned word, never seen half written
+def shared_word(mm, offset):
+    return ctypes.c_uint64.from_buffer(mm, offset)
+
+def record_size(len_data):
+    return (RECORD_HEADER.size + len_data + 7) & ~7
+
+# (sender, message) of a record body, owned as for decode
+def loads_record(data_b, owned=False):
+    with memoryview(data_b) as view:
+        start = SENDER.size + SENDER.unpack_from(view, 0)[0]
+        with view[start:] as frame:
+            return str(view[SENDER.size: start], "utf-8"), decode(frame, owned)
+
+# one per instance, all upstream and downstream instances send into it
+# rf/wf are the doorbell FIFO, so the Poller handles it like a DTC
+class Mailbox:
+    def __init__(self, name, ipc_path="/home/app/ipc", capacity=16 * 1024 * 1024, stall_timeout=5):
+        self.ipc_path = ipc_path
+        self.path = f"{ipc_path}/{name}.mbx"
+        self.bell = f"{ipc_path}/{name}.bell"
+        self.capacity = capacity
+
+        try:
+            if not os.path.exists(self.bell):
+                os.mkfifo(self.bell)
+        except FileExistsError as err:
+            pass
+        self.rf = os.open(self.bell, os.O_RDONLY | os.O_NONBLOCK)
+        # keep a writer, so the FIFO never reports EOF when senders come and go
+        self.wf = os.open(self.bell, os.O_RDWR | os.O_NONBLOCK)
+
+        # senders only open a fully initialized file
+        tmp_path = f"{self.path}.{os.getpid()}"
+        self.fd = os.open(tmp_path, os.O_CREAT | os.O_TRUNC | os.O_RDWR, 0o666)
+        os.ftruncate(self.fd, MAILBOX_DATA + capacity)
+        self.mm = mmap.mmap(self.fd, MAILBOX_DATA + capacity)
+        MAILBOX_HEADER.pack_into(self.mm, 0, capacity, 0, 0)
+        self.shared_head = shared_word(self.mm, 8)
+        self.shared_tail = shared_word(self.mm, 16)
+        os.rename(tmp_path, self.path)
+
+        self.head = 0
+        # a record still reserved after stall_timeout seconds belongs to a sender that died, it is skipped
+        self.stall_timeout = stall_timeout
+        self.stall_deadline = None
+        # recv stopped at a record that is still being copied, the Poller polls it again on a short tick
+        self.pending = False
+        self.IDENTITY = name
+
+    def ring(self):
+        try:
+            while os.read(self.rf, 4096):
+                pass
+        except BlockingIOError as err:
+            pass
+
+    # list of (sender, message)
+    def recv(self):
+        self.ring()
+
+        recv_data_list = []
+        self.pending = False
+        while True:
+            tail = self.shared_tail.value
+            while self.head < tail:
+                offset = self.head % self.capacity
+                state, len_data = RECORD_HEADER.unpack_from(self.mm, MAILBOX_DATA + offset)
+                if state == RECORD_FREE:
+                    # reserved, the sender is still copying, return what was read and pick it up later
+                    if self.stall_deadline is None:
+                        self.stall_deadline = time.time() + self.stall_timeout
+                    if time.time() < self.stall_deadline:
+                        self.pending = True
+                        break
+                    # the length is written at reserve, so the record can be skipped
+                    print(f"[recv error] skip record of {len_data} bytes at {self.head} in mailbox {self.IDENTITY}, its sender stalled")
+                self.stall_deadline = None
+                if state == RECORD_READY or state == RECORD_BLOB:
+                    data_start = MAILBOX_DATA + offset + RECORD_HEADER.size
+                    with memoryview(self.mm)[data_start: data_start + len_data] as data_b:
+                        if state == RECORD_BLOB:
+                            try:
+                                recv_data_list.append(from_blob(data_b, loads_record))
+                            except FileNotFoundError as err:
+                                # swept after its sender scaled down
+                                print(f"[recv error] {err}")
+                        else:
+                            recv_data_list.append(loads_record(data_b))
+                self.head += record_size(len_data)
+
+            # publish head and check for records reserved meanwhile, senders ring only if they found it empty
+            fcntl.lockf(self.fd, fcntl.LOCK_EX, MAILBOX_DATA, 0)
+            try:
+                self.shared_head.value = self.head
+                tail = self.shared_tail.value
+            finally:
+                fcntl.lockf(self.fd, fcntl.LOCK_UN, MAILBOX_DATA, 0)
+            if self.pending or tail == self.head:
+                break
+
+        return recv_data_list
+
+    # blobs sent by a func that scaled down or crashed and are not in the mailbox are never read
+    def sweep(self, sender):
+        sweep_blobs(self.ipc_path, blob_prefix(self.IDENTITY, sender))
+
+    def close(self):
+        for path in [self.path, self.bell]:
+            try:
+                os.unlink(path)
+            except FileNotFoundError as err:
+                pass
+        # nobody reads the blobs that are left for this instance
+        sweep_blobs(self.ipc_path, blob_prefix(self.IDENTITY))
+        # the map cannot be closed while the words point into it
+        del self.shared_head, self.shared_tail
+        self.mm.close()
+        os.close(self.fd)
+
+# sender side of the mailbox of another instance
+class Peer:
+    def __init__(self, sender, name, ipc_path="/home/app/ipc", blob_threshold=256 * 1024, open_timeout=10, full_timeout=10):
+        self.sender = sender
+        self.ipc_path = ipc_path
+        # messages of at least blob_threshold bytes go through a blob file
+        self.blob_threshold = blob_threshold
+        self.path = f"{ipc_path}/{name}.mbx"
+        self.bell = f"{ipc_path}/{name}.bell"
+        self.mm = None
+        self.open_timeout = open_timeout
+        # the owner has not made room after full_timeout seconds, it is stuck or sends into this mailbox too
+        self.full_timeout = full_timeout
+        self.IDENTITY = name
+
+    # the owner may not have created its mailbox yet, or it is gone
+    def open(self):
+        deadline = time.time() + self.open_timeout
+        while not os.path.exists(self.path):
+            if time.time() > deadline:
+                raise TimeoutError(f"no mailbox {self.IDENTITY} after {self.open_timeout}s")
+            time.sleep(0.01)
+        self.fd = os.open(self.path, os.O_RDWR)
+        self.mm = mmap.mmap(self.fd, 0)
+        self.capacity = MAILBOX_HEADER.unpack_from(self.mm, 0)[0]
+        self.shared_head = shared_word(self.mm, 8)
+        self.shared_tail = shared_word(self.mm, 16)
+        self.wf = os.open(self.bell, os.O_RDWR | os.O_NONBLOCK)
+
+    # reserve space under a short lock, copy outside of it
+    def reserve(self, len_data):
+        need = record_size(len_data)
+        if need > self.capacity:
+            raise ValueError(f"message of {len_data} bytes does not fit in mailbox {self.IDENTITY}")
+
+        deadline = None
+        while True:
+            fcntl.lockf(self.fd, fcntl.LOCK_EX, MAILBOX_DATA, 0)
+            try:
+                capacity, head, tail = self.capacity, self.shared_head.value, self.shared_tail.value
+                offset = tail % capacity
+                pad = capacity - offset if offset + need > capacity else 0
+                if tail + pad + need - head <= capacity:
+                    if pad:
+                        RECORD_HEADER.pack_into(self.mm, MAILBOX_DATA + offset, RECORD_PAD, pad - RECORD_HEADER.size)
+                    # the slot may hold bytes of an older record, the owner waits until it is ready
+                    # the length is valid before tail is published, send only flips the state
+                    RECORD_HEADER.pack_into(self.mm, MAILBOX_DATA + (tail + pad) % capacity, RECORD_FREE, len_data)
+                    self.shared_tail.value = tail + pad + need
+                    return (tail + pad) % capacity, head == tail
+            finally:
+                fcntl.lockf(self.fd, fcntl.LOCK_UN, MAILBOX_DATA, 0)
+            # full, wait for the owner
+            if deadline is None:
+                deadline = time.time() + self.full_timeout
+            elif time.time() > deadline:
+                raise TimeoutError(f"mailbox {self.IDENTITY} still full after {self.full_timeout}s")
+            time.sleep(0.001)
+
+    def send(self, data_obj):
+        if self.mm is None:
+            self.open()
+        sender_b = self.sender.encode()
+        buffers = [SENDER.pack(len(sender_b)), sender_b, *encode(data_obj)]
+        state = RECORD_READY
+        if sum(map(len, buffers)) >= self.blob_threshold:
+            buffers = [to_blob(self.ipc_path, *buffers, prefix=blob_prefix(self.IDENTITY, self.sender))]
+            state = RECORD_BLOB
+        len_data = sum(map(len, buffers))
+        try:
+            offset, empty = self.reserve(len_data)
+        except TimeoutError:
+            if state == RECORD_BLOB:
+                os.unlink(bytes(buffers[0]))
+            raise
+
+        # the buffers are copied into the record one after the other
+        data_start = MAILBOX_DATA + offset + RECORD_HEADER.size
+        for data_b in buffers:
+            self.mm[data_start: data_start + len(data_b)] = data_b
+            data_start += len(data_b)
+        # commit after the copy with a write of the state word alone, the length is set by reserve
+        RECORD_STATE.pack_into(self.mm, MAILBOX_DATA + offset, state)
+
+        if empty:
+            try:
+                os.write(self.wf, b"\0")
+            except BlockingIOError as err:
+                # bell is full, the owner is woken anyway
+                pass
+
+    # sweep the blobs this sender left for a receiver that scaled down
+    def close(self, sweep=False):
+        if self.mm is not None:
+            del self.shared_head, self.shared_tail
+            self.mm.close()
+            os.close(self.fd)
+            os.close(self.wf)
+            self.mm = None
+        if sweep:
+            sweep_blobs(self.ipc_path, blob_prefix(self.IDENTITY, self.sender))
 
 class Poller:
     def __init__(self):
@@ -107,9 +415,11 @@ class Poller:
         self.map.pop(dtc.rf, None)
 
     def poll(self):
-        events = dict(self.poller.poll(timeout=5))
+        # a mailbox that stopped at a record still being copied is read again after a short tick
+        pending = [dtc for dtc in self.map.values() if getattr(dtc, "pending", False)]
+        events = dict(self.poller.poll(timeout=0.001 if pending else 5))
         dtcs = [self.map[rf] for rf in events]
-        return dtcs
+        return dtcs + [dtc for dtc in pending if dtc not in dtcs]
     
     def close(self):
         for dtc in self.map.values():
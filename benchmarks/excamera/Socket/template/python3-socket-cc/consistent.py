@@ -23,8 +23,9 @@ class HashTable:
             self.worker_list.remove(worker_hash)
             del self.worker_table[worker_hash]
 
+    # source_key is a req_id, int or str
     def get_server(self, source_key):
-        key_hash = get_hash(source_key)
+        key_hash = get_hash(str(source_key))
         index = bisect.bisect_left(self.worker_list, key_hash)
         index = index % len(self.worker_list)
         return self.worker_table[self.worker_list[index]]
@@ -0,0 +1,188 @@
+import time
+import zlib
+import lzma
+from collections import Counter
+
+from message_types import MESSAGE_DATA, CODEC_NONE, CODEC_ZLIB, CODEC_LZMA, Message, Encoded, dumps_req, decompress
+
+CODECS = {"zlib": CODEC_ZLIB, "lzma": CODEC_LZMA}
+CODEC_NAMES = {CODEC_NONE: "raw", CODEC_ZLIB: "zlib", CODEC_LZMA: "lzma"}
+
+# one buffer of the payload buffers compressed with codec
+def compress(codec, buffers, args):
+    if codec == CODEC_ZLIB:
+        compressor = zlib.compressobj(args["zlib_level"])
+    else:
+        compressor = lzma.LZMACompressor(preset=args["lzma_preset"])
+    data = [compressor.compress(data_b) for data_b in buffers]
+    data.append(compressor.flush())
+    return b"".join(data)
+
+# the first n bytes of the buffers
+def head(buffers, n):
+    data = []
+    for data_b in buffers:
+        if n <= 0:
+            break
+        data.append(data_b[:n])
+        n -= len(data_b)
+    return b"".join(data)
+
+# compression of MESSAGE_DATA per edge, only if compress time plus transfer time beats raw transfer:
+# for every codec, an edge samples the ratio and speed on its messages, and the link rate is the one
+# the Server measured while the queue of the edge was blocked, an edge whose queue keeps up sends raw.
+# it runs on the event loop, so compressing and sampling take at most loop_budget seconds per iteration
+class Compressor:
+    def __init__(self, args):
+        self.args = {
+            # smaller messages are sent raw without sampling
+            "min_bytes": 64 * 1024,
+            # bytes of a message compressed to sample a codec, every sample_every messages of an edge
+            "sample_bytes": 64 * 1024,
+            "sample_every": 16,
+            # seconds a link rate is used, then the edge sends raw until its queue blocks again
+            "rate_ttl": 10,
+            "codecs": ["zlib", "lzma"],
+            "zlib_level": 1,
+            "lzma_preset": 0,
+            # weight of a new sample in the estimates
+            "alpha": 0.25,
+            # seconds of compressing and sampling per iteration of the event loop, later messages are sent raw
+            "loop_budget": 0.01,
+        }
+        self.args.update(args)
+        self.codecs = [CODECS[name] for name in self.args["codecs"]]
+
+        # edge, the func_id of the peer -> {"n": messages, "est": {codec: ratio, speed and decompress speed},
+        # "codec": last decision, "link": last link rate, "msgs": Counter of codecs, "bytes_in", "bytes_out",
+        # "over_budget": messages sent raw since the loop budget was spent}
+        self.edges = {}
+        # last message and codec -> (its req encoded with codec, seconds to compress), a fan-out sends it to several edges
+        self.last_message = None
+        self.last = {}
+        # seconds spent in this iteration of the event loop
+        self.spent = 0
+
+    # a new iteration of the event loop
+    def new_round(self):
+        self.spent = 0
+
+    # the peer of the edge is gone, a new one on its fd starts from scratch
+    def reset(self, edge):
+        self.edges.pop(edge, None)
+
+    def get_edge(self, edge):
+        if edge not in self.edges:
+            self.edges[edge] = {"n": 0, "est": {}, "codec": CODEC_NONE, "link": None, "msgs": Counter(),
+                "bytes_in": 0, "bytes_out": 0, "over_budget": 0}
+        return self.edges[edge]
+
+    def encoded(self, message, codec):
+        if message is not self.last_message:
+            self.last_message = message
+            self.last = {CODEC_NONE: (dumps_req(message.req), 0)}
+        if codec not in self.last:
+            raw = self.last[CODEC_NONE][0]
+            start = time.time()
+            data = compress(codec, raw.buffers, self.args)
+            self.last[codec] = (Encoded(raw.flags, [data], codec), time.time() - start)
+            self.spent += self.last[codec][1]
+        return self.last[codec]
+
+    def update(self, edge, codec, sample):
+        alpha = self.args["alpha"]
+        est = edge["est"].get(codec, None)
+        if est is None:
+            edge["est"][codec] = sample
+            return
+        for key, value in sample.items():
+            est[key] = (1 - alpha) * est[key] + alpha * value
+
+    def sample(self, edge, raw):
+        data = head(raw.buffers, self.args["sample_bytes"])
+        for codec in self.codecs:
+            start = time.time()
+            compressed = compress(codec, [data], self.args)
+            end = time.time()
+            decompress(codec, compressed)
+            self.spent += time.time() - start
+            self.update(edge, codec, {"ratio": len(compressed) / len(data),
+                "speed": len(data) / max(end - start, 1e-9), "dspeed": len(data) / max(time.time() - end, 1e-9)})
+
+    # codec with the least compress, transfer and decompress time for n bytes at rate bytes/s
+    def choose(self, edge, n, rate):
+        best = CODEC_NONE
+        best_time = n / rate
+        for codec, est in edge["est"].items():
+            codec_time = n / est["speed"] + n * est["ratio"] / rate + n / est["dspeed"]
+            if codec_time < best_time:
+                best = codec
+                best_time = codec_time
+        return best
+
+    # message to send on edge, link is Server.get_link_rate of the edge
+    def compress(self, message, edge, link):
+        if message.type_id != MESSAGE_DATA or message.req is None:
+            return message
+        # already compressed by the sender
+        if type(message.req) is Encoded and message.req.codec != CODEC_NONE:
+            return message
+        edge = self.get_edge(edge)
+        # the queue of the edge keeps up, the transport encodes the message as usual
+        if link is None or time.time() - link[1] >= self.args["rate_ttl"]:
+            edge["codec"] = CODEC_NONE
+            edge["link"] = None
+            edge["msgs"][CODEC_NONE] += 1
+            return message
+        edge["link"] = link[0]
+        raw = self.encoded(message, CODEC_NONE)[0]
+        n = sum(map(len, raw.buffers))
+
+        codec = CODEC_NONE
+        if n >= self.args["min_bytes"]:
+            # no codec compresses faster than the link sends, until the link gets slower
+            if edge["n"] % self.args["sample_every"] == 0 and (not edge["est"] or
+                    any(est["speed"] > link[0] for est in edge["est"].values())) and \
+                    self.spent < self.args["loop_budget"]:
+                self.sample(edge, raw)
+            edge["n"] += 1
+            codec = self.choose(edge, n, link[0])
+            # other edges and the cc wait for the event loop, unless another edge of a fan-out compressed it already
+            if codec != CODEC_NONE and codec not in self.last and self.spent >= self.args["loop_budget"]:
+                edge["over_budget"] += 1
+                codec = CODEC_NONE
+
+        edge["codec"] = codec
+        edge["msgs"][codec] += 1
+        edge["bytes_in"] += n
+        if codec == CODEC_NONE:
+            edge["bytes_out"] += n
+            return Message(type_id=message.type_id, req_id=message.req_id, req=raw, index=message.index)
+
+        compressed, seconds = self.encoded(message, codec)
+        n_out = len(compressed.buffers[0])
+        edge["bytes_out"] += n_out
+        # the decompress speed is only sampled
+        self.update(edge, codec, {"ratio": n_out / n, "speed": n / max(seconds, 1e-9)})
+        return Message(type_id=message.type_id, req_id=message.req_id, req=compressed, index=message.index)
+
+    # per edge, decision of the last message, messages per codec and bytes out / bytes in since the last call,
+    # estimated ratio per codec and link rate in bytes/s, None if the link kept up
+    def get_stats(self):
+        stats = {}
+        for edge_id, edge in self.edges.items():
+            if not edge["msgs"]:
+                continue
+            stats[edge_id] = {
+                "codec": CODEC_NAMES[edge["codec"]],
+                "msgs": {CODEC_NAMES[codec]: n for codec, n in edge["msgs"].items()},
+                "ratio": edge["bytes_out"] / edge["bytes_in"] if edge["bytes_in"] else 1.0,
+                "est": {CODEC_NAMES[codec]: round(est["ratio"], 3) for codec, est in edge["est"].items()},
+                "link": edge["link"],
+                "over_budget": edge["over_budget"],
+            }
+            edge["msgs"] = Counter()
+            edge["over_budget"] = 0
+            edge["bytes_in"] = 0
+            edge["bytes_out"] = 0
+        return stats
@@ -3,6 +3,7 @@ import logging
 import traceback
 
 from dtc import Client, Server
+from compress import Compressor
 from consistent import HashTable
 from message_types import *
 from zookeeper import ZookeeperClient
@@ -20,8 +21,13 @@ class Sidecar:
         workflow_name, grt_address, read_up = self.handshake(config)
 
         self.fan_in = config.fan_in
-        self.server = Server("0.0.0.0", 6000)
+        # opt-in MSG_ZEROCOPY for big frames, "socket": {"zerocopy_threshold": bytes} in workflow.json
+        socket_args = config.config.get("socket", {})
+        self.server = Server("0.0.0.0", 6000, zerocopy_threshold=socket_args.get("zerocopy_threshold", None))
         self.server.add_dtc(self.cc)
+        # opt-in compression of big messages on slow links, "compress": {} in workflow.json, args in compress.py
+        compress_args = config.config.get("compress", None)
+        self.compressor = Compressor(compress_args) if compress_args is not None else None
 
         # fd of upstream func -> index of func
         self.servers = {}
@@ -44,6 +50,8 @@ class Sidecar:
         self.hash_tables = []
         # client_id - > ip
         self.client_ips = {}
+        # fd -> client_id, the edges of the compressor
+        self.client_names = {}
         for client_index, client_infos in enumerate(clients):
             # client_info: {client_id: client_host}
             self.clients.append([])
@@ -52,6 +60,7 @@ class Sidecar:
                 client = Client(client_host, 6000)
                 self.server.add_dtc(client)
                 self.clients[client_index].append((client_id, client.socket.fileno()))
+                self.client_names[client.socket.fileno()] = client_id
                 
                 if client_index in self.fan_in_clients:
                     self.hash_tables.append(HashTable())
@@ -118,15 +127,22 @@ class Sidecar:
             client_ip = self.client_ips[self.hash_tables[client_index].get_server(req_id)]
             client_fd = self.server.pam[client_ip]
         # multiple clients but non-fan-in, round-robin
+        # skip clients whose outbound queue is above the high-water mark
         else:
-            choose_index = self.hash_tables[client_index]
-            self.hash_tables[client_index] = (self.hash_tables[client_index] + 1) % len(self.clients[client_index])
-            client_fd = self.clients[client_index][choose_index][1]
+            for i in range(len(self.clients[client_index])):
+                choose_index = self.hash_tables[client_index]
+                self.hash_tables[client_index] = (self.hash_tables[client_index] + 1) % len(self.clients[client_index])
+                client_fd = self.clients[client_index][choose_index][1]
+                if not self.server.is_congested(client_fd):
+                    break
 
         return self.server.map[client_fd]
 
     # select_dtc is socket object
     def sender(self, select_dtc, message):
+        if self.compressor:
+            fd = select_dtc.fileno()
+            message = self.compressor.compress(message, self.client_names.get(fd, fd), self.server.get_link_rate(fd))
         self.server.send(message, select_dtc)
 
     def worker(self, req_id, req):
@@ -134,6 +150,9 @@ class Sidecar:
         self.n_req_interval += 1
         self.n_req += 1
 
+        # do not hold frames already produced while the handler runs
+        self.server.flush()
+
         exec_start = time.time()
 
         try:
@@ -156,7 +175,8 @@ class Sidecar:
         # logging.info(f"{self.func_name}: {res}")
 
         if self.fan_out > 0:
-            # store result until all downstream funcs are ready
+            # encoded once for all downstream funcs and replays, stored until all downstream funcs are ready
+            res = dumps_req(res)
             self.outputs[req_id] = {"ready": 0, "req": res}
             message = Message(type_id=MESSAGE_DATA, req_id=req_id, req=res, index=self.index)
             for client_index in range(self.fan_out):
@@ -174,7 +194,7 @@ class Sidecar:
             # pass
             # only for getting latency distribution
             message = Message(type_id=MESSAGE_OVER, req_id=req_id, req=res, index=self.index)
-            self.cc.send(message)
+            self.sender(self.cc.socket, message)
             # logging.info(f"{self.func_name}: {res}")
 
     # massage.type_id == MESSAGE_DATA
@@ -200,15 +220,17 @@ class Sidecar:
         replay_id = f"{req_id}:{message.index}"
         # complete req
         if self.inputs[req_id]["ready"] == self.fan_in:
+            # reqs are kept encoded until here, and loaded once for the handler
+            reqs = [load_req(req) for req in self.inputs[req_id]["req"]]
             if self.fan_in == 1:
-                data = self.inputs[req_id]["req"][0]
+                data = reqs[0]
             else:
-                if isinstance(message.req, str):
+                if isinstance(reqs[message.index], str):
                     # merge data for string data
-                    data = json.dumps(self.inputs[req_id]["req"])
+                    data = json.dumps(reqs)
                 else:
                     # merge data for non-string data
-                    data = self.inputs[req_id]["req"]
+                    data = reqs
 
             self.worker(req_id, data)
 
@@ -317,6 +339,7 @@ class Sidecar:
         client = Client(client_ip, 6000)
         self.server.add_dtc(client)
         self.clients[message.index].append((client_id, client.socket.fileno()))
+        self.client_names[client.socket.fileno()] = client_id
 
         if message.index in self.fan_in_clients:
             self.hash_tables[message.index].add_server(client_id)
@@ -341,6 +364,9 @@ class Sidecar:
             client_ip = self.client_ips[client_id]
             client_fd = self.server.pam[client_ip]
             self.clients[message.index].remove((client_id, client_fd))
+            self.client_names.pop(client_fd, None)
+            if self.compressor:
+                self.compressor.reset(client_id)
             # self.server.del_dtc(self.server.map[client_fd])
 
             if message.index in self.fan_in_clients:
@@ -355,6 +381,10 @@ class Sidecar:
 
     def handle_closed_socket(self, poll_dtc):
         dtc_fd = poll_dtc.fileno()
+        # the next socket on this fd is another edge
+        client_id = self.client_names.pop(dtc_fd, None)
+        if client_id is not None and self.compressor:
+            self.compressor.reset(client_id)
         if dtc_fd in self.servers:
             self.servers.pop(dtc_fd, None)
             indexs = [k for k, v in self.server_index_list.items() if dtc_fd in v]
@@ -373,6 +403,22 @@ class Sidecar:
             if self.avg_exec_time:
                 logging.info(f"{self.func_name}: QPS={1.0 / self.avg_exec_time}/s")
 
+        if self.server.congested:
+            congested = [self.server.address.get(fd, fd) for fd in self.server.congested]
+            logging.info(f"{self.func_name}: congested clients {congested}")
+
+        send_stats = self.server.get_send_stats()
+        if send_stats["frames"]:
+            logging.info(f"{self.func_name}: sent {send_stats['frames']} frames, "
+                f"{send_stats['frames_per_flush']:.2f} frames/flush, {send_stats['frames_per_syscall']:.2f} frames/syscall")
+
+        if self.compressor:
+            for edge, stats in self.compressor.get_stats().items():
+                link = f"{stats['link'] / 1e6:.1f} MB/s" if stats["link"] else "not limiting"
+                logging.info(f"{self.func_name}: compress to {edge}: {stats['codec']}, "
+                    f"msgs {stats['msgs']}, ratio {stats['ratio']:.3f}, estimated {stats['est']}, link {link}, "
+                    f"raw over loop budget {stats['over_budget']}")
+
         self.n_req_interval = 0
         self.start_exec_time = time.time()
 
@@ -392,6 +438,8 @@ class Sidecar:
                 # no message, update arrival rate
                 self.update_arrival_rate()
                 continue
+            if self.compressor:
+                self.compressor.new_round()
             for poll_dtc, message in poll_results:
                 if message is None:
                     self.handle_closed_socket(poll_dtc)
@@ -417,13 +465,16 @@ class Sidecar:
                     flag = False
                     continue
 
+            # one sendmsg per peer for all frames of this iteration
+            self.server.flush()
+
         self.quit()
 
         logging.info(f"{self.func_name} LC closed")
 
     def quit(self):
         req = Message(type_id=MESSAGE_CLIENT_DOWN, req_id=None, req=self.func_id, index=self.index)
-        self.cc.send(req)
+        self.sender(self.cc.socket, req)
 
         req = Message(type_id=MESSAGE_SERVER_DOWN, req_id=None, req=None, index=self.index)
         if self.fan_out:
@@ -0,0 +1,10 @@
+from .handler import handle
+
+# Test your handler here
+
+# To disable testing, you can set the build_arg `TEST_ENABLED=false` on the CLI or in your stack.yml
+# https://docs.openfaas.com/reference/yaml/#function-build-args-build-args
+
+def test_handle():
+    # assert handle("input") == "input"
+    pass
@@ -0,0 +1,10 @@
+def handle(req):
+    """handle a request to the function
+    Args:
+        req: result of the upstream func, the list of results of the upstream funcs in a fan-in stage,
+            or the request sent by the entry, any picklable object
+    Returns:
+        the result, any picklable object, it is encoded once on the way to the downstream funcs
+    """
+
+    return req
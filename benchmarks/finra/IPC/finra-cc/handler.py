@@ -10,8 +10,8 @@ def get_lat_dist(lats, dag):
     Calculate the latency distribution from the list of latencies.
     Args:
         lats: [(message_data, timestamp)]
-        - message_data.req_id: str, request id
-        - message_data.req: str, request result of a final stage func
+        - message_data.req_id: int, request id
+        - message_data.req: dict, request result of a final stage func, or its JSON str
         - timestamp: float, timestamp of receiving the message, in seconds
 
         dag: list of stages in the workflow, each stage is a list of function names
@@ -20,7 +20,7 @@ def get_lat_dist(lats, dag):
     """
     valid_lats = []
     for message, recv_time in lats:
-        res_j = json.loads(message.req)
+        res_j = json.loads(message.req) if isinstance(message.req, str) else message.req
         valid_lats.append(recv_time * 1000 - res_j["workflowStartTime"])
 
     valid_lats.sort()
@@ -5,10 +5,10 @@ from function.util import *
 def handle(req):
     """handle a request to the function
     Args:
-        req (str): request body
+        req (dict): request body
     """
 
-    event = json.loads(req)
+    event = req
 
     startTime = 1000*time.time()
 
@@ -27,4 +27,4 @@ def handle(req):
 
     response = {'statusCode': 200, 'body': {'valid':valid, 'portfolio': portfolio}}
     endTime = 1000*time.time()
-    return json.dumps(timestamp(response, event, startTime, endTime, 0))
+    return timestamp(response, event, startTime, endTime, 0)
@@ -1,8 +1,9 @@
 import json
 import logging
+import os
 import traceback
 
-from dtc import Socket, DTC, Poller
+from dtc import Socket, DTC, Poller, Mailbox, Peer
 from consistent import HashTable
 from message_types import *
 from zookeeper import ZookeeperClient
@@ -22,6 +23,14 @@ class Sidecar:
         # handshake with cc
         workflow_name, grt_address, read_up = self.handshake(config)
 
+        # upstream and downstream funcs send into one mailbox instead of a FIFO per peer
+        self.mailbox = Mailbox(self.func_id)
+        self.poller.add_peer(self.mailbox)
+        # func_id -> Peer, for sending into the mailbox of other funcs
+        self.peers = {}
+        # func_ids that scaled down, their late messages are dropped
+        self.removed = set()
+
         self.fan_in = config.fan_in
 
         server_funcs = config.get_servers()
@@ -32,14 +41,14 @@ class Sidecar:
         servers = self.get_clients_from_grt(grt_address, workflow_name, read_up, server_funcs)
 
         # 2-dim array. 1st are fan-in funcs, 2nd are workers
-        # DTC[][]: array of DTC for upstream funcs, recv data
+        # Peer[][]: array of Peer for upstream funcs, data arrives in the mailbox
+        # DTC[][] for the entry
         self.servers = []
         if servers:
             for server_index, server_ids in enumerate(servers):
                 self.servers.append([])
                 for server_id in server_ids:
-                    self.servers[server_index].append(DTC(f"{server_id}_{self.func_id}", f"{self.func_id}_{server_id}"))
-                    self.poller.add_peer(self.servers[server_index][-1])
+                    self.servers[server_index].append(self.get_peer(server_id))
         else:
             self.servers.append([DTC(f"{self.func_id}_r", f"{self.func_id}_w")])
             self.poller.add_peer(self.servers[0][0])
@@ -48,7 +57,7 @@ class Sidecar:
         clients = self.get_clients_from_grt(grt_address, workflow_name, read_up, client_funcs)
 
         # 2-dim array. 1st are fan-out funcs, 2nd are workers
-        # DTC[][]: array of DTC for downstream funcs, send data
+        # Peer[][]: array of Peer for downstream funcs, send data
         self.clients = []
         self.fan_in_clients = config.get_fan_in()
         # path -> client
@@ -60,8 +69,7 @@ class Sidecar:
         for client_index, client_ids in enumerate(clients):
             self.clients.append([])
             for client_id in client_ids:
-                self.clients[client_index].append(DTC(f"{client_id}_{self.func_id}", f"{self.func_id}_{client_id}"))
-                self.poller.add_peer(self.clients[client_index][-1])
+                self.clients[client_index].append(self.get_peer(client_id))
                 
                 if client_index in self.fan_in_clients:
                     self.hash_tables.append(HashTable())
@@ -130,6 +138,24 @@ class Sidecar:
 
         return clients
 
+    def get_peer(self, func_id):
+        if func_id not in self.peers:
+            self.peers[func_id] = Peer(self.func_id, func_id)
+        return self.peers[func_id]
+
+    # Peer to reply to the sender of a mailbox message, None if the sender scaled down or is gone
+    def get_sender_peer(self, func_id):
+        if func_id in self.peers:
+            return self.peers[func_id]
+        if func_id in self.removed:
+            return None
+        # a func that scaled up may send before its MESSAGE_SERVER_UP arrives, its mailbox exists then
+        peer = Peer(self.func_id, func_id)
+        if not os.path.exists(peer.path):
+            return None
+        self.peers[func_id] = peer
+        return peer
+
     def choose_client(self, client_index, req_id):
         # only 1 client
         if len(self.clients[client_index]) == 1:
@@ -144,7 +170,11 @@ class Sidecar:
             return self.clients[client_index][choose_index]
 
     def sender(self, select_dtc, message):
-        select_dtc.send(message)
+        try:
+            select_dtc.send(message)
+        except TimeoutError as e:
+            # the mailbox of a func that is gone
+            logging.info(f"{self.func_name}: drop message to {select_dtc.IDENTITY}: {e}")
 
     def worker(self, req_id, req):
         # logging.info("start worker")
@@ -173,7 +203,8 @@ class Sidecar:
         # logging.info(f"{self.func_name}: {res}")
 
         if self.fan_out > 0:
-            # store result until all downstream funcs are ready
+            # encoded once for all downstream funcs and replays, stored until all downstream funcs are ready
+            res = dumps_req(res)
             self.outputs[req_id] = {"ready": 0, "req": res}
             message = Message(type_id=MESSAGE_DATA, req_id=req_id, req=res, index=self.index)
             for client_index in range(self.fan_out):
@@ -208,15 +239,17 @@ class Sidecar:
         replay_id = f"{req_id}:{message.index}"
         # complete req
         if self.inputs[req_id]["ready"] == self.fan_in:
+            # reqs are kept encoded until here, and loaded once for the handler
+            reqs = [load_req(req) for req in self.inputs[req_id]["req"]]
             if self.fan_in == 1:
-                data = self.inputs[req_id]["req"][0]
+                data = reqs[0]
             else:
-                if isinstance(message.req, str):
+                if isinstance(reqs[message.index], str):
                     # merge data for string data
-                    data = json.dumps(self.inputs[req_id]["req"])
+                    data = json.dumps(reqs)
                 else:
                     # merge data for non-string data
-                    data = self.inputs[req_id]["req"]
+                    data = reqs
 
             self.worker(req_id, data)
 
@@ -317,13 +350,12 @@ class Sidecar:
         # zk.stop()
                 
         # add servers
+        self.removed.discard(func_id)
         if message.type_id == MESSAGE_SERVER_UP:
-            self.servers[message.index].append(DTC(f"{func_id}_{self.func_id}", f"{self.func_id}_{func_id}"))
-            self.poller.add_peer(self.servers[message.index][-1])
+            self.servers[message.index].append(self.get_peer(func_id))
         # add clients
         else:
-            self.clients[message.index].append(DTC(f"{func_id}_{self.func_id}", f"{func_id}_{self.func_id}"))
-            self.poller.add_peer(self.clients[message.index][-1])
+            self.clients[message.index].append(self.get_peer(func_id))
             if message.index in self.fan_in_clients:
                 self.clients_map[func_id] = self.clients[message.index][-1]
                 self.hash_tables[message.index].add_server(func_id)
@@ -339,14 +371,21 @@ class Sidecar:
     def handle_scale_down(self, poll_dtc, message):
         # del servers; message from upstream func that will exit
         if message.type_id == MESSAGE_SERVER_DOWN:
-            self.poller.del_peer(poll_dtc)
-            if poll_dtc in self.servers[message.index]:
-                self.servers[message.index].remove(poll_dtc)
+            self.removed.add(message.req)
+            del_server = self.peers.pop(message.req, None)
+            if del_server in self.servers[message.index]:
+                self.servers[message.index].remove(del_server)
+                del_server.close()
+            # blobs of the upstream func whose records never made it into the mailbox
+            self.mailbox.sweep(message.req)
         else:
             client_id = message.req
-            del_client = [client for client in self.clients[message.index] if f"{client_id}_{self.func_id}" in client.IDENTITY]
-            self.poller.del_peer(del_client)
-            self.clients[message.index].remove(del_client)
+            self.removed.add(client_id)
+            del_client = self.peers.pop(client_id, None)
+            if del_client in self.clients[message.index]:
+                self.clients[message.index].remove(del_client)
+                # blobs sent to the downstream func that it never read
+                del_client.close(sweep=True)
 
             if message.index in self.fan_in_clients:
                 self.hash_tables[message.index].del_server(client_id)
@@ -390,31 +429,39 @@ class Sidecar:
                 self.update_arrival_rate()
                 continue
 
-            recv_data_list = []
+            poll_results = []
             for poll_dtc in poll_dtcs:
-                recv_data_list.append(poll_dtc.recv())
+                if poll_dtc is self.mailbox:
+                    # reply to the mailbox of the sender
+                    for sender, message in self.mailbox.recv():
+                        peer = self.get_sender_peer(sender)
+                        if peer is None:
+                            logging.info(f"{self.func_name}: drop message from {sender} that scaled down")
+                            continue
+                        poll_results.append((peer, message))
+                else:
+                    poll_results.extend((poll_dtc, message) for message in poll_dtc.recv())
             
-            for poll_dtc, recv_datas in zip(poll_dtcs, recv_data_list):
-                for message in recv_datas:
-                    if message.type_id == MESSAGE_DATA:
-                        # logging.info("Start handling req")
-                        self.handle_func_req(poll_dtc, message)
-                    elif message.type_id == MESSAGE_READY:
-                        self.handle_depends_ready(message)
-                    elif message.type_id == MESSAGE_ROUTE_ERR:
-                        self.handle_route_error(poll_dtc, message)
-                    elif message.type_id == MESSAGE_DEL:
-                        self.inputs.pop(message.req_id, None)
-                    elif message.type_id == MESSAGE_SERVER_UP or message.type_id == MESSAGE_CLIENT_UP:
-                        self.handle_scale_up(poll_dtc, message)
-                    elif message.type_id == MESSAGE_SERVER_DOWN or message.type_id == MESSAGE_CLIENT_DOWN:
-                        self.handle_scale_down(poll_dtc, message)
-                    elif message.type_id == MESSAGE_PANIC_OVER:
-                        self.panic = False
-                        logging.info(f"{self.func_name} panic over")
-                    elif message.type_id == MESSAGE_EXIT:
-                        flag = False
-                        continue
+            for poll_dtc, message in poll_results:
+                if message.type_id == MESSAGE_DATA:
+                    # logging.info("Start handling req")
+                    self.handle_func_req(poll_dtc, message)
+                elif message.type_id == MESSAGE_READY:
+                    self.handle_depends_ready(message)
+                elif message.type_id == MESSAGE_ROUTE_ERR:
+                    self.handle_route_error(poll_dtc, message)
+                elif message.type_id == MESSAGE_DEL:
+                    self.inputs.pop(message.req_id, None)
+                elif message.type_id == MESSAGE_SERVER_UP or message.type_id == MESSAGE_CLIENT_UP:
+                    self.handle_scale_up(poll_dtc, message)
+                elif message.type_id == MESSAGE_SERVER_DOWN or message.type_id == MESSAGE_CLIENT_DOWN:
+                    self.handle_scale_down(poll_dtc, message)
+                elif message.type_id == MESSAGE_PANIC_OVER:
+                    self.panic = False
+                    logging.info(f"{self.func_name} panic over")
+                elif message.type_id == MESSAGE_EXIT:
+                    flag = False
+                    continue
 
         self.quit()
 
@@ -424,4 +471,11 @@ class Sidecar:
         req = Message(type_id=MESSAGE_CLIENT_DOWN, req_id=None, req=self.func_id, index=self.index)
         self.cc.send(req)         
 
-        self.poller.close()
\ No newline at end of file
+        for peer in self.peers.values():
+            peer.close()
+        # blobs the cc and the entry sent through the pipes that were never read
+        for dtc in [self.cc, *self.servers[0]]:
+            if isinstance(dtc, DTC):
+                dtc.sweep()
+        self.poller.close()
+        self.mailbox.close()
\ No newline at end of file
@@ -1,14 +1,13 @@
 import pandas as pd
 import time
-import json
 
 def handle(req):
     """handle a request to the function
     Args:
-        req (str): request body
+        req (dict): request body
     """
 
-    event = json.loads(req)
+    event = req
 
     startTime = time.time()
     externalServicesTime = []
@@ -35,4 +34,4 @@ def handle(req):
 
     response = {'time': {'start': startTime, 'end': endTime, 'externalServicesTime': externalServicesTime}, 'body': {'marketData':prices}}
 
-    return json.dumps(response)
+    return response
@@ -1,6 +1,11 @@
+import os
 import json
+import select
 import logging
+import threading
 import traceback
+from collections import deque, Counter
+from concurrent.futures import ThreadPoolExecutor
 
 from dtc import Client, Server, RDMA
 from consistent import HashTable
@@ -41,6 +46,11 @@ class Sidecar:
         # get clients from grt
         clients = self.get_clients_from_grt(grt_address, workflow_name, read_up, client_funcs)
 
+        # connect to all downstream instances at once, each one may still be starting
+        client_hosts = [client_host for client_infos in clients for client_host in client_infos.values()]
+        with ThreadPoolExecutor(max_workers=max(len(client_hosts), 1)) as executor:
+            connected = iter(list(executor.map(lambda client_host: Client(client_host, 6000), client_hosts)))
+
         # 2-dim array. 1st are fan-out funcs, 2nd are (func_id, fd)
         # tuple[][]: array of (func_id, fd) for downstream funcs
         self.clients = []
@@ -53,12 +63,12 @@ class Sidecar:
             # client_info: {client_id: client_host}
             self.clients.append([])
             for client_id, client_host in client_infos.items():
-                client = Client(client_host, 6000)
+                client = next(connected)
                 self.client_fds[client_id] = client.socket.fileno()
                 self.server.add_dtc(client)
                 self.clients[client_index].append((client_id, client.socket.fileno()))
 
-                handshake_RDMA.append((client, self.dtc.nqp))
+                handshake_RDMA.append((client, self.dtc.nqp, client_funcs[client_index]))
                 self.dtc.nqp = self.dtc.nqp + 1
                 
                 if client_index in self.fan_in_clients:
@@ -83,10 +93,22 @@ class Sidecar:
 
         self.panic = False
 
-        for client, nqp in handshake_RDMA:
-            local_info = self.dtc.prepare_dtc(nqp)
+        # new downstream instances connected in the background, (poll_dtc, message, client)
+        self.scale_ups = deque()
+        # fd -> (poll_dtc, message) of new downstream instances, routed to once their qp is ready
+        self.pending_clients = {}
+        self.wakeup_r, self.wakeup_w = os.pipe()
+        os.set_blocking(self.wakeup_r, False)
+        self.server.poller.register(self.wakeup_r, select.EPOLLIN)
+
+        # qps of all handshakes at once, in the slot classes of their edges
+        for index, n in Counter(self.dtc.recv_class(client_func) for client, nqp, client_func in handshake_RDMA).items():
+            self.dtc.refill(n, index)
+        for client, nqp, client_func in handshake_RDMA:
+            local_info = self.dtc.prepare_dtc(nqp, peer=client_func)
             message = Message(type_id=MESSAGE_HANDSHAKE_RDMA, req_id=None, req=local_info, index=nqp)
-            client.send(message)
+            self.server.send(message, client.socket)
+        self.server.flush()
 
         self.server.add_comp_ch(self.dtc.comp_ch.fd)
     
@@ -130,7 +152,7 @@ class Sidecar:
         IDENTITY = str(poll_dtc.fileno())
         # handshake from upstream
         if poll_dtc in self.server.client_socket:
-            local_info = self.dtc.prepare_dtc(self.dtc.nqp)
+            local_info = self.dtc.prepare_dtc(self.dtc.nqp, remote_info_str=message.req)
             response = Message(type_id=MESSAGE_HANDSHAKE_RDMA, req_id=None, req=local_info, index=message.index)
 
             self.dtc.add_dtc(message.req, IDENTITY, self.dtc.nqp)
@@ -141,6 +163,8 @@ class Sidecar:
         # feedback from downstream
         else:
             self.dtc.add_dtc(message.req, IDENTITY, message.index)
+            if poll_dtc.fileno() in self.pending_clients:
+                self.route_client(poll_dtc.fileno(), *self.pending_clients.pop(poll_dtc.fileno()))
 
     def choose_client(self, client_index, req_id):
         # only 1 client
@@ -172,6 +196,10 @@ class Sidecar:
         self.n_req_interval += 1
         self.n_req += 1
 
+        # do not hold frames already produced while the handler runs
+        self.server.flush()
+        self.dtc.flush()
+
         exec_start = time.time()
 
         try:
@@ -194,7 +222,8 @@ class Sidecar:
         # logging.info(f"{self.func_name}: {res}")
 
         if self.fan_out > 0:
-            # store result until all downstream funcs are ready
+            # encoded once for all downstream funcs and replays, stored until all downstream funcs are ready
+            res = dumps_req(res)
             self.outputs[req_id] = {"ready": 0, "req": res}
             message = Message(type_id=MESSAGE_DATA, req_id=req_id, req=res, index=self.index)
             for client_index in range(self.fan_out):
@@ -212,7 +241,7 @@ class Sidecar:
             # pass
             # only for getting latency distribution
             message = Message(type_id=MESSAGE_OVER, req_id=req_id, req=res, index=self.index)
-            self.cc.send(message)
+            self.sender(self.cc.socket, message)
             # logging.info(f"{self.func_name}: {res}")
 
     # massage.type_id == MESSAGE_DATA
@@ -237,15 +266,17 @@ class Sidecar:
         replay_id = f"{req_id}:{message.index}"
         # complete req
         if self.inputs[req_id]["ready"] == self.fan_in:
+            # reqs are kept encoded until here, and loaded once for the handler
+            reqs = [load_req(req) for req in self.inputs[req_id]["req"]]
             if self.fan_in == 1:
-                data = self.inputs[req_id]["req"][0]
+                data = reqs[0]
             else:
-                if isinstance(message.req, str):
+                if isinstance(reqs[message.index], str):
                     # merge data for string data
-                    data = json.dumps(self.inputs[req_id]["req"])
+                    data = json.dumps(reqs)
                 else:
                     # merge data for non-string data
-                    data = self.inputs[req_id]["req"]
+                    data = reqs
 
             self.worker(req_id, data)
 
@@ -334,35 +365,69 @@ class Sidecar:
 
     # message.type_id == MESSAGE_SERVER_UP or MESSAGE_CLIENT_UP
     # only MESSAGE_CLIENT_UP in TCP SOCKET, MESSAGE_SERVER_UP happends in socket connect
+    # zookeeper and the connection run in a thread, the event loop goes on
     def handle_scale_up(self, poll_dtc, message):
-        # add clients
-        client_id = (message.req)["func_id"]
-        workflow_name = message.req["workflow_name"]
-        grt_address = message.req["grt_address"]
-        reader_up = message.req["acl"]
+        threading.Thread(target=self.dial, args=(poll_dtc, message), daemon=True).start()
 
-        client_name = "-".join(client_id.split("-")[:-1])
+    # connect to the new downstream instance, then wake up the event loop
+    def dial(self, poll_dtc, message):
+        try:
+            client_id = (message.req)["func_id"]
+            workflow_name = message.req["workflow_name"]
+            grt_address = message.req["grt_address"]
+            reader_up = message.req["acl"]
 
-        zk = ZookeeperClient(grt_address, reader_up[0], reader_up[1])
-        func_instances = json.loads(zk.get_node(f"/{workflow_name}/{client_name}"))
-        zk.stop()
-        
-        client_ip = func_instances[client_id]
-                
-        client = Client(client_ip, 6000)
-        self.server.add_dtc(client)
-        self.client_fds[client_id] = client.socket.fileno()
-        self.clients[message.index].append((client_id, client.socket.fileno()))
+            client_name = "-".join(client_id.split("-")[:-1])
 
-        if message.index in self.fan_in_clients:
-            self.hash_tables[message.index].add_server(client_id)
+            zk = ZookeeperClient(grt_address, reader_up[0], reader_up[1])
+            func_instances = json.loads(zk.get_node(f"/{workflow_name}/{client_name}"))
+            zk.stop()
+
+            client_ip = func_instances[client_id]
+
+            client = Client(client_ip, 6000)
+        except Exception as e:
+            traceback.print_exc()
+            return
 
-        local_info = self.dtc.prepare_dtc(self.dtc.nqp)
+        self.scale_ups.append((poll_dtc, message, client))
+        os.write(self.wakeup_w, b"\0")
+
+    # add the downstream instances connected by dial
+    def handle_connected(self):
+        try:
+            os.read(self.wakeup_r, 4096)
+        except BlockingIOError:
+            pass
+        while self.scale_ups:
+            poll_dtc, message, client = self.scale_ups.popleft()
+            self.add_client(poll_dtc, message, client)
+
+    def add_client(self, poll_dtc, message, client):
+        client_id = (message.req)["func_id"]
+
+        self.server.add_dtc(client)
+
+        client_name = "-".join(client_id.split("-")[:-1])
+        local_info = self.dtc.prepare_dtc(self.dtc.nqp, peer=client_name)
         handshake_message = Message(type_id=MESSAGE_HANDSHAKE_RDMA, req_id=None, req=local_info, index=self.dtc.nqp)
-        client.send(handshake_message)
+        self.server.send(handshake_message, client.socket)
 
         self.dtc.nqp = self.dtc.nqp + 1
 
+        # choose_client only picks it once add_dtc has created its mrs, in handle_handshake_RDMA
+        self.pending_clients[client.socket.fileno()] = (poll_dtc, message)
+
+    # the qp of a new downstream instance is ready, route to it
+    def route_client(self, fd, poll_dtc, message):
+        client_id = (message.req)["func_id"]
+
+        self.client_fds[client_id] = fd
+        self.clients[message.index].append((client_id, fd))
+
+        if message.index in self.fan_in_clients:
+            self.hash_tables[message.index].add_server(client_id)
+
         self.panic = True
 
         response = Message(type_id=MESSAGE_PANIC_OVER, req_id=message.req_id, req=None, index=self.index)
@@ -381,6 +446,8 @@ class Sidecar:
         else:
             IDENTITY = str(poll_dtc.fileno())
             client_id = message.req
+            for fd in [fd for fd, pending in self.pending_clients.items() if pending[1].req["func_id"] == client_id]:
+                del self.pending_clients[fd]
             self.client_fds.pop(client_id, None)
             self.clients[message.index].remove((client_id, IDENTITY))
 
@@ -432,6 +499,11 @@ class Sidecar:
             if self.avg_exec_time:
                 logging.info(f"{self.func_name}: QPS={1.0 / self.avg_exec_time}/s")
 
+        send_stats = self.server.get_send_stats()
+        if send_stats["frames"]:
+            logging.info(f"{self.func_name}: sent {send_stats['frames']} frames, "
+                f"{send_stats['frames_per_flush']:.2f} frames/flush, {send_stats['frames_per_syscall']:.2f} frames/syscall")
+
         self.n_req_interval = 0
         self.start_exec_time = time.time()
 
@@ -446,21 +518,35 @@ class Sidecar:
 
         flag = True
         while flag:
-            poll_fds = self.server.poll()
+            # busy polling of the cq after RDMA activity
+            busy = self.dtc.busy
+            # wake up in time to resend control messages that are not acked
+            poll_fds = self.server.poll(0 if busy else self.dtc.timeout(5))
             poll_results = []
+            if busy and self.server.comp_ch not in poll_fds:
+                poll_results.extend(self.dtc.poll(wait=False))
             for fd in poll_fds:
                 # RDMA event
                 if fd == self.server.comp_ch:
                     dtc_poll_results = self.dtc.poll()
                     if dtc_poll_results:
                         poll_results.extend(dtc_poll_results)
+                # scale up connected
+                elif fd == self.wakeup_r:
+                    self.handle_connected()
+                    self.server.flush()
+                    self.dtc.flush()
                 else:
-                    socket_poll_result = self.server.poll_fd(fd)
-                    poll_results.append(socket_poll_result)
+                    socket_poll_results = self.server.poll_fd(fd)
+                    poll_results.extend(socket_poll_results)
 
             if not poll_results:
-                # no message, update arrival rate
-                self.update_arrival_rate()
+                # no message, update arrival rate and create qps for the next scale up
+                if not busy:
+                    self.update_arrival_rate()
+                    self.dtc.refill()
+                self.dtc.resend()
+                self.dtc.flush()
                 continue
             for poll_dtc, message in poll_results:
                 if message is None:
@@ -489,19 +575,25 @@ class Sidecar:
                     flag = False
                     continue
 
+            # one sendmsg per peer for all frames of this iteration,
+            # one post_send per qp for all wrs of this iteration
+            self.server.flush()
+            self.dtc.flush()
+
         self.quit()
 
         logging.info(f"{self.func_name} LC closed")
 
     def quit(self):
         req = Message(type_id=MESSAGE_CLIENT_DOWN, req_id=None, req=self.func_id, index=self.index)
-        self.cc.send(req)
+        self.sender(self.cc.socket, req)
 
         req = Message(type_id=MESSAGE_SERVER_DOWN, req_id=None, req=None, index=self.index)
         if self.fan_out:
             for client_info in self.clients:
                 for client_id, client_fd in client_info:
                     self.sender(f"{client_fd}-0", req)
+        self.dtc.flush()
 
         for fd in self.client_fds.values():
             self.dtc.destroy(str(fd))
@@ -509,4 +601,6 @@ class Sidecar:
         for socket_dtc in self.server.client_socket:
             self.dtc.destroy(str(socket_dtc.fileno()))
 
-        self.server.clean()
\ No newline at end of file
+        self.server.clean()
+        os.close(self.wakeup_r)
+        os.close(self.wakeup_w)
\ No newline at end of file
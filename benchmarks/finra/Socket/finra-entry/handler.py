@@ -8,13 +8,14 @@ from message_types import *
 
 def generate_data():
     # func for generate req for message
-    return '{"body":{ "portfolioType":"S&P", "portfolio":"1234"}}'
+    return {"body": {"portfolioType": "S&P", "portfolio": "1234"}}
 
 def generate_reqs(n_req):
     reqs = []
     for i in range(n_req):
         data = generate_data()
-        req_id = str(uuid.uuid4())
+        # 64-bit request id of the binary frame header
+        req_id = uuid.uuid4().int >> 64
         message = Message(type_id=MESSAGE_DATA, req_id=req_id, req=data, index=0)
         reqs.append(message)
     return reqs
@@ -22,11 +22,10 @@ def checkMarginBalance(portfolioData, marketData, portfolio):
 def handle(req):
     """handle a request to the function
     Args:
-        req (str): request body
+        req (list): results of the upstream functions
     """
 
-    events = json.loads(req)
-    events = [json.loads(event) for event in events]
+    events = req
 
     startTime = 1000*time.time()
     marketData = {}
@@ -48,4 +47,4 @@ def handle(req):
                 'body': {'validFormat': validFormat, 'marginSatisfied': marginSatisfied}}
 
     endTime = 1000*time.time()
-    return json.dumps(agg_timestamp(response, events, startTime, endTime, 0))
+    return agg_timestamp(response, events, startTime, endTime, 0)
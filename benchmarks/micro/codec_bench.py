@@ -0,0 +1,105 @@
+"""
+Cost of the binary frame codec of message_types against pickling whole Message objects.
+
+For a typical message of every MESSAGE_* type, it times encoding a frame (length prefix and body)
+and decoding the body, with pickle.dumps/pickle.loads of the Message as the DTCs did before,
+and with message_types.encode/decode.
+
+usage: python codec_bench.py [--template DIR] [--seconds S] [--size BYTES]
+"""
+import argparse
+import json
+import os
+import pickle
+import struct
+import sys
+import time
+
+TEMPLATE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    "..", "excamera", "RDMA", "template", "python3-rdma-func")
+
+HEADER = struct.Struct("!I")
+
+REQ_ID = 0x9f3c2a7d5e8b1046
+UPDATE_ID = 17
+
+# (req_id, req, index) of a typical message of each type
+def samples(size):
+    result = json.dumps({"req_id": REQ_ID, "time": {"vpxenc-1": {"start_time": 1.0, "end_time": 2.0}}})
+    return {
+        "MESSAGE_HANDSHAKE": (None, "vpxenc-1", None),
+        "MESSAGE_DATA": (REQ_ID, b"x" * size, 0),
+        "MESSAGE_READY": (REQ_ID, None, 1),
+        "MESSAGE_ROUTE_ERR": (REQ_ID, None, 1),
+        "MESSAGE_DEL": (REQ_ID, None, None),
+        "MESSAGE_SERVER_UP": (UPDATE_ID, None, 2),
+        "MESSAGE_SERVER_DOWN": (UPDATE_ID, "vpxenc-1-2", 2),
+        "MESSAGE_CLIENT_UP": (UPDATE_ID, None, 2),
+        "MESSAGE_CLIENT_DOWN": (UPDATE_ID, "vpxenc-1-2", 2),
+        "MESSAGE_PANIC_OVER": (UPDATE_ID, None, None),
+        "MESSAGE_ENTRY": (None, "vpxenc-1", None),
+        "MESSAGE_OVER": (REQ_ID, result, 0),
+        "MESSAGE_LAT_DIS": (None, "avg: 12.34 ms, p99: 56.78 ms, total: 100 requests", None),
+        "MESSAGE_CLEAR": (None, None, None),
+        "MESSAGE_EXIT": (None, None, None),
+        "MESSAGE_HANDSHAKE_RDMA": (None, "fe80::1,1234,140000000000,5678,1235,vpxenc-1,4096,4096", 4),
+        "MESSAGE_TRANSPORT": (None, {"server": "xcdec-1-0", "client": "vpxenc-1-0", "transport": "rdma"}, None),
+    }
+
+# req of a decoded message, the req of a MESSAGE_DATA is kept encoded until load_req, older templates load it in decode
+def load(message_types, message):
+    if hasattr(message_types, "load_req"):
+        return message_types.load_req(message.req)
+    return message.req
+
+# seconds per call of fn, over about the given time
+def per_call(fn, seconds):
+    n = 1
+    while True:
+        start = time.perf_counter()
+        for i in range(n):
+            fn()
+        elapsed = time.perf_counter() - start
+        if elapsed >= seconds:
+            return elapsed / n
+        n *= 2 if elapsed < seconds / 8 else max(2, int(seconds / elapsed) + 1)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--template", default=TEMPLATE)
+    parser.add_argument("--seconds", type=float, default=0.2)
+    parser.add_argument("--size", type=int, default=1024, help="payload of MESSAGE_DATA")
+    args = parser.parse_args()
+
+    sys.path.insert(0, os.path.abspath(args.template))
+    import message_types
+
+    types = sorted((getattr(message_types, name), name) for name in dir(message_types) if name.startswith("MESSAGE_"))
+    sample = samples(args.size)
+
+    print(f"{'type':<24} {'pickle B':>9} {'frame B':>8} {'enc pickle':>11} {'enc frame':>10} {'dec pickle':>11} {'dec frame':>10}")
+    for type_id, name in types:
+        req_id, req, index = sample.get(name, (REQ_ID, None, 0))
+        message = message_types.Message(type_id=type_id, req_id=req_id, req=req, index=index)
+
+        pickle_body = pickle.dumps(message)
+        frame_body = b"".join(message_types.encode(message))
+
+        def encode_pickle():
+            data_b = pickle.dumps(message)
+            return HEADER.pack(len(data_b)) + data_b
+
+        def encode_frame():
+            buffers = message_types.encode(message)
+            return b"".join([HEADER.pack(sum(map(len, buffers))), *buffers])
+
+        enc_pickle = per_call(encode_pickle, args.seconds)
+        enc_frame = per_call(encode_frame, args.seconds)
+        dec_pickle = per_call(lambda: pickle.loads(pickle_body), args.seconds)
+        dec_frame = per_call(lambda: load(message_types, message_types.decode(frame_body)), args.seconds)
+
+        print(f"{name[len('MESSAGE_'):]:<24} {HEADER.size + len(pickle_body):>9} {HEADER.size + len(frame_body):>8} "
+            f"{enc_pickle * 1e6:>9.2f}us {enc_frame * 1e6:>8.2f}us {dec_pickle * 1e6:>9.2f}us {dec_frame * 1e6:>8.2f}us")
+
+if __name__ == '__main__':
+    main()
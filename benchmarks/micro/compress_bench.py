@@ -0,0 +1,102 @@
+"""
+Decisions of the per-edge compression of the socket sidecars, for an ExCamera state edge and a FINRA edge.
+
+The Compressor of compress.py compresses the MESSAGE_DATA of an edge only if compress time plus
+transfer time at the link rate the Server measured beats raw transfer. For every edge and link rate,
+it feeds messages to a Compressor with that link rate, and prints the codec it chose, the bytes on the
+wire over the raw bytes, and the time per message (compress, transfer at the link rate and decompress)
+of its choice, of sending raw and of always using each codec.
+
+usage: python compress_bench.py [--template DIR] [--messages N] [--state BYTES] [--rates MB/s,...]
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+TEMPLATE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    "..", "excamera", "Socket", "template", "python3-socket-func")
+
+REQ_ID = 0x9f3c2a7d5e8b1046
+
+# decoder state of a chunk: runs of zeros between random blocks, about a third random
+def state(size):
+    data = []
+    n = 0
+    while n < size:
+        block = os.urandom(random.randint(64, 512)) + b"\x00" * random.randint(128, 1024)
+        data.append(block)
+        n += len(block)
+    return b"".join(data)[:size]
+
+# results of an edge, like the handlers return them
+def edges(state_size, n):
+    now = 1000 * time.time()
+    excamera = [{"req_id": REQ_ID, "time": {"xcdec-1": {"start": now, "end": now + 1}},
+        f"{REQ_ID}-1-0.state": state(state_size), f"{REQ_ID}-1-0.ivf": os.urandom(256 * 1024)} for i in range(n)]
+    finra = [{"statusCode": 200, "body": {"valid": True, "portfolio": "1234"}, "duration": 1.5,
+        "workflowEndTime": now + 1, "workflowStartTime": now} for i in range(n)]
+    return [("xcdec -> reencode", excamera), ("finra -> margin", finra)]
+
+# seconds to encode and compress the message, send it at rate and decompress it
+def cost(message_types, compress, message, rate):
+    start = time.perf_counter()
+    data = message_types.dumps_req(message.req).buffers
+    if compress is not None:
+        data = [compress(data)]
+        message_types.decompress(compress.codec, data[0])
+    return time.perf_counter() - start + sum(map(len, data)) / rate
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--template", default=TEMPLATE)
+    parser.add_argument("--messages", type=int, default=20, help="messages per edge and link rate")
+    parser.add_argument("--state", type=int, default=2 * 1024 * 1024, help="bytes of the .state of a chunk")
+    parser.add_argument("--rates", default="10,100,1000,10000", help="link rates in MB/s")
+    args = parser.parse_args()
+
+    sys.path.insert(0, os.path.abspath(args.template))
+    import compress
+    import message_types
+
+    rates = [float(rate) * 1e6 for rate in args.rates.split(",")]
+    defaults = compress.Compressor({}).args
+    codecs = [("raw", None)]
+    for name in defaults["codecs"]:
+        codec = compress.CODECS[name]
+        fn = lambda buffers, codec=codec: compress.compress(codec, buffers, defaults)
+        fn.codec = codec
+        codecs.append((name, fn))
+
+    print(f"{'edge':<18} {'link':>10} {'chosen':<10} {'ratio':>6} {'auto':>9} " + " ".join(f"{name:>9}" for name, fn in codecs))
+    for name, reqs in edges(args.state, args.messages):
+        messages = [message_types.Message(type_id=message_types.MESSAGE_DATA, req_id=REQ_ID, req=req, index=0) for req in reqs]
+        for rate in rates:
+            compressor = compress.Compressor({})
+            auto = 0
+            for message in messages:
+                # a message per iteration of the event loop
+                compressor.new_round()
+                start = time.perf_counter()
+                out = compressor.compress(message, 0, (rate, time.time()))
+                elapsed = time.perf_counter() - start
+                n = sum(map(len, out.req.buffers))
+                if out.req.codec != message_types.CODEC_NONE:
+                    start = time.perf_counter()
+                    message_types.decompress(out.req.codec, out.req.buffers[0])
+                    elapsed += time.perf_counter() - start
+                auto += elapsed + n / rate
+                # the sidecar decodes it as any frame
+                assert message_types.load_req(message_types.decode(b"".join(message_types.encode(out))).req) == message.req
+            stats = compressor.get_stats()[0]
+            chosen = ",".join(f"{codec}:{n}" for codec, n in stats["msgs"].items())
+
+            fixed = []
+            for codec_name, fn in codecs:
+                fixed.append(sum(cost(message_types, fn, message, rate) for message in messages) / len(messages))
+            print(f"{name:<18} {rate / 1e6:>6.0f}MB/s {chosen:<10} {stats['ratio']:>6.3f} {auto / len(messages) * 1e3:>7.3f}ms "
+                + " ".join(f"{t * 1e3:>7.3f}ms" for t in fixed))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+"""
+Loopback throughput of the TCP data-plane DTC.
+
+A Client sends MESSAGE_DATA messages to a Server in a background thread, and the
+main thread drains them with Server.poll() like the sidecar does.
+
+usage: python framer_bench.py [--template DIR] [--seconds S]
+"""
+import argparse
+import os
+import sys
+import threading
+import time
+
+TEMPLATE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    "..", "excamera", "Socket", "template", "python3-socket-func")
+
+SIZES = [64, 1024, 16 * 1024, 256 * 1024, 1024 * 1024, 8 * 1024 * 1024]
+
+def run_size(dtc, message_types, size, seconds):
+    server = dtc.Server("127.0.0.1", 0)
+    port = server.socket.getsockname()[1]
+    client = dtc.Client("127.0.0.1", port)
+
+    payload = b"x" * size
+    message = message_types.Message(type_id=message_types.MESSAGE_DATA, req_id=0, req=payload, index=0)
+
+    # enough messages for the given time, measured with a short warm-up
+    n_msg = max(10, min(200000, int(seconds * 2e9 / (size + 200) / 10)))
+
+    def send():
+        for i in range(n_msg):
+            client.send(message)
+
+    sender = threading.Thread(target=send)
+    start = time.time()
+    sender.start()
+
+    n_recv = 0
+    while n_recv < n_msg:
+        for poll_dtc, recv_data in server.poll():
+            if recv_data is None:
+                break
+            n_recv += 1
+    end = time.time()
+    sender.join()
+
+    client.clean()
+    server.clean()
+
+    return n_msg / (end - start), n_msg * size / (end - start) / 1024 / 1024
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--template", default=TEMPLATE)
+    parser.add_argument("--seconds", type=float, default=1.0)
+    args = parser.parse_args()
+
+    sys.path.insert(0, os.path.abspath(args.template))
+    import dtc
+    import message_types
+
+    print(f"{'payload':>10} {'msgs/s':>12} {'MB/s':>10}")
+    for size in SIZES:
+        msg_rate, mb_rate = run_size(dtc, message_types, size, args.seconds)
+        print(f"{size:>10} {msg_rate:>12.0f} {mb_rate:>10.1f}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,145 @@
+"""
+Cost of the bytes values of ExCamera messages on the vpxenc -> vx-con -> xcdec path, in-band and out-of-band.
+
+The handlers of ExCamera return dicts with the .ivf and .state files as bytes values. In-band, the frame
+codec copies them into the pickle of the req; out-of-band (values of at least OOB_THRESHOLD bytes), the
+transports send them as buffers of their own. For every hop, it times encoding and decoding the messages,
+and sending them from a Server to a Client of the socket DTC over TCP loopback and a Unix domain socket.
+
+usage: python oob_bench.py [--template DIR] [--seconds S] [--ivf BYTES] [--state BYTES] [--repeat N]
+"""
+import argparse
+import os
+import select
+import sys
+import tempfile
+import time
+
+TEMPLATE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    "..", "excamera", "Socket", "template", "python3-socket-func")
+
+REQ_ID = 0x9f3c2a7d5e8b1046
+
+def span(start):
+    return {"start": start, "end": start + 1}
+
+# messages of each hop, like the handlers return them, vx-con sends its merged result to all 3 xcdecs
+def hops(message_types, ivf_size, state_size):
+    now = 1000 * time.time()
+    encoded = []
+    for key in range(1, 4):
+        encoded.append({"req_id": REQ_ID, f"{REQ_ID}-{key}-0.ivf": os.urandom(ivf_size), "time": {f"vpxenc-{key}": span(now)}})
+    merged = {"req_id": REQ_ID, "time": {}}
+    for event in encoded:
+        merged.update(event)
+        merged["time"].update(event["time"])
+    merged["time"]["vx-con"] = span(now)
+    decoded = []
+    for key in range(1, 4):
+        ivf = f"{REQ_ID}-{key}-0.ivf"
+        decoded.append({"req_id": REQ_ID, "time": dict(merged["time"], **{f"xcdec-{key}": span(now)}),
+            ivf: merged[ivf], f"{REQ_ID}-{key}-0.state": os.urandom(state_size)})
+
+    def messages(reqs):
+        return [message_types.Message(type_id=message_types.MESSAGE_DATA, req_id=REQ_ID, req=req, index=index)
+            for index, req in enumerate(reqs)]
+
+    return [
+        ("vpxenc -> vx-con", messages(encoded)),
+        ("vx-con -> xcdec", messages([merged] * 3)),
+        ("xcdec -> reencode", messages(decoded)),
+    ]
+
+# req of a decoded message, the req of a MESSAGE_DATA is kept encoded until load_req, older templates load it in decode
+def load(message_types, message):
+    if hasattr(message_types, "load_req"):
+        return message_types.load_req(message.req)
+    return message.req
+
+# a Server and a Client of the socket DTC, connected
+def connect(dtc, addr):
+    server = dtc.Server(addr[0], addr[1])
+    if addr[1] is not None:
+        addr = (addr[0], server.socket.getsockname()[1])
+    client = dtc.Client(addr[0], addr[1])
+    while len(server.client_socket) == 0:
+        server.poll()
+    return server, client
+
+# send the messages of a hop and receive them, in one thread
+def transfer(server, client, messages):
+    conn = server.client_socket[0]
+    fd = conn.fileno()
+    for message in messages:
+        server.send(message, conn)
+    server.flush()
+    n_recv = 0
+    while n_recv < len(messages):
+        select.select([client.socket], [], [], 1)
+        n_recv += len(client.recv_all(client.socket))
+        if fd in server.send_bk:
+            server.poll()
+
+# seconds per call of fn, over about the given time
+def per_call(fn, seconds):
+    n = 1
+    while True:
+        start = time.perf_counter()
+        for i in range(n):
+            fn()
+        elapsed = time.perf_counter() - start
+        if elapsed >= seconds:
+            return elapsed / n
+        n *= 2 if elapsed < seconds / 8 else max(2, int(seconds / elapsed) + 1)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--template", default=TEMPLATE)
+    parser.add_argument("--seconds", type=float, default=0.1)
+    parser.add_argument("--ivf", type=int, default=256 * 1024, help="bytes of the .ivf of a chunk")
+    parser.add_argument("--state", type=int, default=2 * 1024 * 1024, help="bytes of the .state of a chunk")
+    parser.add_argument("--repeat", type=int, default=5, help="rounds of both modes, the best time is kept")
+    args = parser.parse_args()
+
+    sys.path.insert(0, os.path.abspath(args.template))
+    import dtc
+    import message_types
+
+    modes = [("in-band", float("inf")), ("oob", message_types.OOB_THRESHOLD)]
+    uds_path = os.path.join(tempfile.mkdtemp(), "bench.sock")
+    links = [("tcp", connect(dtc, ("127.0.0.1", 0))), ("uds", connect(dtc, (uds_path, None)))]
+
+    print(f"{'hop':<18} {'mode':<7} {'buffers':>7} {'encode':>9} {'decode':>9} {'tcp':>9} {'uds':>9}")
+    totals = {}
+    for name, messages in hops(message_types, args.ivf, args.state):
+        best = {}
+        # the modes take turns, so both see the same load of the host
+        for i in range(args.repeat):
+            for mode, threshold in modes:
+                # encode reads the threshold on every call
+                message_types.OOB_THRESHOLD = threshold
+                frames = [b"".join(message_types.encode(message)) for message in messages]
+                assert all(load(message_types, message_types.decode(frame)) == message.req for frame, message in zip(frames, messages))
+
+                times = [
+                    per_call(lambda: [message_types.encode(message) for message in messages], args.seconds),
+                    per_call(lambda: [load(message_types, message_types.decode(frame)) for frame in frames], args.seconds),
+                ]
+                for link, (server, client) in links:
+                    times.append(per_call(lambda: transfer(server, client, messages), args.seconds))
+                best[mode] = [min(pair) for pair in zip(best.get(mode, times), times)]
+        for mode, threshold in modes:
+            message_types.OOB_THRESHOLD = threshold
+            n_buffers = len(message_types.encode(messages[0]))
+            totals[mode] = [total + t for total, t in zip(totals.get(mode, [0] * len(best[mode])), best[mode])]
+            print(f"{name:<18} {mode:<7} {n_buffers:>7} " + " ".join(f"{t * 1e3:>7.2f}ms" for t in best[mode]))
+    for mode, times in totals.items():
+        print(f"{'path':<18} {mode:<7} {'':>7} " + " ".join(f"{t * 1e3:>7.2f}ms" for t in times))
+
+    for link, (server, client) in links:
+        client.clean()
+        server.clean()
+    os.rmdir(os.path.dirname(uds_path))
+
+if __name__ == '__main__':
+    main()
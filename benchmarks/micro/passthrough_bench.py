@@ -0,0 +1,84 @@
+"""
+Sidecar CPU per message of a func, with the req of MESSAGE_DATA loaded as it arrives against kept encoded.
+
+The sidecar routes a MESSAGE_DATA by the type, req_id and index of its frame header. Loaded as it arrives,
+every req is unpickled on receive, and every result is encoded again for each downstream func and for a
+replay. Kept encoded, decode only copies the payload out of the receive buffer, and a result is encoded
+once and sent as it is to all downstream funcs and replays. For payloads of growing size, pickled
+(rows of a table) and with an out-of-band bytes value (an ExCamera .state file), it times the receive,
+the sends of a result to the downstream funcs and a replay, and loading the req for the handler.
+
+usage: python passthrough_bench.py [--template DIR] [--seconds S] [--fan-out N]
+"""
+import argparse
+import os
+import sys
+import time
+
+TEMPLATE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    "..", "excamera", "RDMA", "template", "python3-rdma-func")
+
+REQ_ID = 0x9f3c2a7d5e8b1046
+
+# (name, req) of growing size
+def payloads():
+    for size in (1024, 64 * 1024, 1024 * 1024, 4 * 1024 * 1024):
+        rows = [[i, f"trade-{i}", i * 0.5] for i in range(size // 32)]
+        yield f"pickle {size // 1024}K", {"req_id": REQ_ID, "rows": rows}
+        # smaller values are pickled in-band
+        if size >= 64 * 1024:
+            yield f"oob {size // 1024}K", {"req_id": REQ_ID, "time": {}, f"{REQ_ID}-1-0.state": os.urandom(size)}
+
+# seconds per call of fn, over about the given time
+def per_call(fn, seconds):
+    n = 1
+    while True:
+        start = time.perf_counter()
+        for i in range(n):
+            fn()
+        elapsed = time.perf_counter() - start
+        if elapsed >= seconds:
+            return elapsed / n
+        n *= 2 if elapsed < seconds / 8 else max(2, int(seconds / elapsed) + 1)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--template", default=TEMPLATE)
+    parser.add_argument("--seconds", type=float, default=0.2)
+    parser.add_argument("--fan-out", type=int, default=3, help="downstream funcs of a result")
+    args = parser.parse_args()
+
+    sys.path.insert(0, os.path.abspath(args.template))
+    from message_types import Message, MESSAGE_DATA, encode, decode, dumps_req, load_req
+
+    # sends of a result, to the downstream funcs then a replay
+    sends = args.fan_out + 1
+
+    def eager_send(res):
+        message = Message(type_id=MESSAGE_DATA, req_id=REQ_ID, req=res, index=0)
+        for i in range(sends):
+            encode(message)
+
+    def lazy_send(res):
+        message = Message(type_id=MESSAGE_DATA, req_id=REQ_ID, req=dumps_req(res), index=0)
+        for i in range(sends):
+            encode(message)
+
+    print(f"{'payload':<12} {'recv eager':>11} {'recv lazy':>10} {'send eager':>11} {'send lazy':>10} {'load':>9}")
+    for name, req in payloads():
+        # a reused receive buffer, like the frames of the socket and RDMA transports
+        frame = bytearray(b"".join(encode(Message(type_id=MESSAGE_DATA, req_id=REQ_ID, req=req, index=0))))
+        encoded = decode(frame).req
+        assert load_req(encoded) == req
+
+        times = [
+            per_call(lambda: load_req(decode(frame).req), args.seconds),
+            per_call(lambda: decode(frame), args.seconds),
+            per_call(lambda: eager_send(req), args.seconds),
+            per_call(lambda: lazy_send(req), args.seconds),
+            per_call(lambda: load_req(encoded), args.seconds),
+        ]
+        print(f"{name:<12} " + " ".join(f"{t * 1e6:>{width}.1f}us" for t, width in zip(times, (9, 8, 9, 8, 7))))
+
+if __name__ == '__main__':
+    main()
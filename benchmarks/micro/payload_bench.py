@@ -0,0 +1,140 @@
+"""
+Serialization CPU per hop of the FINRA and SN workflows, for string and native handlers.
+
+A string handler returns json.dumps(result) and json.loads its input, and a fan-in stage gets
+the JSON list of the upstream strings, so margin-balance and compose-and-upload decode twice.
+A native handler returns and takes Python objects, and the frame codec encodes each result once.
+For every hop, it times encoding the results of the upstream funcs, decoding them at the
+downstream func, merging them at a fan-in, and the parsing in the handler.
+
+usage: python payload_bench.py [--template DIR] [--seconds S]
+"""
+import argparse
+import json
+import os
+import random
+import string
+import sys
+import time
+
+TEMPLATE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    "..", "finra", "RDMA", "template", "python3-rdma-func")
+
+REQ_ID = 0x9f3c2a7d5e8b1046
+
+def random_string(n):
+    return "".join(random.choice(string.ascii_letters + string.digits) for i in range(n))
+
+def span(start):
+    return {"start_time": start, "end_time": start + 0.001}
+
+# results of the funcs of FINRA, like the handlers return them
+def finra_hops():
+    now = 1000 * time.time()
+    request = {"body": {"portfolioType": "S&P", "portfolio": "1234"}}
+    marketdata = {"time": {"start": now, "end": now + 1, "externalServicesTime": [0.1, 0.1, 0.1]},
+        "body": {"marketData": {"GOOG": 1732.38, "AMZN": 3185.27, "MSFT": 221.02}}}
+    check = {"statusCode": 200, "body": {"valid": True, "portfolio": "1234"}, "duration": 1.5,
+        "workflowEndTime": now + 1, "workflowStartTime": now, "externalServicesTime": 0, "memsetTime": 0,
+        "timeStampCost": 0.01}
+    result = dict(check, body={"validFormat": True, "marginSatisfied": True})
+    return [
+        ("entry -> marketdata, ...", [request] * 5, False),
+        ("5 -> margin-balance", [marketdata, check, check, check, check], True),
+        ("margin-balance -> cc", [result], False),
+    ]
+
+# results of the funcs of SN, like the handlers return them
+def sn_hops():
+    now = time.time()
+    text = "@username_7 " + " ".join("http://" + random_string(64) for i in range(3))
+    media_ids = [random_string(5) for i in range(2)]
+    request = {"username": "username_1", "user_id": 1, "post_type": 0, "text": text,
+        "media_ids": ",".join(media_ids), "media_types": "png,png"}
+    post = {"time": {"compose-post": span(now)}, "body": request}
+    uploads = [
+        {"time": {"upload-user-mentions": span(now)}, "body": {"user_mentions": [{"user_id": 7, "username": "username_7"}]}},
+        {"time": {"upload-creator": span(now)}, "body": {"creator": {"username": "username_1", "user_id": 1}}},
+        {"time": {"upload-media": span(now)}, "body": {"medias": [{"media_id": i, "media_type": "png"} for i in media_ids]}},
+        {"time": {"upload-text": span(now), "compose-post": span(now)}, "body": {"text": text,
+            "urls": [{"shortened_url": "http://short-url/" + random_string(10), "expanded_url": "http://" + random_string(64)} for i in range(3)]}},
+        {"time": {"upload-unique-id": span(now)}, "body": {"post_id": random.getrandbits(63)}},
+    ]
+    composed = {"time": {}, "body": {}}
+    for upload in uploads:
+        composed["time"].update(upload["time"])
+        composed["body"].update(upload["body"])
+    stored = {"time": {"post-storage": span(now)}}
+    return [
+        ("entry -> compose-post", [request], False),
+        ("compose-post -> 5", [post] * 5, False),
+        ("5 -> compose-and-upload", uploads, True),
+        ("compose-and-upload -> 3", [composed] * 3, False),
+        ("3 -> cc", [stored] * 3, False),
+    ]
+
+# req of a decoded message, the req of a MESSAGE_DATA is kept encoded until load_req, older templates load it in decode
+def load(message_types, message):
+    if hasattr(message_types, "load_req"):
+        return message_types.load_req(message.req)
+    return message.req
+
+# serialization of one hop, upstream results in, inputs of the downstream handlers out
+def string_hop(message_types, results, fan_in):
+    frames = []
+    for index, result in enumerate(results):
+        message = message_types.Message(type_id=message_types.MESSAGE_DATA, req_id=REQ_ID, req=json.dumps(result), index=index)
+        frames.append(b"".join(message_types.encode(message)))
+    reqs = [load(message_types, message_types.decode(frame)) for frame in frames]
+    if fan_in:
+        data = json.dumps(reqs)
+        return [[json.loads(event) for event in json.loads(data)]]
+    return [json.loads(req) for req in reqs]
+
+def native_hop(message_types, results, fan_in):
+    frames = []
+    for index, result in enumerate(results):
+        message = message_types.Message(type_id=message_types.MESSAGE_DATA, req_id=REQ_ID, req=result, index=index)
+        frames.append(b"".join(message_types.encode(message)))
+    reqs = [load(message_types, message_types.decode(frame)) for frame in frames]
+    if fan_in:
+        return [reqs]
+    return reqs
+
+# seconds per call of fn, over about the given time
+def per_call(fn, seconds):
+    n = 1
+    while True:
+        start = time.perf_counter()
+        for i in range(n):
+            fn()
+        elapsed = time.perf_counter() - start
+        if elapsed >= seconds:
+            return elapsed / n
+        n *= 2 if elapsed < seconds / 8 else max(2, int(seconds / elapsed) + 1)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--template", default=TEMPLATE)
+    parser.add_argument("--seconds", type=float, default=0.2)
+    args = parser.parse_args()
+
+    sys.path.insert(0, os.path.abspath(args.template))
+    import message_types
+
+    print(f"{'workflow':<8} {'hop':<26} {'string':>9} {'native':>9} {'saved':>6}")
+    for workflow, hops in [("finra", finra_hops()), ("sn", sn_hops())]:
+        total_string = 0
+        total_native = 0
+        for name, results, fan_in in hops:
+            # both contracts hand the same inputs to the handlers
+            assert string_hop(message_types, results, fan_in) == native_hop(message_types, results, fan_in)
+            t_string = per_call(lambda: string_hop(message_types, results, fan_in), args.seconds)
+            t_native = per_call(lambda: native_hop(message_types, results, fan_in), args.seconds)
+            total_string += t_string
+            total_native += t_native
+            print(f"{workflow:<8} {name:<26} {t_string * 1e6:>7.1f}us {t_native * 1e6:>7.1f}us {1 - t_native / t_string:>6.0%}")
+        print(f"{workflow:<8} {'request':<26} {total_string * 1e6:>7.1f}us {total_native * 1e6:>7.1f}us {1 - total_native / total_string:>6.0%}")
+
+if __name__ == '__main__':
+    main()
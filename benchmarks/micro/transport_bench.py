@@ -0,0 +1,171 @@
+"""
+Throughput of the transports between two function instances on one host.
+
+- tcp:  Server.send to a Client over loopback, like the Socket templates
+- uds:  the same over a Unix domain socket
+- memfd: the same over a Unix domain socket, messages of at least --fd-threshold bytes are passed in a memfd
+- fifo: the named-pipe DTC of the IPC templates
+- mailbox: the shared-memory mailbox of the IPC templates
+
+The sender runs in a background thread, the main thread receives and decodes.
+
+usage: python transport_bench.py [--seconds S] [--fd-threshold BYTES]
+"""
+import argparse
+import importlib.util
+import os
+import select
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "excamera")
+SOCKET_TEMPLATE = os.path.join(ROOT, "Socket", "template", "python3-socket-func")
+IPC_TEMPLATE = os.path.join(ROOT, "IPC", "template", "python3-ipc-func")
+
+SIZES = [64, 1024, 16 * 1024, 256 * 1024, 1024 * 1024, 8 * 1024 * 1024]
+
+# the fifo receiver keeps all messages until the end
+MAX_BYTES = 256 * 1024 * 1024
+
+def load_ipc_dtc():
+    # another module named dtc, loaded next to the one of the Socket template
+    spec = importlib.util.spec_from_file_location("ipc_dtc", os.path.join(IPC_TEMPLATE, "dtc.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def n_messages(size, seconds):
+    n_msg = max(10, min(200000, int(seconds * 2e9 / (size + 200) / 10)))
+    return max(10, min(n_msg, MAX_BYTES // size))
+
+def run_socket(dtc, message, n_msg, addr, fd_threshold):
+    server = dtc.Server(addr[0], addr[1], fd_threshold=fd_threshold)
+    if addr[1] is not None:
+        addr = (addr[0], server.socket.getsockname()[1])
+    client = dtc.Client(addr[0], addr[1])
+
+    # the accepted socket of the client
+    while len(server.client_socket) == 0:
+        server.poll()
+    conn = server.client_socket[0]
+    fd = conn.fileno()
+
+    def send():
+        for i in range(n_msg):
+            server.send(message, conn)
+            server.flush()
+            # wait for EPOLLOUT instead of queueing without bound
+            while server.is_congested(fd):
+                server.poll()
+        while fd in server.send_bk:
+            server.poll()
+
+    sender = threading.Thread(target=send)
+    start = time.time()
+    sender.start()
+
+    n_recv = 0
+    while n_recv < n_msg:
+        select.select([client.socket], [], [])
+        for recv_data in client.recv_all(client.socket):
+            if recv_data is None:
+                break
+            n_recv += 1
+    end = time.time()
+    sender.join()
+
+    client.clean()
+    server.clean()
+    return end - start
+
+def run_fifo(dtc, message, n_msg):
+    with tempfile.TemporaryDirectory() as ipc_path:
+        receiver = dtc.DTC("a_b", "b_a", ipc_path)
+        sender_dtc = dtc.DTC("b_a", "a_b", ipc_path)
+        # the receiver reads until the sender closes its end
+        os.set_blocking(receiver.rf, True)
+
+        def send():
+            for i in range(n_msg):
+                sender_dtc.send(message)
+            os.close(sender_dtc.wf)
+
+        sender = threading.Thread(target=send)
+        start = time.time()
+        sender.start()
+        recv_data_list = receiver.recv()
+        end = time.time()
+        sender.join()
+
+        for fd in [receiver.rf, receiver.wf, sender_dtc.rf]:
+            os.close(fd)
+    assert len(recv_data_list) == n_msg, (len(recv_data_list), n_msg)
+    return end - start
+
+def run_mailbox(dtc, message, n_msg):
+    with tempfile.TemporaryDirectory() as ipc_path:
+        mailbox = dtc.Mailbox("b", ipc_path)
+        poller = dtc.Poller()
+        poller.add_peer(mailbox)
+        peer = dtc.Peer("a", "b", ipc_path)
+
+        def send():
+            for i in range(n_msg):
+                peer.send(message)
+
+        sender = threading.Thread(target=send)
+        start = time.time()
+        sender.start()
+        n_recv = 0
+        while n_recv < n_msg:
+            for poll_dtc in poller.poll():
+                n_recv += len(poll_dtc.recv())
+        end = time.time()
+        sender.join()
+
+        peer.close()
+        poller.close()
+        mailbox.close()
+    return end - start
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--seconds", type=float, default=1.0)
+    parser.add_argument("--fd-threshold", type=int, default=256 * 1024)
+    args = parser.parse_args()
+
+    sys.path.insert(0, os.path.abspath(SOCKET_TEMPLATE))
+    import dtc as socket_dtc
+    import message_types
+    try:
+        ipc_dtc = load_ipc_dtc()
+    except ImportError as e:
+        # the IPC DTC needs zmq for its handshake sockets
+        print(f"skip fifo: {e}")
+        ipc_dtc = None
+
+    uds_path = os.path.join(tempfile.mkdtemp(), "bench.sock")
+
+    print(f"{'payload':>10} {'transport':>10} {'msgs/s':>12} {'MB/s':>10}")
+    for size in SIZES:
+        message = message_types.Message(type_id=message_types.MESSAGE_DATA, req_id=0, req=b"x" * size, index=0)
+        n_msg = n_messages(size, args.seconds)
+
+        results = [
+            ("tcp", run_socket(socket_dtc, message, n_msg, ("127.0.0.1", 0), None)),
+            ("uds", run_socket(socket_dtc, message, n_msg, (uds_path, None), None)),
+            ("memfd", run_socket(socket_dtc, message, n_msg, (uds_path, None), args.fd_threshold)),
+        ]
+        if ipc_dtc:
+            results.append(("fifo", run_fifo(ipc_dtc, message, n_msg)))
+            results.append(("mailbox", run_mailbox(ipc_dtc, message, n_msg)))
+
+        for transport, duration in results:
+            print(f"{size:>10} {transport:>10} {n_msg / duration:>12.0f} {n_msg * size / duration / 1024 / 1024:>10.1f}")
+
+    os.rmdir(os.path.dirname(uds_path))
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,4 @@
 import pymongo
-import json
 from time import time
 
 mongo_url = "mongodb://post-storage-mongodb.socialnetwork-db.svc.cluster.local:27017/"
@@ -11,12 +10,12 @@ mycol = mydb["post"]
 def handle(req):
     """handle a request to the function
     Args:
-        req (str): request body
+        req (dict): request body
     """
 
     start = time()
 
-    event = json.loads(req)
+    event = req
 
     response = {"time": {"post-storage": {"start_time": start}}}
 
@@ -34,6 +33,6 @@ def handle(req):
 
     response["time"]["post-storage"]["end_time"] = time()
 
-    return json.dumps(response)
+    return response
 
     return str(time() - start)
@@ -50,13 +50,14 @@ def generate_data():
         "media_types": ",".join(media_types)
     }
 
-    return json.dumps(data)
+    return data
 
 def generate_reqs(n_req):
     reqs = []
     for i in range(n_req):
         data = generate_data()
-        req_id = str(uuid.uuid4())
+        # 64-bit request id of the binary frame header
+        req_id = uuid.uuid4().int >> 64
         message = Message(type_id=MESSAGE_DATA, req_id=req_id, req=data, index=0)
         reqs.append(message)
     return reqs
@@ -1,15 +1,14 @@
-import json
 import time
 
 def handle(req):
     """handle a request to the function
     Args:
-        req (str): request body
+        req (dict): request body
     """
 
     start = time.time()
 
-    event = json.loads(req)
+    event = req
 
     response = {"time": {"compose-post": {"start_time": start}}}   
  
@@ -29,4 +28,4 @@ def handle(req):
         response["body"] = "Incomplete arguments"
 
     response["time"]["compose-post"]["end_time"] = time.time()
-    return json.dumps(response)
+    return response
@@ -8,7 +8,7 @@ def get_lat_dist(lats, dag):
     Calculate the latency distribution from the list of latencies.
     Args:
         lats: [(message_data, timestamp)]
-        - message_data.req_id: str, request id
+        - message_data.req_id: int, request id
         - message_data.req: str, request result of a final stage func
         - timestamp: float, timestamp of receiving the message, in seconds
 
@@ -30,7 +30,7 @@ class Sidecar:
         self.client_fds = {}
 
         # id for view update, +1 when handle_view_handle is invoked
-        self.update_id = "0"
+        self.update_id = 0
         # update_id: count of instances need to notify when view is updated 
         self.panic_count = {}
         self.panic_fds = {}
@@ -112,7 +112,7 @@ class Sidecar:
                         self.panic_fds[self.update_id].append(self.client_fds[f"{stage_fn}-{i}"])
                         self.panic_count[self.update_id] += 1
 
-        self.update_id = str(int(self.update_id) + 1)
+        self.update_id += 1
 
     def handle_panic_over(self, message):
         if message.req_id in self.panic_count:
@@ -196,7 +196,7 @@ class Sidecar:
 
         self.panic_func_ids[self.update_id] = func_id
 
-        self.update_id = str(int(self.update_id) + 1)
+        self.update_id += 1
 
     def handle_closed_socket(self, dtc):
         dtc_fd = dtc.fileno()
@@ -262,6 +262,9 @@ class Sidecar:
                     self.socket.send(response, dtc)
                     flag = False
 
+            # one sendmsg per peer for all frames of this iteration
+            self.socket.flush()
+
         # quit
         funcs = self.config.get_funcs()
         for func_name in funcs:
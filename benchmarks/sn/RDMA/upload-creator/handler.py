@@ -1,4 +1,3 @@
-import json
 import time
 
 import pymongo
@@ -15,12 +14,12 @@ mycol = mydb["user"]
 def handle(req):
     """handle a request to the function
     Args:
-        req (str): request body
+        req (dict): request body
     """
 
     start = time.time()
 
-    event = json.loads(req)
+    event = req
 
     response = {"time": {"upload-creator": {"start_time": start}}}
 
@@ -49,4 +48,4 @@ def handle(req):
 
     response["time"]["upload-creator"]["end_time"] = time.time()
 
-    return json.dumps(response)
+    return response
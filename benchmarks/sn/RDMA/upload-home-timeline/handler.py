@@ -26,12 +26,12 @@ def get_followers(user_id):
 def handle(req):
     """handle a request to the function
     Args:
-        req (str): request body
+        req (dict): request body
     """
 
     start = time()
 
-    event = json.loads(req)
+    event = req
 
     response = {"time": {"upload-home-timeline": {"start_time": start}}}
 
@@ -50,4 +50,4 @@ def handle(req):
 
     response["time"]["upload-home-timeline"]["end_time"] = time()
 
-    return json.dumps(response)
+    return response
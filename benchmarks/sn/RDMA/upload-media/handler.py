@@ -1,15 +1,14 @@
-import json
 import time
 
 def handle(req):
     """handle a request to the function
     Args:
-        req (str): request body
+        req (dict): request body
     """
 
     start = time.time()
 
-    event = json.loads(req)
+    event = req
 
     response = {"time": {"upload-media": {"start_time": start}}}
     
@@ -26,4 +25,4 @@ def handle(req):
 
     response["time"]["upload-media"]["end_time"] = time.time()
 
-    return json.dumps(response)
+    return response
@@ -1,4 +1,3 @@
-import json
 import time
 import re
 import string
@@ -12,12 +11,12 @@ def gen_random_string(i):
 def handle(req):
     """handle a request to the function
     Args:
-        req (str): request body
+        req (dict): request body
     """
 
     start = time.time()
 
-    event = json.loads(req)
+    event = req
 
     response = {"time": {"upload-text": {"start_time": start}}}
     
@@ -37,4 +36,4 @@ def handle(req):
 
     response["time"]["upload-text"]["end_time"] = time.time()
 
-    return json.dumps(response)
+    return response
@@ -1,16 +1,14 @@
-import json
 import time
 
 def handle(req):
     """handle a request to the function
     Args:
-        req (str): request body
+        req (list): results of the upstream functions
     """
 
     start = time.time()
 
-    events = json.loads(req)
-    events = [json.loads(event) for event in events]
+    events = req
 
     body = {}
     response = {"time": {"compose-and-upload": {"start_time": start}}}
@@ -28,4 +26,4 @@ def handle(req):
     response["body"] = body
     response["time"]["compose-and-upload"]["end_time"] = time.time()
 
-    return json.dumps(response)
+    return response
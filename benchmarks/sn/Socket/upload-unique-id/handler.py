@@ -1,4 +1,3 @@
-import json
 import time
 import string
 import random
@@ -9,12 +8,12 @@ def gen_random_digits(i):
 def handle(req):
     """handle a request to the function
     Args:
-        req (str): request body
+        req (dict): request body
     """
 
     start = time.time()
 
-    event = json.loads(req)
+    event = req
    
     response = {"time": {"upload-unique-id": {"start_time": start}}}
  
@@ -30,4 +29,4 @@ def handle(req):
     
     response["time"]["upload-unique-id"]["end_time"] = time.time()
 
-    return json.dumps(response)
+    return response
@@ -15,11 +15,11 @@ redis_client = redis.Redis(host=user_timeline_redis, port=6379, decode_responses
 def handle(req):
     """handle a request to the function
     Args:
-        req (str): request body
+        req (dict): request body
     """
 
     start = time()
-    event = json.loads(req)
+    event = req
 
     response = {"time": {"upload-user-timeline": {"start_time": start}}}
 
@@ -45,4 +45,4 @@ def handle(req):
 
     response["time"]["upload-user-timeline"]["end_time"] = time()
 
-    return json.dumps(response)
+    return response
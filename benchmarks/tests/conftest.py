@@ -0,0 +1,39 @@
+import importlib
+import os
+import sys
+import types
+
+import pytest
+
+BENCHMARKS = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# the templates the tests import, the other benchmarks carry copies of the same modules
+TEMPLATES = {
+    "socket": os.path.join(BENCHMARKS, "excamera", "Socket", "template", "python3-socket-func"),
+    "ipc": os.path.join(BENCHMARKS, "excamera", "IPC", "template", "python3-ipc-func"),
+    "rdma": os.path.join(BENCHMARKS, "excamera", "RDMA", "template", "python3-rdma-func"),
+    "auto": os.path.join(BENCHMARKS, "excamera", "Auto", "template", "python3-auto-func"),
+}
+
+# modules the templates share by name, the sidecar imports them from its own directory
+MODULES = ("dtc", "message_types", "compress", "softverbs")
+# modules of the sidecar, imported by the tests of a sidecar themselves, it needs kazoo
+SIDECAR_MODULES = ("sidecar", "zookeeper", "consistent", "config")
+
+def unload():
+    for name in MODULES + SIDECAR_MODULES:
+        sys.modules.pop(name, None)
+
+# modules of the template named by TEMPLATE of the test module, imported like the sidecar does,
+# the template stays on sys.path for the imports they make while the tests of the module run
+@pytest.fixture(scope="module")
+def template(request):
+    path = TEMPLATES[request.module.TEMPLATE]
+    unload()
+    sys.path.insert(0, path)
+    try:
+        yield types.SimpleNamespace(**{name: importlib.import_module(name) for name in MODULES
+            if os.path.exists(os.path.join(path, f"{name}.py"))})
+    finally:
+        sys.path.remove(path)
+        unload()
@@ -0,0 +1,150 @@
+import importlib
+import os
+import select
+import socket
+import time
+
+import pytest
+
+# the sidecar imports the ZooKeeper client
+pytest.importorskip("kazoo")
+
+TEMPLATE = "auto"
+
+# the software stand-in of pyverbs, see test_rdma.py
+RDMA_ARGS = {"ib_dev": "soft", "gid_index": 0, "size": 1024, "num_sgl": 20, "rx_depth": 256, "tx_depth": 256}
+
+@pytest.fixture(scope="module")
+def sidecar(template):
+    return importlib.import_module("sidecar")
+
+# the transport parts of a sidecar as its __init__ sets them up, node is None without the shared volume
+def instance(template, sidecar, tmp_path, name, node, rnic, cc):
+    sc = object.__new__(sidecar.Sidecar)
+    sc.func_name = name
+    sc.func_id = f"{name}-0"
+    sc.node = node
+    sc.dtc = template.dtc.RDMA(name, dict(RDMA_ARGS)) if rnic else None
+    sc.server = template.dtc.Server("127.0.0.1", 0)
+    sc.cc = template.dtc.Client("127.0.0.1", cc.socket.getsockname()[1])
+    sc.server.add_dtc(sc.cc)
+    sc.compressor = None
+    if sc.dtc:
+        sc.server.add_comp_ch(sc.dtc.comp_ch.fd)
+    sc.uds = None
+    if node:
+        sc.uds = template.dtc.Server(str(tmp_path / f"{sc.func_id}.sock"), None)
+        sc.server.poller.register(sc.uds.poller.fileno(), select.EPOLLIN)
+    sc.client_names = {}
+    sc.pending_clients = {}
+    return sc
+
+def info(sc):
+    return {"host": "127.0.0.1", "node": sc.node, "rnic": sc.dtc is not None,
+        "path": sc.uds.addr if sc.uds else None}
+
+# one iteration of the event loop of the sidecar, without handling the messages
+def pump(sc):
+    results = []
+    for fd in sc.server.poll(0.01):
+        if sc.dtc and fd == sc.server.comp_ch:
+            results.extend(sc.dtc.poll())
+        elif sc.uds and fd == sc.uds.poller.fileno():
+            for uds_fd in sc.uds.poll(0):
+                results.extend(sc.uds.poll_fd(uds_fd))
+        else:
+            results.extend(sc.server.poll_fd(fd))
+    if sc.dtc:
+        sc.dtc.resend()
+    sc.flush()
+    return results
+
+# upstream a connects to downstream b like the sidecar does on start, b answers an RDMA handshake
+def connect(sidecar, a, b, port):
+    if a.uds and info(b)["node"] == a.node:
+        client = a.dial(info(b))
+    else:
+        # dial uses the port of the cluster, the test instance listens elsewhere
+        client = sidecar.Client("127.0.0.1", port)
+    client_dtc = a.connect("b-0", info(b), client)
+    a.flush()
+    if isinstance(client_dtc, str):
+        deadline = time.time() + 10
+        while client_dtc not in a.dtc.mrs and time.time() < deadline:
+            for poll_dtc, message in pump(b):
+                if message.type_id == sidecar.MESSAGE_HANDSHAKE_RDMA:
+                    b.handle_handshake_RDMA(poll_dtc, message)
+            for poll_dtc, message in pump(a):
+                if message.type_id == sidecar.MESSAGE_HANDSHAKE_RDMA:
+                    a.handle_handshake_RDMA(poll_dtc, message)
+    return client_dtc
+
+def close(*instances):
+    for sc in instances:
+        if sc.dtc:
+            for IDENTITY in list(sc.dtc.qps):
+                sc.dtc.destroy(IDENTITY)
+        sc.server.clean()
+        if sc.uds:
+            sc.uds.clean()
+
+# the transport of an edge: a Unix domain socket on the same node, RDMA if both have an RNIC, else TCP,
+# reported to the cc, and the data of the edge goes over it
+@pytest.mark.parametrize("a_node,b_node,rnic,transport", [
+    ("n1", "n1", False, "uds"),
+    ("n1", "n1", True, "uds"),
+    ("n1", "n2", False, "tcp"),
+    (None, None, False, "tcp"),
+    ("n1", "n2", True, "rdma"),
+    (None, None, True, "rdma"),
+], ids=["same node", "same node rnic", "other node", "no volume", "rdma", "rdma no volume"])
+def test_transport(template, sidecar, tmp_path, a_node, b_node, rnic, transport):
+    mt = template.message_types
+    cc = template.dtc.Server("127.0.0.1", 0)
+    a = instance(template, sidecar, tmp_path, "a", a_node, rnic, cc)
+    b = instance(template, sidecar, tmp_path, "b", b_node, rnic, cc)
+    client_dtc = connect(sidecar, a, b, b.server.socket.getsockname()[1])
+
+    reports = []
+    deadline = time.time() + 10
+    while not reports and time.time() < deadline:
+        for fd in cc.poll(0.01):
+            reports.extend(message.req for dtc, message in cc.poll_fd(fd) if message is not None)
+    assert reports == [{"server": "a-0", "client": "b-0", "transport": transport}]
+    if transport == "rdma":
+        assert isinstance(client_dtc, str)
+    else:
+        assert client_dtc.family == (socket.AF_UNIX if transport == "uds" else socket.AF_INET)
+
+    req = os.urandom(100000)
+    a.sender(client_dtc, mt.Message(type_id=mt.MESSAGE_DATA, req_id=1, req=req, index=0))
+    a.flush()
+    got = []
+    deadline = time.time() + 10
+    while not got and time.time() < deadline:
+        pump(a)
+        got.extend(message for poll_dtc, message in pump(b) if message.type_id == mt.MESSAGE_DATA)
+    assert [mt.load_req(message.req) for message in got] == [req]
+    close(a, b)
+    cc.clean()
+
+# dial picks the socket file of an instance on the same node, else its host
+def test_dial(sidecar, monkeypatch):
+    monkeypatch.setattr(sidecar, "Client", lambda host, port: (host, port))
+    sc = object.__new__(sidecar.Sidecar)
+    sc.node = "n1"
+    sc.uds = object()
+    client_info = {"host": "10.0.0.2", "node": "n1", "rnic": False, "path": "/home/app/ipc/b-0.sock"}
+    assert sc.dial(client_info) == ("/home/app/ipc/b-0.sock", None)
+    assert sc.dial(dict(client_info, node="n2")) == ("10.0.0.2", 6000)
+    sc.uds = None
+    assert sc.dial(client_info) == ("10.0.0.2", 6000)
+
+# the first instance on a node names it for all of them, without the shared volume there is none
+def test_node_id(sidecar, tmp_path, monkeypatch):
+    monkeypatch.setattr(sidecar, "IPC_DIR", str(tmp_path))
+    node = sidecar.get_node_id()
+    assert node and sidecar.get_node_id() == node
+    assert os.listdir(tmp_path) == ["node"]
+    monkeypatch.setattr(sidecar, "IPC_DIR", str(tmp_path / "missing"))
+    assert sidecar.get_node_id() is None
@@ -0,0 +1,80 @@
+import os
+import select
+import socket
+import time
+
+TEMPLATE = "socket"
+
+def data(template, req_id, req):
+    return template.message_types.Message(type_id=template.message_types.MESSAGE_DATA, req_id=req_id, req=req, index=0)
+
+# a Server on loopback and a Client with small kernel buffers, so the queue of the Server fills up
+def connect(template, hwm):
+    server = template.dtc.Server("127.0.0.1", 0, hwm=hwm)
+    client = template.dtc.Client("127.0.0.1", server.socket.getsockname()[1])
+    client.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 16 * 1024)
+    while not server.client_socket:
+        server.poll()
+    conn = server.client_socket[0]
+    conn.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 16 * 1024)
+    return server, client, conn
+
+# the client reads what arrived, the server writes more once poll sees EPOLLOUT
+def drain(server, client, fd, got, n):
+    deadline = time.time() + 10
+    while len(got) < n and time.time() < deadline:
+        if select.select([client.socket], [], [], 0.01)[0]:
+            got.extend(m for m in client.recv_all(client.socket) if m is not None)
+        if fd in server.blocked:
+            server.poll()
+
+# the queue of a peer that does not read goes above the high-water mark and waits for EPOLLOUT,
+# it is written as the peer reads and is no longer congested below half of the mark
+def test_congested_until_drained(template):
+    server, client, conn = connect(template, 64 * 1024)
+    fd = conn.fileno()
+    messages = [data(template, i, os.urandom(16 * 1024)) for i in range(40)]
+    for message in messages:
+        server.send(message, conn)
+    server.flush()
+    assert server.is_congested(fd)
+    assert fd in server.blocked and server.send_len[fd] > 64 * 1024
+
+    # the peer still does not read, nothing more is written
+    queued = server.send_len[fd]
+    server.flush()
+    assert server.send_len[fd] == queued
+
+    got = []
+    drain(server, client, fd, got, 10)
+    # frames queued while the socket is blocked go after the ones before them
+    more = [data(template, 40 + i, os.urandom(1000)) for i in range(10)]
+    for message in more:
+        server.send(message, conn)
+    server.flush()
+    drain(server, client, fd, got, len(messages) + len(more))
+
+    assert not server.is_congested(fd)
+    assert fd not in server.blocked and fd not in server.send_bk
+    assert [m.req_id for m in got] == [m.req_id for m in messages + more]
+    assert [template.message_types.load_req(m.req) for m in got] == [m.req for m in messages + more]
+    # the queue drained at the rate of the link
+    rate, measured = server.get_link_rate(fd)
+    assert rate > 0 and measured <= time.time()
+    client.clean()
+    server.clean()
+
+# a queue the kernel takes at once never blocks, its link rate stays unknown
+def test_not_congested(template):
+    server, client, conn = connect(template, 4 * 1024 * 1024)
+    fd = conn.fileno()
+    server.send(data(template, 1, b"x" * 100), conn)
+    server.flush()
+    assert not server.is_congested(fd)
+    assert fd not in server.blocked and fd not in server.send_bk
+    assert server.get_link_rate(fd) is None
+    got = []
+    drain(server, client, fd, got, 1)
+    assert [m.req_id for m in got] == [1]
+    client.clean()
+    server.clean()
@@ -0,0 +1,81 @@
+import gc
+import os
+
+import pytest
+
+# the IPC dtc imports zmq for its named-pipe DTC
+pytest.importorskip("zmq")
+
+TEMPLATE = "ipc"
+
+def data(mt, req_id, req):
+    return mt.Message(type_id=mt.MESSAGE_DATA, req_id=req_id, req=req, index=0)
+
+def blobs(path):
+    return sorted(name for name in os.listdir(path) if name.endswith(".blob"))
+
+REQS = [b"x" * 100, {"a.state": os.urandom(200 * 1024), "n": 1}, os.urandom(1 << 20)]
+
+# messages from the threshold up go through a blob named after the pipes, the req is a view of its map
+def test_pipe_blob(template, tmp_path):
+    mt = template.message_types
+    a = template.dtc.DTC("f_r", "f_w", str(tmp_path), blob_threshold=1024)
+    b = template.dtc.DTC("f_w", "f_r", str(tmp_path), blob_threshold=1024)
+    for i, req in enumerate(REQS):
+        a.send(data(mt, i, req))
+    assert len(blobs(tmp_path)) == 2
+    assert all(name.startswith(template.dtc.blob_prefix("f_w", "f_r")) for name in blobs(tmp_path))
+    got = b.recv()
+    assert [mt.load_req(message.req) for message in got] == REQS
+    assert all(type(buffer) is memoryview for buffer in got[2].req.buffers)
+    # blobs are unlinked as they are read
+    assert blobs(tmp_path) == []
+    del got
+    gc.collect()
+
+# the blobs of messages that were never read are swept by the receiver
+def test_pipe_sweep(template, tmp_path):
+    mt = template.message_types
+    a = template.dtc.DTC("f_r", "f_w", str(tmp_path), blob_threshold=1024)
+    b = template.dtc.DTC("f_w", "f_r", str(tmp_path), blob_threshold=1024)
+    a.send(data(mt, 1, REQS[2]))
+    b.send(data(mt, 2, REQS[2]))
+    b.sweep()
+    assert blobs(tmp_path) == [name for name in blobs(tmp_path) if name.startswith("f_r.")]
+    assert len(blobs(tmp_path)) == 1
+
+def test_mailbox_blob(template, tmp_path):
+    mt = template.message_types
+    mailbox = template.dtc.Mailbox("c", str(tmp_path), capacity=64 * 1024)
+    peer = template.dtc.Peer("p", "c", str(tmp_path), blob_threshold=1024)
+    for i, req in enumerate(REQS):
+        peer.send(data(mt, i, req))
+    assert all(name.startswith(template.dtc.blob_prefix("c", "p")) for name in blobs(tmp_path))
+    got = mailbox.recv()
+    assert [sender for sender, message in got] == ["p"] * len(REQS)
+    assert [mt.load_req(message.req) for sender, message in got] == REQS
+    assert all(type(buffer) is memoryview for buffer in got[2][1].req.buffers)
+    assert blobs(tmp_path) == []
+    del got
+    gc.collect()
+    peer.close()
+    mailbox.close()
+
+# a record whose blob was swept is dropped, the records after it still arrive
+def test_mailbox_blob_swept(template, tmp_path):
+    mt = template.message_types
+    mailbox = template.dtc.Mailbox("c", str(tmp_path), capacity=64 * 1024)
+    gone = template.dtc.Peer("gone", "c", str(tmp_path), blob_threshold=1024)
+    live = template.dtc.Peer("live", "c", str(tmp_path), blob_threshold=1024)
+    gone.send(data(mt, 1, REQS[2]))
+    live.send(data(mt, 2, REQS[2]))
+    mailbox.sweep("gone")
+    assert [(sender, message.req_id) for sender, message in mailbox.recv()] == [("live", 2)]
+    # a sender that closes with sweep removes what it left, and the owner what is left for it
+    gone.send(data(mt, 3, REQS[2]))
+    gone.close(sweep=True)
+    live.send(data(mt, 4, REQS[2]))
+    assert len(blobs(tmp_path)) == 1
+    live.close()
+    mailbox.close()
+    assert blobs(tmp_path) == []
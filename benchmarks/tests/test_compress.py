@@ -0,0 +1,82 @@
+import os
+import time
+
+import pytest
+
+TEMPLATE = "socket"
+
+# an ExCamera .state file, mostly zeros
+STATE = (b"\x00" * 1000 + os.urandom(24)) * 1000
+
+def data(mt, req, req_id=1):
+    return mt.Message(type_id=mt.MESSAGE_DATA, req_id=req_id, req=req, index=0)
+
+def send(compressor, message, edge, rate):
+    compressor.new_round()
+    return compressor.compress(message, edge, (rate, time.time()) if rate else None)
+
+def wire(mt, message):
+    return mt.load_req(mt.decode(b"".join(mt.encode(message))).req)
+
+@pytest.mark.parametrize("codec", ["zlib", "lzma"])
+@pytest.mark.parametrize("req", [{"a.state": STATE, "n": 1}, STATE, "s" * 100000, [STATE[:70000]] * 3],
+    ids=["oob", "bytes", "str", "pickle"])
+def test_codec_round_trip(template, codec, req):
+    mt = template.message_types
+    raw = mt.dumps_req(req)
+    compressed = mt.Encoded(raw.flags, [template.compress.compress(template.compress.CODECS[codec], raw.buffers,
+        template.compress.Compressor({}).args)], template.compress.CODECS[codec])
+    assert wire(mt, data(mt, compressed)) == req
+
+# compress on a slow link, raw on a fast one, or if the queue keeps up or the link rate is stale
+def test_decisions(template):
+    mt = template.message_types
+    compressor = template.compress.Compressor({})
+    for rate, compressed in ((10e6, True), (10e9, False), (None, False)):
+        message = data(mt, {"s": STATE})
+        out = send(compressor, message, f"edge-{rate}", rate)
+        if rate is None:
+            assert out is message
+        assert (type(out.req) is mt.Encoded and out.req.codec != mt.CODEC_NONE) == compressed
+        assert wire(mt, out) == message.req
+    message = data(mt, {"s": STATE})
+    compressor.new_round()
+    assert compressor.compress(message, "stale", (10e6, time.time() - 100)) is message
+
+@pytest.mark.parametrize("req", [os.urandom(1 << 20), {"small": 1}], ids=["random", "small"])
+def test_sent_raw(template, req):
+    mt = template.message_types
+    out = send(template.compress.Compressor({}), data(mt, req), "edge", 10e6)
+    assert out.req.codec == mt.CODEC_NONE
+    assert wire(mt, out) == req
+
+def test_control_untouched(template):
+    mt = template.message_types
+    message = mt.Message(type_id=mt.MESSAGE_READY, req_id=1, req=None, index=0)
+    assert send(template.compress.Compressor({}), message, "edge", 1e3) is message
+
+# a spent loop budget sends later messages raw, but a fan-out reuses what another edge compressed
+def test_loop_budget(template):
+    mt = template.message_types
+    compressor = template.compress.Compressor({})
+    for edge in ("a", "b"):
+        send(compressor, data(mt, {"s": STATE}, 0), edge, 10e6)
+    message = data(mt, {"s": STATE})
+    compressor.new_round()
+    assert compressor.compress(message, "a", (10e6, time.time())).req.codec != mt.CODEC_NONE
+    compressor.spent = compressor.args["loop_budget"]
+    assert compressor.compress(message, "b", (10e6, time.time())).req.codec != mt.CODEC_NONE
+    out = compressor.compress(data(mt, {"s": STATE}, 2), "a", (10e6, time.time()))
+    assert out.req.codec == mt.CODEC_NONE
+    assert compressor.get_stats()["a"]["over_budget"] == 1
+    assert send(compressor, data(mt, {"s": STATE}, 3), "a", 10e6).req.codec != mt.CODEC_NONE
+
+# a new peer of an edge starts from scratch
+def test_reset(template):
+    mt = template.message_types
+    compressor = template.compress.Compressor({})
+    send(compressor, data(mt, {"s": STATE}), "edge", 10e6)
+    assert compressor.edges["edge"]["est"]
+    compressor.reset("edge")
+    assert "edge" not in compressor.edges
+    assert compressor.get_stats() == {}
@@ -0,0 +1,102 @@
+import os
+import select
+import socket
+import threading
+
+TEMPLATE = "socket"
+
+def frame_bytes(template, message):
+    body = b"".join(template.message_types.encode(message))
+    return template.dtc.HEADER.pack(len(body)) + body
+
+def data(template, req_id, req):
+    return template.message_types.Message(type_id=template.message_types.MESSAGE_DATA, req_id=req_id, req=req, index=0)
+
+# frames cut at every byte come out whole and in order
+def test_frames_split_across_reads(template):
+    messages = [data(template, i, os.urandom(size)) for i, size in enumerate((0, 1, 100, 5000, 70000))]
+    stream = b"".join(frame_bytes(template, m) for m in messages)
+    framer = template.dtc.Framer(size=4096)
+    a, b = socket.socketpair()
+    got = []
+    with a, b:
+        for start in range(0, len(stream), 777):
+            a.sendall(stream[start: start + 777])
+            while select.select([b], [], [], 0)[0]:
+                framer.fill(b)
+            while True:
+                frame, fds, owned = framer.next_frame()
+                if frame is None:
+                    break
+                with frame:
+                    got.append(template.message_types.decode(frame, owned))
+    assert [m.req_id for m in got] == [m.req_id for m in messages]
+    assert [template.message_types.load_req(m.req) for m in got] == [m.req for m in messages]
+
+# several frames of one read share the buffer and are handed out as views of it
+def test_many_frames_one_read(template):
+    messages = [data(template, i, b"x" * i) for i in range(1, 50)]
+    framer = template.dtc.Framer()
+    a, b = socket.socketpair()
+    with a, b:
+        a.sendall(b"".join(frame_bytes(template, m) for m in messages))
+        framer.fill(b)
+        frames = []
+        while True:
+            frame, fds, owned = framer.next_frame()
+            if frame is None:
+                break
+            assert frame.obj is framer.buf and not owned
+            frames.append(frame)
+    assert len(frames) == len(messages)
+
+# a big frame leaves with its buffer, the frames after it are intact
+def test_big_frame_is_owned(template):
+    big = data(template, 1, os.urandom(200000))
+    small = data(template, 2, b"after")
+    framer = template.dtc.Framer(size=4096)
+    a, b = socket.socketpair()
+    with a, b:
+        a.sendall(frame_bytes(template, big) + frame_bytes(template, small))
+        message = None
+        while message is None:
+            framer.fill(b)
+            frame, fds, owned = framer.next_frame()
+            if frame is not None:
+                assert owned
+                message = template.message_types.decode(frame, owned)
+        while framer.next_frame()[0] is None:
+            framer.fill(b)
+    assert type(message.req.buffers[0]) is memoryview
+    assert template.message_types.load_req(message.req) == big.req
+    assert len(framer.buf) == framer.size
+
+# messages of all sizes through the Server and a Client on loopback, with a queue that blocks
+def test_server_to_client(template):
+    server = template.dtc.Server("127.0.0.1", 0, hwm=256 * 1024)
+    client = template.dtc.Client("127.0.0.1", server.socket.getsockname()[1])
+    while not server.client_socket:
+        server.poll()
+    conn = server.client_socket[0]
+    messages = [data(template, i, os.urandom(size)) for i, size in enumerate([10, 1000, 100000, 3 * 1024 * 1024] * 3)]
+
+    def send():
+        for message in messages:
+            server.send(message, conn)
+            server.flush()
+            while server.is_congested(conn.fileno()):
+                server.poll()
+        while conn.fileno() in server.send_bk:
+            server.poll()
+
+    thread = threading.Thread(target=send)
+    thread.start()
+    got = []
+    while len(got) < len(messages):
+        assert select.select([client.socket], [], [], 5)[0]
+        got.extend(m for m in client.recv_all(client.socket) if m is not None)
+    thread.join()
+    client.clean()
+    server.clean()
+    assert [m.req_id for m in got] == [m.req_id for m in messages]
+    assert [template.message_types.load_req(m.req) for m in got] == [m.req for m in messages]
@@ -0,0 +1,104 @@
+import multiprocessing
+import os
+import time
+
+import pytest
+
+# the IPC dtc imports zmq for its named-pipe DTC
+pytest.importorskip("zmq")
+
+TEMPLATE = "ipc"
+
+N = 2000
+PRODUCERS = 4
+
+# a sender instance, the mailbox lock is a file lock, so senders are processes like the funcs
+def produce(template, ipc_path, i):
+    peer = template.dtc.Peer(f"p{i}", "c", ipc_path, blob_threshold=32 * 1024)
+    for k in range(N):
+        # mostly small records, some bigger than the mailbox can hold at once and some blobs
+        size = 40000 if k % 200 == 0 else (20000 if k % 50 == 0 else k % 300)
+        peer.send(template.message_types.Message(type_id=template.message_types.MESSAGE_DATA, req_id=k,
+            req=bytes([i]) * size, index=i))
+    peer.close()
+
+# the records of every sender come out whole and in order, while the ring wraps and fills up
+def test_concurrent_senders(template, tmp_path):
+    mt = template.message_types
+    context = multiprocessing.get_context("fork")
+    producers = [context.Process(target=produce, args=(template, str(tmp_path), i)) for i in range(PRODUCERS)]
+    mailbox = template.dtc.Mailbox("c", str(tmp_path), capacity=64 * 1024)
+    poller = template.dtc.Poller()
+    poller.add_peer(mailbox)
+    for producer in producers:
+        producer.start()
+
+    last = {}
+    n = 0
+    deadline = time.time() + 60
+    while n < N * PRODUCERS and time.time() < deadline:
+        for dtc in poller.poll():
+            for sender, message in dtc.recv():
+                i = message.index
+                assert sender == f"p{i}"
+                assert message.req_id == last.get(sender, -1) + 1
+                req = mt.load_req(message.req)
+                assert req == bytes([i]) * len(req)
+                last[sender] = message.req_id
+                n += 1
+    for producer in producers:
+        producer.join(10)
+        assert producer.exitcode == 0
+    poller.close()
+    mailbox.close()
+    assert n == N * PRODUCERS
+    # blobs are unlinked as they are read
+    assert not [name for name in os.listdir(tmp_path) if name.endswith(".blob")]
+
+# a sender that dies between reserve and commit does not block the mailbox
+def test_stalled_record_skipped(template, tmp_path):
+    mt = template.message_types
+    mailbox = template.dtc.Mailbox("c", str(tmp_path), capacity=64 * 1024, stall_timeout=0.2)
+    dead = template.dtc.Peer("dead", "c", str(tmp_path))
+    dead.open()
+    dead.reserve(100)
+    # recv does not wait for the record, the Poller hands the mailbox out again on a short tick
+    poller = template.dtc.Poller()
+    poller.add_peer(mailbox)
+    assert mailbox.recv() == [] and mailbox.pending
+    live = template.dtc.Peer("live", "c", str(tmp_path))
+    live.send(mt.Message(type_id=mt.MESSAGE_DATA, req_id=7, req=b"x", index=0))
+    start = time.time()
+    assert poller.poll() == [mailbox]
+    assert time.time() - start < 1
+    assert mailbox.recv() == [] and mailbox.pending
+    time.sleep(0.2)
+    assert [(sender, message.req_id) for sender, message in mailbox.recv()] == [("live", 7)]
+    assert not mailbox.pending
+    live.send(mt.Message(type_id=mt.MESSAGE_DATA, req_id=8, req=b"x", index=0))
+    assert [(sender, message.req_id) for sender, message in mailbox.recv()] == [("live", 8)]
+    for peer in (dead, live):
+        peer.close()
+    poller.close()
+    mailbox.close()
+
+# a sender gives up on a mailbox whose owner does not read it
+def test_full_timeout(template, tmp_path):
+    mt = template.message_types
+    mailbox = template.dtc.Mailbox("c", str(tmp_path), capacity=4096)
+    peer = template.dtc.Peer("p", "c", str(tmp_path), blob_threshold=8192, full_timeout=0.1)
+    with pytest.raises(TimeoutError):
+        for i in range(1000):
+            peer.send(mt.Message(type_id=mt.MESSAGE_DATA, req_id=i, req=b"x", index=0))
+    with pytest.raises(TimeoutError):
+        peer.send(mt.Message(type_id=mt.MESSAGE_DATA, req_id=1000, req=b"x" * 10000, index=0))
+    # the blob of the message that did not fit is removed
+    assert not [name for name in os.listdir(tmp_path) if name.endswith(".blob")]
+    peer.close()
+    mailbox.close()
+
+def test_open_timeout(template, tmp_path):
+    mt = template.message_types
+    peer = template.dtc.Peer("p", "gone", str(tmp_path), open_timeout=0.1)
+    with pytest.raises(TimeoutError):
+        peer.send(mt.Message(type_id=mt.MESSAGE_DATA, req_id=1, req=b"", index=0))
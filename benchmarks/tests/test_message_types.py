@@ -0,0 +1,89 @@
+import pickle
+
+import pytest
+
+TEMPLATE = "socket"
+
+# req of a decoded message, loaded like the sidecar hands it to the handler
+def fields(mt, message):
+    return message.type_id, message.req_id, mt.load_req(message.req), message.index
+
+def round_trip(mt, message, frame_type=bytes):
+    return mt.decode(frame_type(b"".join(mt.encode(message))))
+
+REQS = [None, b"", b"raw", "", "text", "ünïcode", 0, 3.5, [1, "a", None], {"rows": [[1, "x", 0.5]] * 100},
+    ("t", 1), {"nested": {"deep": [b"small bytes"]}}]
+
+@pytest.mark.parametrize("req", REQS, ids=repr)
+@pytest.mark.parametrize("frame_type", [bytes, bytearray, memoryview])
+def test_data_round_trip(template, req, frame_type):
+    mt = template.message_types
+    message = mt.Message(type_id=mt.MESSAGE_DATA, req_id=(1 << 64) - 1, req=req, index=7)
+    assert fields(mt, round_trip(mt, message, frame_type)) == fields(mt, message)
+
+# every message type with the header fields left out
+@pytest.mark.parametrize("type_id", range(15))
+def test_control_round_trip(template, type_id):
+    mt = template.message_types
+    for req_id, index in ((None, None), (0, 0), (42, mt.MAX_INDEX)):
+        message = mt.Message(type_id=type_id, req_id=req_id, req="ctl", index=index)
+        decoded = round_trip(mt, message)
+        assert fields(mt, decoded) == fields(mt, message)
+
+# a frame is the header and the payload, nothing else
+def test_frame_size(template):
+    mt = template.message_types
+    frame = b"".join(mt.encode(mt.Message(type_id=mt.MESSAGE_READY, req_id=5, req=None, index=1)))
+    assert len(frame) == mt.FRAME_HEADER.size
+    frame = b"".join(mt.encode(mt.Message(type_id=mt.MESSAGE_DATA, req_id=5, req=b"abc", index=1)))
+    assert len(frame) == mt.FRAME_HEADER.size + 3
+    assert mt.FRAME_HEADER.unpack_from(frame)[:4] == (mt.MESSAGE_DATA, mt.FRAME_BYTES, 1, 5)
+
+# objects that do not fit the header are pickled whole
+@pytest.mark.parametrize("message", [
+    "not a message",
+    {"type": 1},
+], ids=repr)
+def test_object_fallback(template, message):
+    mt = template.message_types
+    frame = b"".join(mt.encode(message))
+    assert mt.FRAME_HEADER.unpack_from(frame)[1] == mt.FRAME_OBJECT
+    assert mt.decode(frame) == message
+
+# and so are messages with fields the header cannot hold
+@pytest.mark.parametrize("kwargs", [
+    {"req_id": "uuid-string"},
+    {"req_id": -1},
+    {"req_id": 1 << 64},
+    {"index": -1},
+    {"index": 1 << 16},
+], ids=repr)
+def test_header_overflow(template, kwargs):
+    mt = template.message_types
+    message = mt.Message(**dict({"type_id": mt.MESSAGE_DATA, "req_id": 1, "req": [1], "index": 0}, **kwargs))
+    decoded = round_trip(mt, message)
+    assert (decoded.type_id, decoded.req_id, decoded.req, decoded.index) == \
+        (message.type_id, message.req_id, message.req, message.index)
+
+# the sidecar keeps a MESSAGE_DATA encoded and sends it on as it came
+def test_data_kept_encoded(template):
+    mt = template.message_types
+    req = {"rows": list(range(1000))}
+    frame = b"".join(mt.encode(mt.Message(type_id=mt.MESSAGE_DATA, req_id=3, req=req, index=0)))
+    message = mt.decode(frame)
+    assert type(message.req) is mt.Encoded
+    assert b"".join(mt.encode(message)) == frame
+    assert mt.load_req(message.req) == req
+
+# a frame that is reused after decode is copied, an owned one is kept as views
+def test_owned_frame(template):
+    mt = template.message_types
+    req = {"rows": list(range(1000))}
+    frame = bytearray(b"".join(mt.encode(mt.Message(type_id=mt.MESSAGE_DATA, req_id=3, req=req, index=0))))
+    copied = mt.decode(frame)
+    kept = mt.decode(frame, owned=True)
+    assert type(kept.req.buffers[0]) is memoryview
+    frame[mt.FRAME_HEADER.size:] = bytes(len(frame) - mt.FRAME_HEADER.size)
+    assert mt.load_req(copied.req) == req
+    with pytest.raises(pickle.UnpicklingError):
+        mt.load_req(kept.req)
@@ -0,0 +1,92 @@
+import os
+import select
+import tempfile
+import threading
+
+import pytest
+
+TEMPLATE = "socket"
+
+def flags(mt, message):
+    return mt.FRAME_HEADER.unpack_from(b"".join(mt.encode(message)))[1]
+
+def data(mt, req):
+    return mt.Message(type_id=mt.MESSAGE_DATA, req_id=9, req=req, index=0)
+
+BIG = os.urandom(200 * 1024)
+
+@pytest.mark.parametrize("req", [
+    {"req_id": 1, "time": {}, "a.state": BIG, "b.ivf": os.urandom(100 * 1024), "small": b"x" * 10},
+    [BIG, 1, "two"],
+    (b"y" * 70000, BIG),
+    {"same": BIG, "again": BIG},
+], ids=["dict", "list", "tuple", "shared"])
+def test_oob_round_trip(template, req):
+    mt = template.message_types
+    message = data(mt, req)
+    assert flags(mt, message) & mt.FRAME_OOB
+    buffers = mt.encode(message)
+    # the values are buffers of their own, not copied into the pickle
+    assert any(buffer is BIG for buffer in buffers)
+    loaded = mt.load_req(mt.decode(b"".join(buffers)).req)
+    assert loaded == req and type(loaded) is type(req)
+    # bytes values come back as bytes, not views of the frame
+    values = lambda req: list(req.values()) if type(req) is dict else list(req)
+    assert [type(value) for value in values(loaded)] == [type(value) for value in values(req)]
+
+def test_shared_value_sent_once(template):
+    mt = template.message_types
+    buffers = mt.encode(data(mt, {"same": BIG, "again": BIG}))
+    assert sum(buffer is BIG for buffer in buffers) == 1
+
+# small values, other containers and other types stay in the pickle
+@pytest.mark.parametrize("req", [
+    {"small": b"x" * (64 * 1024 - 1)},
+    {"nested": {"deep": BIG}},
+    bytearray(BIG),
+    {"array": bytearray(BIG)},
+], ids=["small", "nested", "bytearray", "bytearray value"])
+def test_in_band(template, req):
+    mt = template.message_types
+    message = data(mt, req)
+    assert not flags(mt, message) & mt.FRAME_OOB
+    assert mt.load_req(mt.decode(b"".join(mt.encode(message))).req) == req
+
+# the handler of a fan-in stage gets the values of an OOB req from a frame that is reused
+def test_oob_copied_from_reused_frame(template):
+    mt = template.message_types
+    req = {"a.state": BIG}
+    frame = bytearray(b"".join(mt.encode(data(mt, req))))
+    message = mt.decode(frame)
+    frame[:] = bytes(len(frame))
+    assert mt.load_req(message.req) == req
+
+# over a Unix domain socket, with and without the memfd handoff
+@pytest.mark.parametrize("fd_threshold", [None, 64 * 1024])
+def test_oob_over_uds(template, fd_threshold):
+    mt = template.message_types
+    path = os.path.join(tempfile.mkdtemp(), "s")
+    server = template.dtc.Server(path, None, fd_threshold=fd_threshold)
+    client = template.dtc.Client(path, None)
+    while not server.client_socket:
+        server.poll()
+    conn = server.client_socket[0]
+    reqs = [{"a.state": os.urandom(size), "n": size} for size in (70000, 1 << 20, 4 << 20)] * 2
+
+    def send():
+        for req in reqs:
+            server.send(data(mt, req), conn)
+            server.flush()
+        while conn.fileno() in server.send_bk:
+            server.poll()
+
+    thread = threading.Thread(target=send)
+    thread.start()
+    got = []
+    while len(got) < len(reqs):
+        assert select.select([client.socket], [], [], 5)[0]
+        got.extend(m for m in client.recv_all(client.socket) if m is not None)
+    thread.join()
+    client.clean()
+    server.clean()
+    assert [mt.load_req(m.req) for m in got] == reqs
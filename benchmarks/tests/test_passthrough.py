@@ -0,0 +1,137 @@
+import importlib
+import json
+
+import pytest
+
+# the sidecar imports the ZooKeeper client
+pytest.importorskip("kazoo")
+
+TEMPLATE = "socket"
+
+@pytest.fixture(scope="module")
+def sidecar(template):
+    return importlib.import_module("sidecar")
+
+# an upstream or downstream func, by its fd
+class Peer:
+    def __init__(self, fd):
+        self.fd = fd
+
+    def fileno(self):
+        return self.fd
+
+# the Server of the sidecar, it keeps what is sent instead of writing it
+class Server:
+    def __init__(self, peers):
+        self.map = {peer.fileno(): peer for peer in peers}
+        self.sent = []
+
+    def send(self, message, dtc):
+        self.sent.append((dtc, message))
+
+    def flush(self):
+        pass
+
+    def is_congested(self, fd):
+        return False
+
+    def get_link_rate(self, fd):
+        return None
+
+# the parts of a sidecar its __init__ sets up, fan_out downstream funcs with one instance each
+def instance(sidecar, handle, fan_in, fan_out):
+    sc = object.__new__(sidecar.Sidecar)
+    upstream = [Peer(i) for i in range(fan_in)]
+    downstream = [Peer(100 + i) for i in range(fan_out)]
+    sc.server = Server(upstream + downstream)
+    sc.compressor = None
+    sc.client_names = {}
+    sc.fan_in = fan_in
+    sc.fan_out = fan_out
+    sc.servers = {}
+    sc.server_index_list = {str(i): [] for i in range(fan_in)}
+    sc.clients = [[(f"f{i}-0", peer.fileno())] for i, peer in enumerate(downstream)]
+    sc.fan_in_clients = []
+    sc.hash_tables = [0] * fan_out
+    sc.handle = handle
+    sc.index = 0
+    sc.inputs = {}
+    sc.outputs = {}
+    sc.replays = []
+    sc.dtc_map = {}
+    sc.panic = False
+    sc.n_req = 0
+    sc.n_req_interval = 0
+    sc.avg_exec_time = None
+    return sc, upstream, downstream
+
+# a MESSAGE_DATA as the sidecar receives it, the req still encoded
+def received(mt, req_id, req, index):
+    return mt.decode(b"".join(mt.encode(mt.Message(type_id=mt.MESSAGE_DATA, req_id=req_id, req=req, index=index))))
+
+# counts the calls of a function of the sidecar
+def count(sidecar, monkeypatch, name):
+    calls = []
+    function = getattr(sidecar, name)
+    def counted(req):
+        calls.append(req)
+        return function(req)
+    monkeypatch.setattr(sidecar, name, counted)
+    return calls
+
+# the reqs of a fan-in stay encoded until the last one arrives and are loaded once for the handler,
+# its result is encoded once and the same Encoded goes to every downstream func
+@pytest.mark.parametrize("reqs,data", [
+    ([b"a" * 100, b"b" * 100], [b"a" * 100, b"b" * 100]),
+    (["a", "b"], json.dumps(["a", "b"])),
+    ([{"k": b"x" * 70000}], {"k": b"x" * 70000}),
+], ids=["bytes", "str", "oob"])
+def test_fan_in(template, sidecar, monkeypatch, reqs, data):
+    mt = template.message_types
+    handled = []
+    def handle(req):
+        handled.append(req)
+        return {"state": b"y" * 70000, "n": len(handled)}
+    loads = count(sidecar, monkeypatch, "load_req")
+    dumps = count(sidecar, monkeypatch, "dumps_req")
+    sc, upstream, downstream = instance(sidecar, handle, len(reqs), 3)
+
+    messages = [received(mt, 7, req, index) for index, req in enumerate(reqs)]
+    for message in messages[:-1]:
+        sc.handle_func_req(upstream[message.index], message)
+        assert type(sc.inputs[7]["req"][message.index]) is mt.Encoded
+        assert not handled and not loads
+    sc.handle_func_req(upstream[-1], messages[-1])
+
+    assert handled == [data]
+    assert len(loads) == len(reqs) and len(dumps) == 1
+    sent = [(dtc, message) for dtc, message in sc.server.sent if message.type_id == mt.MESSAGE_DATA]
+    assert [dtc for dtc, message in sent] == downstream
+    assert all(message.req is sc.outputs[7]["req"] for dtc, message in sent)
+    assert type(sc.outputs[7]["req"]) is mt.Encoded
+    assert mt.load_req(received(mt, 7, sc.outputs[7]["req"], 0).req) == {"state": b"y" * 70000, "n": 1}
+    # the last upstream func is told the req is done
+    assert [(dtc, message.type_id) for dtc, message in sc.server.sent if message.type_id != mt.MESSAGE_DATA] == \
+        [(upstream[-1], mt.MESSAGE_READY)]
+
+# a downstream func that asked for a replay before the result was there gets the same Encoded,
+# the result is kept until all downstream funcs are ready with it
+def test_replay(template, sidecar, monkeypatch):
+    mt = template.message_types
+    dumps = count(sidecar, monkeypatch, "dumps_req")
+    sc, upstream, downstream = instance(sidecar, lambda req: b"r" * 1000, 1, 2)
+    replay = Peer(200)
+    sc.server.map[replay.fileno()] = replay
+    sc.handle_route_error(replay, mt.Message(type_id=mt.MESSAGE_ROUTE_ERR, req_id=3, req=None, index=1))
+    assert sc.dtc_map == {"3:1": replay}
+
+    sc.handle_func_req(upstream[0], received(mt, 3, b"in", 0))
+    sent = [(dtc, message) for dtc, message in sc.server.sent if message.type_id == mt.MESSAGE_DATA]
+    assert [dtc for dtc, message in sent] == [downstream[0], replay]
+    assert len(dumps) == 1
+    assert all(message.req is sc.outputs[3]["req"] for dtc, message in sent)
+    assert not sc.dtc_map
+
+    for index in range(2):
+        sc.handle_depends_ready(mt.Message(type_id=mt.MESSAGE_READY, req_id=3, req=None, index=index))
+    assert not sc.outputs
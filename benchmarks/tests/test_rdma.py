@@ -0,0 +1,178 @@
+import gc
+import os
+import select
+import time
+
+import pytest
+
+TEMPLATE = "rdma"
+
+# the software stand-in of pyverbs, instances of one process talk through its Unix datagram sockets
+ARGS = {"ib_dev": "soft", "gid_index": 0, "size": 1024, "num_sgl": 20, "rx_depth": 256, "tx_depth": 256}
+
+# RDMA instances connected like the sidecars do it with the handshake, a connects to b
+def pair(template, args):
+    a = template.dtc.RDMA("a", dict(args))
+    b = template.dtc.RDMA("b", dict(args))
+    a_info = a.prepare_dtc(0, peer="b")
+    b_info = b.prepare_dtc(0, remote_info_str=a_info)
+    b.add_dtc(a_info, "a", 0)
+    a.add_dtc(b_info, "b", 0)
+    return a, b
+
+# one iteration of the event loop of the sidecars, (instance, mr_id, message) of all of them
+def pump(nodes, timeout=0.01):
+    for node in nodes:
+        node.resend()
+        node.flush()
+    ready = select.select([node.comp_ch.fd for node in nodes], [], [], timeout)[0]
+    got = []
+    for node in nodes:
+        if node.comp_ch.fd in ready:
+            got.extend((node, mr_id, message) for mr_id, message in node.poll())
+        elif node.busy:
+            got.extend((node, mr_id, message) for mr_id, message in node.poll(wait=False))
+    return got
+
+def receive(nodes, to, n):
+    got = []
+    deadline = time.time() + 10
+    while len(got) < n and time.time() < deadline:
+        got.extend((mr_id, message) for node, mr_id, message in pump(nodes) if node is to)
+    assert len(got) == n
+    return got
+
+def close(*nodes):
+    for node in nodes:
+        for peer in list(node.qps):
+            node.destroy(peer)
+
+def data(template, req_id, req):
+    mt = template.message_types
+    return mt.Message(type_id=mt.MESSAGE_DATA, req_id=req_id, req=req, index=0)
+
+# one slot, several slots and rendezvous reads, in order
+SIZES = [0, 10, 900, 1500, 5000, 30000, 200000, 2 << 20]
+
+@pytest.mark.parametrize("args", [ARGS, dict(ARGS, num_sgl=1), dict(ARGS, rndv_threshold=1 << 30),
+    dict(ARGS, inline_size=0), dict(ARGS, busy_poll_us=2000)],
+    ids=["default", "one slot", "no rendezvous", "no inline", "busy poll"])
+def test_round_trip(template, args):
+    mt = template.message_types
+    a, b = pair(template, args)
+    sent = [data(template, i, os.urandom(size)) for i, size in enumerate(SIZES * 2)]
+    for message in sent:
+        a.send("b-0", message)
+    got = receive([a, b], b, len(sent))
+    assert {mr_id for mr_id, message in got} == {"a-1"}
+    assert [message.req_id for mr_id, message in got] == [message.req_id for message in sent]
+    assert [mt.load_req(message.req) for mr_id, message in got] == [message.req for message in sent]
+    close(a, b)
+
+def test_both_ways(template):
+    mt = template.message_types
+    a, b = pair(template, ARGS)
+    sent = {a: [], b: []}
+    for i, size in enumerate(SIZES):
+        for node, mr_id in ((a, "b-0"), (b, "a-0")):
+            message = data(template, i, os.urandom(size))
+            node.send(mr_id, message)
+            sent[node].append(message)
+    got = {a: [], b: []}
+    deadline = time.time() + 10
+    while (len(got[a]) < len(SIZES) or len(got[b]) < len(SIZES)) and time.time() < deadline:
+        for node, mr_id, message in pump([a, b]):
+            got[node].append(message)
+    for node, peer in ((a, b), (b, a)):
+        assert [mt.load_req(message.req) for message in got[node]] == [message.req for message in sent[peer]]
+    close(a, b)
+
+# control messages without a req take the control path and keep their fields
+def test_control(template):
+    mt = template.message_types
+    a, b = pair(template, ARGS)
+    a.send("b-0", data(template, 5, b"x"))
+    receive([a, b], b, 1)
+    b.send("a-0", mt.Message(type_id=mt.MESSAGE_READY, req_id=5, req=None, index=2))
+    b.send("a-0", mt.Message(type_id=mt.MESSAGE_ROUTE_ERR, req_id=6, req=None, index=2))
+    got = receive([a, b], a, 2)
+    assert [(m.type_id, m.req_id, m.index) for mr_id, m in got] == \
+        [(mt.MESSAGE_READY, 5, 2), (mt.MESSAGE_ROUTE_ERR, 6, 2)]
+    close(a, b)
+
+# several senders into one receiver, whose qps share the recv buffers of a slot class
+def test_fan_in(template):
+    mt = template.message_types
+    receiver = template.dtc.RDMA("r", dict(ARGS))
+    senders = []
+    for i in range(4):
+        sender = template.dtc.RDMA(f"s{i}", dict(ARGS))
+        receiver_info = receiver.prepare_dtc(i)
+        sender_info = sender.prepare_dtc(0)
+        sender.add_dtc(receiver_info, "r", 0)
+        receiver.add_dtc(sender_info, f"s{i}", i)
+        senders.append(sender)
+    sent = {}
+    for k, size in enumerate(SIZES * 3):
+        for i, sender in enumerate(senders):
+            message = data(template, k, os.urandom(size))
+            sender.send("r-0", message)
+            sent.setdefault(f"s{i}-1", []).append(message)
+    got = {}
+    for mr_id, message in receive([receiver] + senders, receiver, sum(map(len, sent.values()))):
+        got.setdefault(mr_id, []).append(message)
+    for mr_id, messages in sent.items():
+        assert [mt.load_req(message.req) for message in got[mr_id]] == [message.req for message in messages]
+    # the fan-in fits the shared recv buffers, no packet waits for a recv wr
+    assert receiver.ctx.stats["rnr"] == 0
+    close(receiver, *senders)
+
+# the req of a rendezvous keeps the read buffer, which goes back to the cache once it is released
+def test_rendezvous_buffer_reused(template):
+    mt = template.message_types
+    a, b = pair(template, ARGS)
+    req = {"a.state": os.urandom(1 << 20)}
+    a.send("b-0", data(template, 1, req))
+    (mr_id, message), = receive([a, b], b, 1)
+    cached = sum(map(len, b.rndv_free.values()))
+    assert mt.load_req(message.req) == req
+    del message
+    gc.collect()
+    assert sum(map(len, b.rndv_free.values())) == cached + 1
+    close(a, b)
+
+# a control message the peer does not ack goes on the rc qp after UD_RETRIES sends, with its req_id
+def test_control_falls_back_to_rc(template, monkeypatch):
+    mt = template.message_types
+    monkeypatch.setattr(template.dtc, "UD_RETRIES", 2)
+    a, b = pair(template, ARGS)
+    a.send("b-0", data(template, 5, b"x"))
+    receive([a, b], b, 1)
+    # a drops everything that arrives on its ud qp
+    monkeypatch.setattr(a, "recv_ud", lambda wc, poll_results: a.post_ud_recv(wc.wr_id >> template.dtc.WR_SLOT_SHIFT))
+    b.send("a-0", mt.Message(type_id=mt.MESSAGE_READY, req_id=5, req=None, index=2))
+    (mr_id, message), = receive([a, b], a, 1)
+    assert (message.type_id, message.req_id, message.index) == (mt.MESSAGE_READY, 5, 2)
+    assert not b.unacked
+    # the handle of the req_id is free again
+    assert a.mrs["b-0"]["handles"] == {}
+    close(a, b)
+
+# a handle is given again only after the peer is ready with its req_id, the other messages go without one
+def test_handles_not_reused_while_live(template, monkeypatch):
+    mt = template.message_types
+    monkeypatch.setattr(template.dtc, "HANDLES", 4)
+    a, b = pair(template, ARGS)
+    for req_id in range(6):
+        a.send("b-0", data(template, req_id, b"x"))
+    receive([a, b], b, 6)
+    assert sorted(a.mrs["b-0"]["handles"]) == [0, 1, 2, 3]
+    for req_id in range(6):
+        b.send("a-0", mt.Message(type_id=mt.MESSAGE_READY, req_id=req_id, req=None, index=0))
+    got = receive([a, b], a, 6)
+    assert sorted(message.req_id for mr_id, message in got) == list(range(6))
+    assert a.mrs["b-0"]["handles"] == {}
+    a.send("b-0", data(template, 6, b"x"))
+    receive([a, b], b, 1)
+    assert list(a.mrs["b-0"]["handles"]) == [6]
+    close(a, b)
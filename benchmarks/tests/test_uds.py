@@ -0,0 +1,88 @@
+import os
+import select
+import threading
+
+import pytest
+
+TEMPLATE = "socket"
+
+def data(template, req_id, req):
+    return template.message_types.Message(type_id=template.message_types.MESSAGE_DATA, req_id=req_id, req=req, index=0)
+
+def open_fds():
+    return len(os.listdir("/proc/self/fd"))
+
+def connect(template, path, fd_threshold=None):
+    server = template.dtc.Server(path, None, fd_threshold=fd_threshold)
+    client = template.dtc.Client(path, None)
+    while not server.client_socket:
+        server.poll()
+    return server, client, server.client_socket[0]
+
+# the server writes its queue from a thread, the client reads until it has n messages
+def exchange(server, client, conn, messages):
+    def send():
+        for message in messages:
+            server.send(message, conn)
+        server.flush()
+        while conn.fileno() in server.send_bk:
+            server.poll()
+
+    thread = threading.Thread(target=send)
+    thread.start()
+    got = []
+    while len(got) < len(messages):
+        assert select.select([client.socket], [], [], 5)[0]
+        got.extend(m for m in client.recv_all(client.socket) if m is not None)
+    thread.join()
+    return got
+
+# a socket file left by an earlier instance is replaced, the unnamed peers are told apart by their fd,
+# and the file is removed on clean
+def test_socket_file(template, tmp_path):
+    path = str(tmp_path / "s")
+    open(path, "w").close()
+    server, client, conn = connect(template, path)
+    assert server.address[conn.fileno()] == f"{path}:{conn.fileno()}"
+    client.send(data(template, 1, b"up"))
+    got = []
+    while not got:
+        got.extend(message for dtc, message in server.poll())
+    assert template.message_types.load_req(got[0].req) == b"up"
+    client.clean()
+    server.clean()
+    assert not os.path.exists(path)
+
+# bodies from fd_threshold up go in a sealed memfd, the req is a view of its map,
+# smaller ones and every body without a threshold go in the stream
+@pytest.mark.parametrize("fd_threshold", [None, 64 * 1024])
+def test_memfd_handoff(template, tmp_path, fd_threshold):
+    mt = template.message_types
+    server, client, conn = connect(template, str(tmp_path / "s"), fd_threshold)
+    fds = open_fds()
+    messages = [data(template, i, os.urandom(size)) for i, size in enumerate([10, 70000, 1 << 20, 1000, 4 << 20])]
+    got = exchange(server, client, conn, messages)
+    assert [mt.load_req(m.req) for m in got] == [m.req for m in messages]
+    mapped = [type(m.req.buffers[0]) is memoryview and type(m.req.buffers[0].obj).__name__ == "mmap" for m in got]
+    if fd_threshold is None:
+        assert not any(mapped)
+    else:
+        assert mapped == [len(m.req) >= fd_threshold for m in messages]
+    # the memfds are closed on both sides once the messages are released
+    del got
+    assert open_fds() == fds
+    client.clean()
+    server.clean()
+
+# more memfds than one SCM_RIGHTS message carries, the frames wait for fds that come with a later recvmsg
+def test_many_memfds(template, tmp_path):
+    mt = template.message_types
+    server, client, conn = connect(template, str(tmp_path / "s"), 1024)
+    n = template.dtc.SCM_MAX_FD * 2 + 10
+    messages = [data(template, i, bytes([i % 256]) * 2000) for i in range(n)]
+    got = exchange(server, client, conn, messages)
+    assert [m.req_id for m in got] == list(range(n))
+    assert [mt.load_req(m.req) for m in got] == [m.req for m in messages]
+    assert not server.send_fds
+    client.clean()
+    server.clean()
@@ -0,0 +1,74 @@
+import os
+import select
+import time
+
+import pytest
+
+TEMPLATE = "socket"
+
+def data(template, req_id, req):
+    return template.message_types.Message(type_id=template.message_types.MESSAGE_DATA, req_id=req_id, req=req, index=0)
+
+def connect(template, host, zerocopy_threshold, tmp_path=None):
+    if host is None:
+        path = str(tmp_path / "s")
+        server = template.dtc.Server(path, None, zerocopy_threshold=zerocopy_threshold)
+        client = template.dtc.Client(path, None)
+    else:
+        server = template.dtc.Server(host, 0, zerocopy_threshold=zerocopy_threshold)
+        client = template.dtc.Client(host, server.socket.getsockname()[1])
+    while not server.client_socket:
+        server.poll()
+    return server, client, server.client_socket[0]
+
+# the client reads, the server reaps the completions of its zero-copy sends from the error queue
+def exchange(server, client, fd, n):
+    got = []
+    deadline = time.time() + 10
+    while (len(got) < n or server.zc_pending.get(fd, None)) and time.time() < deadline:
+        if select.select([client.socket], [], [], 0.01)[0]:
+            got.extend(m for m in client.recv_all(client.socket) if m is not None)
+        if server.poller.poll(0):
+            server.poll()
+    return got
+
+# big sendmsgs go with MSG_ZEROCOPY, their buffers are kept until the kernel reports them done
+def test_zerocopy_reaped(template):
+    server, client, conn = connect(template, "127.0.0.1", 64 * 1024)
+    fd = conn.fileno()
+    if fd not in server.zerocopy:
+        pytest.skip("kernel without SO_ZEROCOPY")
+    messages = [data(template, i, os.urandom(1 << 20)) for i in range(4)]
+    for message in messages:
+        server.send(message, conn)
+        server.flush()
+    # the kernel may still read the buffers of the sends
+    assert server.zc_pending[fd]
+    got = exchange(server, client, fd, len(messages))
+    assert not server.zc_pending[fd]
+    assert [template.message_types.load_req(m.req) for m in got] == [m.req for m in messages]
+    stats = server.get_send_stats()
+    # one sendmsg per message at least, more if one was written in parts
+    assert stats["zerocopy"] >= len(messages)
+    # loopback copies anyway and says so in the completion
+    assert stats["zerocopy_copied"] <= stats["zerocopy"]
+    client.clean()
+    server.clean()
+
+# small sendmsgs are copied, so are all of them without a threshold or on a Unix domain socket
+@pytest.mark.parametrize("host,threshold", [("127.0.0.1", 64 * 1024), ("127.0.0.1", None), (None, 64 * 1024)],
+    ids=["small", "off", "uds"])
+def test_copied(template, tmp_path, host, threshold):
+    server, client, conn = connect(template, host, threshold, tmp_path)
+    fd = conn.fileno()
+    size = 1000 if threshold and host else 1 << 20
+    messages = [data(template, i, os.urandom(size)) for i in range(4)]
+    for message in messages:
+        server.send(message, conn)
+        server.flush()
+    assert not server.zc_pending.get(fd, None)
+    got = exchange(server, client, fd, len(messages))
+    assert [template.message_types.load_req(m.req) for m in got] == [m.req for m in messages]
+    assert server.get_send_stats().get("zerocopy", 0) == 0
+    client.clean()
+    server.clean()